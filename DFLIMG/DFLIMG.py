@@ -5,8 +5,8 @@ from .DFLJPG import DFLJPG
 class DFLIMG():
 
     @staticmethod
-    def load(filepath, loader_func=None):
+    def load(filepath, loader_func=None, header_only=False):
         if filepath.suffix == '.jpg':
-            return DFLJPG.load ( str(filepath), loader_func=loader_func )
+            return DFLJPG.load ( str(filepath), loader_func=loader_func, header_only=header_only )
         else:
             return None
@@ -0,0 +1,317 @@
+import multiprocessing
+import os
+import pickle
+import struct
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+from core import pathex
+from core.interact import interact as io
+from core.joblib import Subprocessor
+from facelib import FaceType
+
+from .DFLIMG import DFLIMG
+
+index_filename = '.dflindex'
+
+class DFLIndex(object):
+    """
+    Columnar metadata index of the aligned faces of one folder, stored in <folder>/.dflindex
+
+    Rows are keyed by filename, size and mtime.
+    load() reparses only new or changed files and writes the index back.
+
+    Files which are not dfl images are remembered as skipped and are not reparsed until changed.
+    Other files which are not in the index ( unusual landmarks )
+    have to be loaded with DFLIMG.load
+    """
+    VERSION = 3
+
+    # parse result of file which is not a dfl image
+    NOT_DFL = 'not_dfl'
+
+    # name, dtype, shape of row
+    array_columns = [ ('face_type',           np.int32,   () ),
+                      ('shape',               np.int32,   (3,) ),
+                      ('landmarks',           np.float32, (68,2) ),
+                      ('source_landmarks',    np.float64, (68,2) ),
+                      ('source_rect',         np.float64, (4,) ),
+                      ('image_to_face_mat',   np.float64, (2,3) ),
+                      ('eyebrows_expand_mod', np.float32, () ),
+                      ('has_seg_ie_polys',    np.bool_,   () ),
+                      ('has_xseg_mask',       np.bool_,   () ),
+                    ]
+
+    # variable size columns
+    object_columns = ['source_filename', 'seg_ie_polys', 'xseg_mask_compressed']
+
+    # optional columns, filled with nan if value is None
+    nan_columns = ['source_landmarks', 'source_rect', 'image_to_face_mat']
+
+    def __init__(self, dir_path):
+        self.dir_path = Path(dir_path)
+        self.filenames = []
+        self.sizes = np.zeros( (0,), np.int64 )
+        self.mtimes = np.zeros( (0,), np.int64 )
+        self.columns = { name : np.zeros( (0,)+shape, dtype ) for name, dtype, shape in DFLIndex.array_columns }
+        self.columns.update ( { name : [] for name in DFLIndex.object_columns } )
+        self.filename_to_idx = {}
+        # filename : (size, mtime) of files which are not dfl images
+        self.skipped = {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @staticmethod
+    def load(dir_path, update=True):
+        """
+        returns DFLIndex of dir_path, updated with the current files of the folder if update is True
+        """
+        index = DFLIndex(dir_path)
+        index_path = index.dir_path / index_filename
+
+        if index_path.exists():
+            try:
+                if not index.read(index_path):
+                    # index of older version is rebuilt
+                    index = DFLIndex(dir_path)
+            except:
+                io.log_info(f"{index_path} is corrupted and will be rebuilt.")
+                index = DFLIndex(dir_path)
+
+        if update:
+            index.update()
+        return index
+
+    def read(self, filepath):
+        """
+        returns False if the index is of older version
+        """
+        with open(filepath, "rb") as f:
+            version, = struct.unpack("Q", f.read(8) )
+            if version < DFLIndex.VERSION:
+                return False
+            if version != DFLIndex.VERSION:
+                raise NotImplementedError
+            d = pickle.loads(f.read())
+
+        self.filenames = d['filenames']
+        self.sizes = d['sizes']
+        self.mtimes = d['mtimes']
+        self.columns = d['columns']
+        self.filename_to_idx = { filename : i for i, filename in enumerate(self.filenames) }
+        self.skipped = d.get('skipped', {})
+        return True
+
+    def write(self, filepath):
+        d = {'filenames' : self.filenames,
+             'sizes' : self.sizes,
+             'mtimes' : self.mtimes,
+             'columns' : self.columns,
+             'skipped' : self.skipped }
+
+        pathex.write_bytes_safe (filepath, struct.pack("Q", DFLIndex.VERSION) + pickle.dumps(d, 4) )
+
+    def update(self):
+        """
+        reparses new and changed files, removes deleted files.
+        The index is written back if anything has changed.
+        """
+        file_stats = {}
+        if self.dir_path.exists():
+            with os.scandir(self.dir_path) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.lower().endswith('.jpg'):
+                        stat = entry.stat()
+                        file_stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        keep_idxs = []
+        stale_filenames = []
+        skipped = {}
+        for filename, stat in file_stats.items():
+            idx = self.filename_to_idx.get(filename, None)
+            if idx is not None and self.sizes[idx] == stat[0] and self.mtimes[idx] == stat[1]:
+                keep_idxs.append(idx)
+            elif self.skipped.get(filename, None) == stat:
+                skipped[filename] = stat
+            else:
+                stale_filenames.append(filename)
+
+        if len(stale_filenames) == 0 and len(keep_idxs) == len(self.filenames) and len(skipped) == len(self.skipped):
+            return
+
+        rows = DFLIndex.parse_files ( [ str(self.dir_path / filename) for filename in stale_filenames ] )
+
+        new_filenames = [ self.filenames[idx] for idx in keep_idxs ]
+        new_columns = { name : self.columns[name][keep_idxs] for name, _, _ in DFLIndex.array_columns }
+        new_columns.update ( { name : [ self.columns[name][idx] for idx in keep_idxs ] for name in DFLIndex.object_columns } )
+
+        added_filenames = []
+        added_rows = []
+        for filename, row in zip(stale_filenames, rows):
+            if row is DFLIndex.NOT_DFL:
+                skipped[filename] = file_stats[filename]
+            elif row is not None:
+                added_filenames.append(filename)
+                added_rows.append(row)
+
+        if len(added_rows) != 0:
+            for name, dtype, shape in DFLIndex.array_columns:
+                values = np.array ( [ row[name] for row in added_rows ], dtype ).reshape( (len(added_rows),)+shape )
+                new_columns[name] = np.concatenate ( [new_columns[name], values], 0 )
+
+            for name in DFLIndex.object_columns:
+                new_columns[name] += [ row[name] for row in added_rows ]
+
+        self.filenames = new_filenames + added_filenames
+        self.sizes = np.array ( [ file_stats[filename][0] for filename in self.filenames ], np.int64 )
+        self.mtimes = np.array ( [ file_stats[filename][1] for filename in self.filenames ], np.int64 )
+        self.columns = new_columns
+        self.filename_to_idx = { filename : i for i, filename in enumerate(self.filenames) }
+        self.skipped = skipped
+
+        try:
+            self.write (self.dir_path / index_filename)
+        except:
+            io.log_info(f"Unable to write {self.dir_path / index_filename}")
+
+    @staticmethod
+    def parse_files(filepaths):
+        """
+        returns list of rows, None for files which cannot be indexed,
+        DFLIndex.NOT_DFL for files which are not dfl images
+        """
+        if len(filepaths) < 256:
+            return [ DFLIndex.parse_file(filepath) for filepath in io.progress_bar_generator(filepaths, "Indexing") ]
+        return DFLIndexSubprocessor(filepaths).run()
+
+    @staticmethod
+    def parse_file(filepath):
+        try:
+            dflimg = DFLIMG.load (Path(filepath), header_only=True)
+            if dflimg is None or not dflimg.has_data():
+                return DFLIndex.NOT_DFL
+
+            row = {'face_type'            : FaceType.fromString( dflimg.get_face_type() ),
+                   'shape'                : dflimg.get_shape(),
+                   'landmarks'            : dflimg.get_landmarks(),
+                   'source_landmarks'     : dflimg.get_dict().get('source_landmarks', None),
+                   'source_rect'          : dflimg.get_source_rect(),
+                   'image_to_face_mat'    : dflimg.get_image_to_face_mat(),
+                   'eyebrows_expand_mod'  : dflimg.get_eyebrows_expand_mod(),
+                   'has_seg_ie_polys'     : dflimg.has_seg_ie_polys(),
+                   'has_xseg_mask'        : dflimg.has_xseg_mask(),
+                   'source_filename'      : dflimg.get_source_filename(),
+                   'seg_ie_polys'         : dflimg.get_dict().get('seg_ie_polys', None),
+                   'xseg_mask_compressed' : dflimg.get_xseg_mask_compressed(),
+                  }
+
+            for name, dtype, shape in DFLIndex.array_columns:
+                value = row[name]
+                if value is not None:
+                    value = np.array(value, dtype)
+                    if value.shape != shape:
+                        value = None
+
+                if value is None:
+                    if name not in DFLIndex.nan_columns:
+                        return None
+                    value = np.full (shape, np.nan, dtype)
+                row[name] = value
+
+            return row
+        except:
+            io.log_err(f"Unable to index {filepath}: {traceback.format_exc()}")
+            return None
+
+    def get_idx(self, filepath, check_stat=False):
+        """
+        returns row index of filepath or None if file is not in the index
+
+        check_stat      also returns None if the file has changed since indexing,
+                        use it for an index loaded with update=False
+        """
+        filepath = Path(filepath)
+        idx = self.filename_to_idx.get( filepath.name, None)
+        if idx is not None and check_stat:
+            try:
+                stat = filepath.stat()
+            except:
+                return None
+            if self.sizes[idx] != stat.st_size or self.mtimes[idx] != stat.st_mtime_ns:
+                return None
+        return idx
+
+    def is_skipped(self, filepath):
+        """
+        returns True if filepath is known as not a dfl image
+        """
+        return Path(filepath).name in self.skipped
+
+    def get(self, idx, name):
+        """
+        returns value of column 'name' at row idx,
+        None for optional values which are not set
+        """
+        value = self.columns[name][idx]
+        if name in DFLIndex.nan_columns:
+            if np.isnan(value).all():
+                return None
+            if name == 'source_rect':
+                # as stored in DFLJPG
+                return tuple( int(x) for x in value )
+        return value
+
+class DFLIndexSubprocessor(Subprocessor):
+    #override
+    def __init__(self, filepaths):
+        self.filepaths = filepaths
+        self.idxs = [*range(len(filepaths))]
+        self.result = [None]*len(filepaths)
+        super().__init__('DFLIndex', DFLIndexSubprocessor.Cli, 60, chunk_size=0)
+
+    #override
+    def on_clients_initialized(self):
+        io.progress_bar ("Indexing", len (self.filepaths))
+
+    #override
+    def on_clients_finalized(self):
+        io.progress_bar_close()
+
+    #override
+    def process_info_generator(self):
+        for i in range(min(multiprocessing.cpu_count(), 8) ):
+            yield 'CPU%d' % (i), {}, {}
+
+    #override
+    def get_data(self, host_dict):
+        if len (self.idxs) > 0:
+            idx = self.idxs.pop(0)
+            return idx, self.filepaths[idx]
+        return None
+
+    #override
+    def on_data_return (self, host_dict, data):
+        self.idxs.insert(0, data[0])
+
+    #override
+    def on_result (self, host_dict, data, result):
+        idx, row = result
+        self.result[idx] = row
+        io.progress_bar_inc(1)
+
+    #override
+    def get_result(self):
+        return self.result
+
+    class Cli(Subprocessor.Cli):
+        #override
+        def process_data(self, data):
+            idx, filepath = data
+            return idx, DFLIndex.parse_file(filepath)
+
+        #override
+        def get_data_name (self, data):
+            return data[1]
@@ -1,4 +1,4 @@
-import pickle
+import os
 import struct
 import traceback
 
@@ -12,6 +12,8 @@ from core.interact import interact as io
 from core.structex import *
 from facelib import FaceType
 
+from .DFLMeta import DFLMeta
+
 
 class DFLJPG(object):
     def __init__(self, filename):
@@ -22,113 +24,174 @@ class DFLJPG(object):
         self.dfl_dict = None
         self.shape = None
         self.img = None
+        self.header_only = False
+        # (size, mtime_ns) of the file on disk when loaded, None if not loaded from disk
+        self.file_stat = None
+
+    # bytes read from disk for header-only loads, enough for APPn/SOFn of a typical aligned face
+    HEADER_PREFIX_SIZE = 65536
 
     @staticmethod
-    def load_raw(filename, loader_func=None):
+    def load_raw(filename, loader_func=None, header_only=False):
+        """
+        header_only     stop at SOS, the entropy-coded scan and the chunks after it are not parsed.
+                        Only a prefix of the file is read if loader_func is not provided.
+        """
         try:
             if loader_func is not None:
                 data = loader_func(filename)
+                if not isinstance(data, bytes):
+                    data = bytes(data)
+                file_stat = None
+                is_prefix = False
             else:
+                st = os.stat(filename)
+                file_stat = (st.st_size, st.st_mtime_ns)
                 with open(filename, "rb") as f:
-                    data = f.read()
+                    if header_only:
+                        data = f.read(DFLJPG.HEADER_PREFIX_SIZE)
+                        is_prefix = len(data) == DFLJPG.HEADER_PREFIX_SIZE
+                    else:
+                        data = f.read()
+                        is_prefix = False
         except:
             raise FileNotFoundError(filename)
 
         try:
+            chunks = DFLJPG.parse_chunks(data, header_only=header_only, is_prefix=is_prefix)
+            if chunks is None:
+                # headers do not fit into the prefix, read the whole file
+                with open(filename, "rb") as f:
+                    data = f.read()
+                chunks = DFLJPG.parse_chunks(data, header_only=header_only)
+
             inst = DFLJPG(filename)
             inst.data = data
             inst.length = len(data)
-            inst_length = inst.length
-            chunks = []
-            data_counter = 0
-            while data_counter < inst_length:
-                chunk_m_l, chunk_m_h = struct.unpack ("BB", data[data_counter:data_counter+2])
-                data_counter += 2
+            inst.chunks = chunks
+            inst.header_only = header_only
+            inst.file_stat = file_stat
+            return inst
+        except Exception as e:
+            raise Exception (f"Corrupted JPG file {filename} {e}")
 
-                if chunk_m_l != 0xFF:
-                    raise ValueError(f"No Valid JPG info in {filename}")
-
-                chunk_name = None
-                chunk_size = None
-                chunk_data = None
-                chunk_ex_data = None
-                is_unk_chunk = False
-
-                if chunk_m_h & 0xF0 == 0xD0:
-                    n = chunk_m_h & 0x0F
-
-                    if n >= 0 and n <= 7:
-                        chunk_name = "RST%d" % (n)
-                        chunk_size = 0
-                    elif n == 0x8:
-                        chunk_name = "SOI"
-                        chunk_size = 0
-                        if len(chunks) != 0:
-                            raise Exception("")
-                    elif n == 0x9:
-                        chunk_name = "EOI"
-                        chunk_size = 0
-                    elif n == 0xA:
-                        chunk_name = "SOS"
-                    elif n == 0xB:
-                        chunk_name = "DQT"
-                    elif n == 0xD:
-                        chunk_name = "DRI"
-                        chunk_size = 2
-                    else:
-                        is_unk_chunk = True
-                elif chunk_m_h & 0xF0 == 0xC0:
-                    n = chunk_m_h & 0x0F
-                    if n == 0:
-                        chunk_name = "SOF0"
-                    elif n == 2:
-                        chunk_name = "SOF2"
-                    elif n == 4:
-                        chunk_name = "DHT"
-                    else:
-                        is_unk_chunk = True
-                elif chunk_m_h & 0xF0 == 0xE0:
-                    n = chunk_m_h & 0x0F
-                    chunk_name = "APP%d" % (n)
+    @staticmethod
+    def parse_chunks(data, header_only=False, is_prefix=False):
+        """
+        returns list of chunks,
+        or None if is_prefix and data ends before SOS
+        """
+        data_len = len(data)
+        data_mv = memoryview(data)
+        chunks = []
+        data_counter = 0
+        while data_counter < data_len:
+            if is_prefix and data_counter+4 > data_len:
+                return None
+
+            chunk_m_l, chunk_m_h = struct.unpack ("BB", data[data_counter:data_counter+2])
+            data_counter += 2
+
+            if chunk_m_l != 0xFF:
+                raise ValueError("No Valid JPG info")
+
+            chunk_name = None
+            chunk_size = None
+            chunk_data = None
+            chunk_offset = None
+            chunk_ex_data = None
+            is_unk_chunk = False
+
+            if chunk_m_h & 0xF0 == 0xD0:
+                n = chunk_m_h & 0x0F
+
+                if n >= 0 and n <= 7:
+                    chunk_name = "RST%d" % (n)
+                    chunk_size = 0
+                elif n == 0x8:
+                    chunk_name = "SOI"
+                    chunk_size = 0
+                    if len(chunks) != 0:
+                        raise Exception("")
+                elif n == 0x9:
+                    chunk_name = "EOI"
+                    chunk_size = 0
+                elif n == 0xA:
+                    chunk_name = "SOS"
+                elif n == 0xB:
+                    chunk_name = "DQT"
+                elif n == 0xD:
+                    chunk_name = "DRI"
+                    chunk_size = 2
                 else:
                     is_unk_chunk = True
+            elif chunk_m_h & 0xF0 == 0xC0:
+                n = chunk_m_h & 0x0F
+                if n == 0:
+                    chunk_name = "SOF0"
+                elif n == 2:
+                    chunk_name = "SOF2"
+                elif n == 4:
+                    chunk_name = "DHT"
+                else:
+                    is_unk_chunk = True
+            elif chunk_m_h & 0xF0 == 0xE0:
+                n = chunk_m_h & 0x0F
+                chunk_name = "APP%d" % (n)
+            else:
+                is_unk_chunk = True
 
-                #if is_unk_chunk:
-                #    #raise ValueError(f"Unknown chunk {chunk_m_h} in {filename}")
-                #    io.log_info(f"Unknown chunk {chunk_m_h} in {filename}")
-
-                if chunk_size == None: #variable size
-                    chunk_size, = struct.unpack (">H", data[data_counter:data_counter+2])
-                    chunk_size -= 2
-                    data_counter += 2
+            #if is_unk_chunk:
+            #    #raise ValueError(f"Unknown chunk {chunk_m_h} in {filename}")
+            #    io.log_info(f"Unknown chunk {chunk_m_h} in {filename}")
 
-                if chunk_size > 0:
-                    chunk_data = data[data_counter:data_counter+chunk_size]
-                    data_counter += chunk_size
+            if chunk_size == None: #variable size
+                chunk_size, = struct.unpack (">H", data[data_counter:data_counter+2])
+                chunk_size -= 2
+                data_counter += 2
 
-                if chunk_name == "SOS":
-                    c = data_counter
-                    while c < inst_length and (data[c] != 0xFF or data[c+1] != 0xD9):
-                        c += 1
+            if is_prefix and data_counter+chunk_size > data_len:
+                return None
+
+            if chunk_size > 0:
+                chunk_data = data[data_counter:data_counter+chunk_size]
+                chunk_offset = data_counter
+                data_counter += chunk_size
+
+            if chunk_name == "SOS":
+                if header_only:
+                    chunks.append ({'name' : chunk_name,
+                                    'm_h' : chunk_m_h,
+                                    'data' : chunk_data,
+                                    'offset' : chunk_offset,
+                                    'ex_data' : None,
+                                    })
+                    break
 
-                    chunk_ex_data = data[data_counter:c]
-                    data_counter = c
+                # 0xFF inside the scan is always stuffed, so the first FFD9 is the EOI marker
+                c = data.find(b"\xFF\xD9", data_counter)
+                if c == -1:
+                    c = data_len
 
-                chunks.append ({'name' : chunk_name,
-                                'm_h' : chunk_m_h,
-                                'data' : chunk_data,
-                                'ex_data' : chunk_ex_data,
-                                })
-            inst.chunks = chunks
+                chunk_ex_data = data_mv[data_counter:c]
+                data_counter = c
 
-            return inst
-        except Exception as e:
-            raise Exception (f"Corrupted JPG file {filename} {e}")
+            chunks.append ({'name' : chunk_name,
+                            'm_h' : chunk_m_h,
+                            'data' : chunk_data,
+                            'offset' : chunk_offset,
+                            'ex_data' : chunk_ex_data,
+                            })
+        return chunks
 
     @staticmethod
-    def load(filename, loader_func=None):
+    def load(filename, loader_func=None, header_only=False):
+        """
+        header_only     metadata-only load: dfl_dict and shape without reading the pixel payload.
+                        save() rereads the full file.
+        """
         try:
-            inst = DFLJPG.load_raw (filename, loader_func=loader_func)
+            inst = DFLJPG.load_raw (filename, loader_func=loader_func, header_only=header_only)
             inst.dfl_dict = {}
 
             for chunk in inst.chunks:
@@ -147,26 +210,77 @@ class DFLJPG(object):
 
                 elif chunk['name'] == 'APP15':
                     if type(chunk['data']) == bytes:
-                        inst.dfl_dict = pickle.loads(chunk['data'])
+                        inst.dfl_dict = DFLMeta.loads(chunk['data'])
 
             return inst
         except Exception as e:
             io.log_err (f'Exception occured while DFLJPG.load : {traceback.format_exc()}')
             return None
 
+    def has_pickled_dict(self):
+        """
+        returns True if the metadata is stored in the old pickled format
+        """
+        for chunk in self.chunks:
+            if chunk['name'] == 'APP15':
+                return type(chunk['data']) == bytes and DFLMeta.is_pickled(chunk['data'])
+        return False
+
     def has_data(self):
         return len(self.dfl_dict.keys()) != 0
 
     def save(self):
         try:
-            with open(self.filename, "wb") as f:
-                f.write ( self.dump() )
+            if not self.save_inplace():
+                # header-only instances reread the file in dump_buffers(), so it must be called before truncating
+                buffers = self.dump_buffers()
+                with open(self.filename, "wb") as f:
+                    f.writelines ( buffers )
         except:
             raise Exception( f'cannot save {self.filename}' )
 
-    def dump(self):
-        data = b""
+    def save_inplace(self):
+        """
+        overwrites only the APP15 payload of the file on disk.
+
+        returns False if the file was not loaded from disk, has changed since,
+        or the new metadata does not fit into the existing APP15 chunk
+        or is much smaller than it, so the file is rewritten without the padding
+        """
+        if self.file_stat is None:
+            return False
+
+        app15_chunk = None
+        for chunk in self.chunks:
+            if chunk['name'] == 'APP15':
+                app15_chunk = chunk
+                break
+
+        if app15_chunk is None or app15_chunk.get('offset', None) is None:
+            return False
 
+        chunk_data = self.dump_dict_data()
+        chunk_size = len(app15_chunk['data'])
+        if len(chunk_data) > chunk_size or len(chunk_data) < chunk_size // 2:
+            return False
+
+        st = os.stat(self.filename)
+        if (st.st_size, st.st_mtime_ns) != self.file_stat:
+            return False
+
+        # trailing bytes are ignored by DFLMeta.loads and the unpickler
+        chunk_data += bytes(chunk_size - len(chunk_data))
+
+        with open(self.filename, "r+b") as f:
+            f.seek(app15_chunk['offset'])
+            f.write(chunk_data)
+
+        app15_chunk['data'] = chunk_data
+        st = os.stat(self.filename)
+        self.file_stat = (st.st_size, st.st_mtime_ns)
+        return True
+
+    def dump_dict_data(self):
         dict_data = self.dfl_dict
 
         # Remove None keys
@@ -174,6 +288,21 @@ class DFLJPG(object):
             if dict_data[key] is None:
                 dict_data.pop(key)
 
+        return DFLMeta.dumps(dict_data)
+
+    def dump(self):
+        return b"".join( self.dump_buffers() )
+
+    def dump_buffers(self):
+        """
+        returns list of buffers of the file,
+        chunk payloads are not copied
+        """
+        if self.header_only:
+            # chunks after SOS were not loaded
+            self.chunks = DFLJPG.load_raw(self.filename).chunks
+            self.header_only = False
+
         for chunk in self.chunks:
             if chunk['name'] == 'APP15':
                 self.chunks.remove(chunk)
@@ -186,24 +315,29 @@ class DFLJPG(object):
 
         dflchunk = {'name' : 'APP15',
                     'm_h' : 0xEF,
-                    'data' : pickle.dumps(dict_data),
+                    'data' : self.dump_dict_data(),
+                    'offset' : None,
                     'ex_data' : None,
                     }
         self.chunks.insert (last_app_chunk+1, dflchunk)
 
-
+        buffers = []
         for chunk in self.chunks:
-            data += struct.pack ("BB", 0xFF, chunk['m_h'] )
             chunk_data = chunk['data']
             if chunk_data is not None:
-                data += struct.pack (">H", len(chunk_data)+2 )
-                data += chunk_data
+                buffers.append ( struct.pack (">BBH", 0xFF, chunk['m_h'], len(chunk_data)+2 ) )
+                buffers.append ( chunk_data )
+            else:
+                buffers.append ( struct.pack ("BB", 0xFF, chunk['m_h'] ) )
 
             chunk_ex_data = chunk['ex_data']
             if chunk_ex_data is not None:
-                data += chunk_ex_data
+                buffers.append ( chunk_ex_data )
+
+        # file is rewritten, offsets are no longer valid for in-place saves
+        self.file_stat = None
 
-        return data
+        return buffers
 
     def get_img(self):
         if self.img is None:
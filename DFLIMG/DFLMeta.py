@@ -0,0 +1,156 @@
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+
+class DFLMeta(object):
+    """
+    Binary encoding of the DFL metadata dict stored in the APP15 chunk.
+
+    header   magic, version, field count
+    field    key, tagged value
+
+    numpy arrays are stored as raw typed data, dict and list values are zlib compressed.
+    Trailing bytes after the last field are ignored.
+
+    Chunks without the magic are the old pickled format and are still readable.
+    """
+    MAGIC = b'DFLM'
+    VERSION = 1
+
+    # fields stored as typed arrays even if they were set as python lists,
+    # other fields are loaded with the type they were set with
+    array_fields = { 'landmarks'         : np.float32,
+                     'source_landmarks'  : np.float64,
+                     'image_to_face_mat' : np.float64,
+                   }
+
+    @staticmethod
+    def is_pickled(data):
+        return data[0:len(DFLMeta.MAGIC)] != DFLMeta.MAGIC
+
+    @staticmethod
+    def dumps(dfl_dict):
+        buffers = [ struct.pack("<4sBH", DFLMeta.MAGIC, DFLMeta.VERSION, len(dfl_dict)) ]
+        for key, value in dfl_dict.items():
+            if key in DFLMeta.array_fields and value is not None and not isinstance(value, np.ndarray):
+                value = np.array(value, DFLMeta.array_fields[key])
+
+            DFLMeta._dump_value(buffers, key)
+            if isinstance(value, (dict, list, tuple)):
+                value_buffers = []
+                DFLMeta._dump_value(value_buffers, value)
+                value_data = zlib.compress( b"".join(value_buffers) )
+                buffers += [ b'z', struct.pack("<I", len(value_data)), value_data ]
+            else:
+                DFLMeta._dump_value(buffers, value)
+        return b"".join(buffers)
+
+    @staticmethod
+    def loads(data):
+        if DFLMeta.is_pickled(data):
+            return pickle.loads(data)
+
+        mv = memoryview(data)
+        _, version, fields_count = struct.unpack_from("<4sBH", mv, 0)
+        if version != DFLMeta.VERSION:
+            raise NotImplementedError(f"Unsupported DFL metadata version {version}")
+
+        c = struct.calcsize("<4sBH")
+        dfl_dict = {}
+        for _ in range(fields_count):
+            c, key = DFLMeta._load_value(mv, c)
+            c, value = DFLMeta._load_value(mv, c)
+            dfl_dict[key] = value
+        return dfl_dict
+
+    @staticmethod
+    def _dump_value(buffers, value):
+        if value is None:
+            buffers.append(b'N')
+        elif value is True:
+            buffers.append(b'T')
+        elif value is False:
+            buffers.append(b'F')
+        elif isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            dtype = value.dtype.str.encode()
+            buffers += [ b'a', struct.pack(f"<B{len(dtype)}sB{value.ndim}I", len(dtype), dtype, value.ndim, *value.shape), value.tobytes() ]
+        elif isinstance(value, np.generic):
+            DFLMeta._dump_value(buffers, value.item())
+        elif isinstance(value, int):
+            buffers += [ b'i', struct.pack("<q", value) ]
+        elif isinstance(value, float):
+            buffers += [ b'f', struct.pack("<d", value) ]
+        elif isinstance(value, str):
+            value = value.encode('utf-8')
+            buffers += [ b's', struct.pack("<I", len(value)), value ]
+        elif isinstance(value, (bytes, bytearray)):
+            buffers += [ b'b', struct.pack("<I", len(value)), bytes(value) ]
+        elif isinstance(value, (list, tuple)):
+            buffers += [ b'l' if isinstance(value, list) else b'u', struct.pack("<I", len(value)) ]
+            for x in value:
+                DFLMeta._dump_value(buffers, x)
+        elif isinstance(value, dict):
+            buffers += [ b'd', struct.pack("<I", len(value)) ]
+            for k, v in value.items():
+                DFLMeta._dump_value(buffers, k)
+                DFLMeta._dump_value(buffers, v)
+        else:
+            raise ValueError(f"DFLMeta: unsupported value type {type(value)}")
+
+    @staticmethod
+    def _load_value(mv, c):
+        """
+        returns offset after the value, value
+        """
+        tag = bytes(mv[c:c+1])
+        c += 1
+        if tag == b'N':
+            return c, None
+        elif tag == b'T':
+            return c, True
+        elif tag == b'F':
+            return c, False
+        elif tag == b'a':
+            dtype_len, = struct.unpack_from("<B", mv, c)
+            dtype = np.dtype( bytes(mv[c+1:c+1+dtype_len]).decode() )
+            c += 1 + dtype_len
+            ndim, = struct.unpack_from("<B", mv, c)
+            shape = struct.unpack_from(f"<{ndim}I", mv, c+1)
+            c += 1 + 4*ndim
+            size = int(np.prod(shape)) * dtype.itemsize
+            value = np.frombuffer(mv[c:c+size], dtype).reshape(shape).copy()
+            return c+size, value
+        elif tag == b'i':
+            return c+8, struct.unpack_from("<q", mv, c)[0]
+        elif tag == b'f':
+            return c+8, struct.unpack_from("<d", mv, c)[0]
+        elif tag == b's' or tag == b'b':
+            size, = struct.unpack_from("<I", mv, c)
+            value = bytes(mv[c+4:c+4+size])
+            return c+4+size, value.decode('utf-8') if tag == b's' else value
+        elif tag == b'l' or tag == b'u':
+            count, = struct.unpack_from("<I", mv, c)
+            c += 4
+            value = []
+            for _ in range(count):
+                c, x = DFLMeta._load_value(mv, c)
+                value.append(x)
+            return c, value if tag == b'l' else tuple(value)
+        elif tag == b'd':
+            count, = struct.unpack_from("<I", mv, c)
+            c += 4
+            value = {}
+            for _ in range(count):
+                c, k = DFLMeta._load_value(mv, c)
+                c, v = DFLMeta._load_value(mv, c)
+                value[k] = v
+            return c, value
+        elif tag == b'z':
+            size, = struct.unpack_from("<I", mv, c)
+            _, value = DFLMeta._load_value( memoryview(zlib.decompress(mv[c+4:c+4+size])), 0 )
+            return c+4+size, value
+        raise ValueError(f"DFLMeta: unknown value tag {tag}")
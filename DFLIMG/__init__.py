@@ -1,2 +1,4 @@
 from .DFLIMG import DFLIMG
-from .DFLJPG import DFLJPG
\ No newline at end of file
+from .DFLJPG import DFLJPG
+from .DFLMeta import DFLMeta
+from .DFLIndex import DFLIndex
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Round-trip check of DFLMeta
+
+    python -m DFLIMG.dflmeta_check
+
+Metadata dict as written by the extractor, by the manual tools and by the pickled format
+is dumped and loaded, and type and dtype of every field are compared with the expected ones.
+"""
+import pickle
+
+import numpy as np
+
+from DFLIMG.DFLMeta import DFLMeta
+
+
+def get_dfl_dicts():
+    """
+    returns list of (name, dfl_dict, expected) where expected is { key : (type, dtype or None) }
+    """
+    landmarks = np.random.RandomState(0).uniform(0, 256, size=(68,2))
+    mat = np.array( [ [1.5, 0.1, -20.25], [-0.1, 1.5, 10.125] ] )
+    seg_ie_polys = {'polys' : [ {'type' : 1, 'pts' : [ [0.5,1.5], [2.5,3.5] ] } ] }
+
+    extractor_dict = { 'face_type'           : 'whole_face',
+                       'landmarks'           : landmarks.tolist(),
+                       'source_filename'     : '00001.png',
+                       'source_rect'         : np.array( [1, 2, 3, 4] ),
+                       'source_landmarks'    : landmarks.tolist(),
+                       'image_to_face_mat'   : mat,
+                       'eyebrows_expand_mod' : 1.0,
+                       'xseg_mask'           : b'\x89PNG',
+                       'seg_ie_polys'        : seg_ie_polys,
+                     }
+    extractor_expected = { 'face_type'           : (str, None),
+                           'landmarks'           : (np.ndarray, np.float32),
+                           'source_filename'     : (str, None),
+                           'source_rect'         : (np.ndarray, np.int64),
+                           'source_landmarks'    : (np.ndarray, np.float64),
+                           'image_to_face_mat'   : (np.ndarray, np.float64),
+                           'eyebrows_expand_mod' : (float, None),
+                           'xseg_mask'           : (bytes, None),
+                           'seg_ie_polys'        : (dict, None),
+                         }
+
+    tools_dict = { 'face_type'           : 'full_face',
+                   'landmarks'           : landmarks.astype(np.float32),
+                   'source_filename'     : None,
+                   'source_rect'         : (1, 2, 3, 4),
+                   'source_landmarks'    : None,
+                   'image_to_face_mat'   : mat.tolist(),
+                   'eyebrows_expand_mod' : 1,
+                 }
+    tools_expected = { 'face_type'           : (str, None),
+                       'landmarks'           : (np.ndarray, np.float32),
+                       'source_filename'     : (type(None), None),
+                       'source_rect'         : (tuple, None),
+                       'source_landmarks'    : (type(None), None),
+                       'image_to_face_mat'   : (np.ndarray, np.float64),
+                       'eyebrows_expand_mod' : (int, None),
+                     }
+
+    pickled_dict = { 'landmarks'   : landmarks.tolist(),
+                     'source_rect' : [1, 2, 3, 4],
+                   }
+    pickled_expected = { 'landmarks'   : (list, None),
+                         'source_rect' : (list, None),
+                       }
+
+    return [ ('extractor', extractor_dict, extractor_expected, DFLMeta.dumps),
+             ('tools', tools_dict, tools_expected, DFLMeta.dumps),
+             ('pickled', pickled_dict, pickled_expected, pickle.dumps),
+           ]
+
+def check(name, dfl_dict, expected, dumps_func):
+    """
+    returns list of error strings
+    """
+    errors = []
+    loaded = DFLMeta.loads( dumps_func(dfl_dict) )
+    if set(loaded.keys()) != set(expected.keys()):
+        errors.append ( f"{name}: keys {sorted(loaded.keys())}" )
+
+    for key, (value_type, dtype) in expected.items():
+        value = loaded.get(key, None)
+        if type(value) != value_type:
+            errors.append ( f"{name}.{key}: type {type(value)}, expected {value_type}" )
+            continue
+
+        if dtype is not None and value.dtype != dtype:
+            errors.append ( f"{name}.{key}: dtype {value.dtype}, expected {np.dtype(dtype)}" )
+
+        src_value = dfl_dict[key]
+        if isinstance(value, np.ndarray):
+            is_equal = np.array_equal(value, np.array(src_value, value.dtype))
+        else:
+            is_equal = value == src_value
+        if not is_equal:
+            errors.append ( f"{name}.{key}: value differs" )
+    return errors
+
+if __name__ == "__main__":
+    errors = []
+    for name, dfl_dict, expected, dumps_func in get_dfl_dicts():
+        errors += check(name, dfl_dict, expected, dumps_func)
+
+    for error in errors:
+        print(f"FAILED {error}")
+    print("OK" if len(errors) == 0 else "FAILED")
+    if len(errors) != 0:
+        exit(1)
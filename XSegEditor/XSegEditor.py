@@ -1103,19 +1103,29 @@ class LoaderQSubprocessor(QSubprocessor):
 
         self.image_paths = image_paths
         self.image_paths_len = len(image_paths)
-        self.idxs = [*range(self.image_paths_len)]
+        self.idxs = []
 
         self.filtered_image_paths = self.image_paths.copy()
 
         self.image_paths_has_ie_polys = { image_path : False for image_path in self.image_paths }
 
+        # unchanged files are resolved from the DFLIndex without loading them
+        self.done_count = 0
+        index = DFLIndex.load(image_paths[0].parent, update=False) if self.image_paths_len != 0 else None
+        for i, image_path in enumerate(self.image_paths):
+            index_idx = index.get_idx(image_path, check_stat=True)
+            if index_idx is not None:
+                self.image_paths_has_ie_polys[image_path] = bool(index.get(index_idx, 'has_seg_ie_polys'))
+                self.done_count += 1
+            else:
+                self.idxs.append(i)
+
         self.q_label = q_label
         self.q_progressbar = q_progressbar
         self.q_progressbar.setRange(0, self.image_paths_len)
-        self.q_progressbar.setValue(0)
+        self.q_progressbar.setValue(self.done_count)
         self.q_progressbar.update()
         self.on_finish_func = on_finish_func
-        self.done_count = 0
         super().__init__('LoaderQSubprocessor', LoaderQSubprocessor.Cli, 60)
 
     def get_data(self, host_dict):
@@ -1148,7 +1158,7 @@ class LoaderQSubprocessor(QSubprocessor):
     class Cli(QSubprocessor.Cli):
         def process_data(self, data):
             idx, filename = data
-            dflimg = DFLIMG.load(filename)
+            dflimg = DFLIMG.load(filename, header_only=True)
             if dflimg is not None and dflimg.has_data():
                 ie_polys = dflimg.get_seg_ie_polys()
 
@@ -11,11 +11,11 @@ def cv2_imread(filename, flags=cv2.IMREAD_UNCHANGED, loader_func=None, verbose=T
     """
     try:
         if loader_func is not None:
-            bytes = bytearray(loader_func(filename))
+            bytes = loader_func(filename)
         else:
             with open(filename, "rb") as stream:
-                bytes = bytearray(stream.read())
-        numpyarray = np.asarray(bytes, dtype=np.uint8)
+                bytes = stream.read()
+        numpyarray = np.frombuffer(bytes, dtype=np.uint8)
         return cv2.imdecode(numpyarray, flags)
     except:
         if verbose:
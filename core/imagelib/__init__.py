@@ -8,7 +8,7 @@ from .draw import draw_polygon, draw_rect
 
 from .morph import morph_by_points
 
-from .warp import gen_warp_params, warp_by_params
+from .warp import gen_warp_params, warp_by_params, warp_by_params_fused, get_resize_mat, WarpFieldPool
 
 from .reduce_colors import reduce_colors
 
@@ -1,8 +1,100 @@
+import multiprocessing
+
 import numpy as np
 import cv2
 from core import randomex
 
-def gen_warp_params (w, flip=False, rotation_range=[-2,2], scale_range=[-0.5, 0.5], tx_range=[-0.05, 0.05], ty_range=[-0.05, 0.05], rnd_state=None  ):
+# per resolution: x, y float32 coordinates of pixels
+_pixel_grids = {}
+
+def get_pixel_grid(w):
+    grid = _pixel_grids.get(w, None)
+    if grid is None:
+        grid = _pixel_grids[w] = np.meshgrid( np.arange(w, dtype=np.float32), np.arange(w, dtype=np.float32) )
+    return grid
+
+def gen_warp_field(w, rnd_state):
+    """
+    returns dx displacement of random warp by grid of gen_warp_params, dy is dx.T
+
+    In gen_warp_params mapy is view of mapx.T,
+    so noise of both is added to the same grid.
+    """
+    cell_size = [ w // (2**i) for i in range(1,4) ] [ rnd_state.randint(3) ]
+    cell_count = w // cell_size + 1
+
+    # truncated normal as randomex.random_normal
+    noise = rnd_state.normal( size=(2, cell_count-2, cell_count-2) )
+    while True:
+        out_of_range = np.abs(noise) > 2.5
+        if not out_of_range.any():
+            break
+        noise[out_of_range] = rnd_state.normal( size=(out_of_range.sum(),) )
+    noise /= 2.5
+
+    half_cell_size = cell_size // 2
+
+    d = np.zeros( (cell_count, cell_count), np.float64 )
+    d[1:-1,1:-1] = (noise[0] + noise[1].T)*(cell_size*0.24)
+    return cv2.resize(d, (w+cell_size,)*2 )[half_cell_size:-half_cell_size,half_cell_size:-half_cell_size].astype(np.float32)
+
+class WarpFieldPool():
+    """
+    Pool of random warp fields of resolution w in shared memory, generated once,
+    so gen_warp_params draws a field from the pool instead of generating it.
+
+    A field is drawn with one of 8 variants of negation, rotation by 180 and transposition of the grid noise,
+    which do not change the distribution of the random grid.
+
+    The pool has at least min_count fields whatever max_bytes is,
+    because warps of a small pool repeat and reduce the diversity of augmentation.
+    """
+    min_count = 256
+    max_count = 1024
+
+    def __init__(self, w, count=None, max_bytes=256*1024*1024, rnd_seed=None):
+        # as gen_warp_params
+        w = max(w, 64)
+        if count is None:
+            count = int(np.clip( max_bytes // (w*w*4), WarpFieldPool.min_count, WarpFieldPool.max_count))
+
+        self.w = w
+        self.count = count
+        self.buffer = multiprocessing.RawArray('f', count*w*w)
+        self.fields = None
+
+        rnd_state = np.random.RandomState(rnd_seed)
+        fields = self.get_fields()
+        for i in range(count):
+            fields[i] = gen_warp_field(w, rnd_state)
+
+    def __getstate__(self):
+        return {'w':self.w, 'count':self.count, 'buffer':self.buffer, 'fields':None}
+
+    def get_fields(self):
+        if self.fields is None:
+            self.fields = np.frombuffer(self.buffer, np.float32).reshape( (self.count, self.w, self.w) )
+        return self.fields
+
+    def get_field(self, rnd_state):
+        """
+        returns dx, dy
+        """
+        dx = self.get_fields()[ rnd_state.randint(self.count) ]
+        variant = rnd_state.randint(8)
+        if variant & 1:
+            dx = -dx
+        if variant & 2:
+            dx = -dx[::-1,::-1]
+        dy = dx.T
+        if variant & 4:
+            dx, dy = dy, dx
+        return dx, dy
+
+def gen_warp_params (w, flip=False, rotation_range=[-2,2], scale_range=[-0.5, 0.5], tx_range=[-0.05, 0.05], ty_range=[-0.05, 0.05], rnd_state=None, warp_field_pool=None ):
+    """
+    warp_field_pool     optional WarpFieldPool of resolution w
+    """
     if rnd_state is None:
         rnd_state = np.random
 
@@ -18,20 +110,27 @@ def gen_warp_params (w, flip=False, rotation_range=[-2,2], scale_range=[-0.5, 0.
     p_flip = flip and rnd_state.randint(10) < 4
 
     #random warp by grid
-    cell_size = [ w // (2**i) for i in range(1,4) ] [ rnd_state.randint(3) ]
-    cell_count = w // cell_size + 1
+    if warp_field_pool is not None and warp_field_pool.w == w:
+        dx, dy = warp_field_pool.get_field(rnd_state)
+        # resized grid of gen_warp_field is shifted by half of pixel
+        grid_x, grid_y = get_pixel_grid(w)
+        mapx = grid_x + (dx + 0.5)
+        mapy = grid_y + (dy + 0.5)
+    else:
+        cell_size = [ w // (2**i) for i in range(1,4) ] [ rnd_state.randint(3) ]
+        cell_count = w // cell_size + 1
 
-    grid_points = np.linspace( 0, w, cell_count)
-    mapx = np.broadcast_to(grid_points, (cell_count, cell_count)).copy()
-    mapy = mapx.T
+        grid_points = np.linspace( 0, w, cell_count)
+        mapx = np.broadcast_to(grid_points, (cell_count, cell_count)).copy()
+        mapy = mapx.T
 
-    mapx[1:-1,1:-1] = mapx[1:-1,1:-1] + randomex.random_normal( size=(cell_count-2, cell_count-2) )*(cell_size*0.24)
-    mapy[1:-1,1:-1] = mapy[1:-1,1:-1] + randomex.random_normal( size=(cell_count-2, cell_count-2) )*(cell_size*0.24)
+        mapx[1:-1,1:-1] = mapx[1:-1,1:-1] + randomex.random_normal( size=(cell_count-2, cell_count-2) )*(cell_size*0.24)
+        mapy[1:-1,1:-1] = mapy[1:-1,1:-1] + randomex.random_normal( size=(cell_count-2, cell_count-2) )*(cell_size*0.24)
 
-    half_cell_size = cell_size // 2
+        half_cell_size = cell_size // 2
 
-    mapx = cv2.resize(mapx, (w+cell_size,)*2 )[half_cell_size:-half_cell_size,half_cell_size:-half_cell_size].astype(np.float32)
-    mapy = cv2.resize(mapy, (w+cell_size,)*2 )[half_cell_size:-half_cell_size,half_cell_size:-half_cell_size].astype(np.float32)
+        mapx = cv2.resize(mapx, (w+cell_size,)*2 )[half_cell_size:-half_cell_size,half_cell_size:-half_cell_size].astype(np.float32)
+        mapy = cv2.resize(mapy, (w+cell_size,)*2 )[half_cell_size:-half_cell_size,half_cell_size:-half_cell_size].astype(np.float32)
 
     #random transform
     random_transform_mat = cv2.getRotationMatrix2D((int(w / 2), int(w / 2)), rotation, scale)
@@ -50,6 +149,43 @@ def gen_warp_params (w, flip=False, rotation_range=[-2,2], scale_range=[-0.5, 0.
 
     return params
 
+def get_resize_mat(src_w, dst_w):
+    """
+    returns affine matrix of cv2.resize from src_w to dst_w
+    """
+    s = dst_w / src_w
+    return np.array([ [s, 0, 0.5*s-0.5], [0, s, 0.5*s-0.5] ], np.float32)
+
+def get_warp_maps(params, can_warp, can_transform):
+    """
+    returns float32 maps of cv2.remap doing random warp and/or random transform of params at once,
+    computed once per params
+    """
+    key = ('warp_maps', can_warp, can_transform)
+    maps = params.get(key, None)
+    if maps is None:
+        w = params['w']
+        rmat = params['rmat']
+        grid_x, grid_y = get_pixel_grid(w)
+        imat = cv2.invertAffineTransform(rmat)
+
+        if can_warp and can_transform:
+            # displacement of warp at pixels of transformed image
+            dx = cv2.warpAffine( params['mapx']-grid_x, rmat, (w,w), borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_LINEAR )
+            dy = cv2.warpAffine( params['mapy']-grid_y, rmat, (w,w), borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_LINEAR )
+            mapx = imat[0,0]*grid_x + imat[0,1]*grid_y + imat[0,2] + dx
+            mapy = imat[1,0]*grid_x + imat[1,1]*grid_y + imat[1,2] + dy
+        elif can_warp:
+            mapx, mapy = params['mapx'], params['mapy']
+        elif can_transform:
+            mapx = imat[0,0]*grid_x + imat[0,1]*grid_y + imat[0,2]
+            mapy = imat[1,0]*grid_x + imat[1,1]*grid_y + imat[1,2]
+        else:
+            mapx, mapy = grid_x, grid_y
+
+        maps = params[key] = (mapx.astype(np.float32), mapy.astype(np.float32))
+    return maps
+
 def warp_by_params (params, img, can_warp, can_transform, can_flip, border_replicate, cv2_inter=cv2.INTER_CUBIC):
     rw = params['rw']
     
@@ -70,3 +206,27 @@ def warp_by_params (params, img, can_warp, can_transform, can_flip, border_repli
     if can_flip and params['flip']:
         img = img[:,::-1,...]
     return img
+
+def warp_by_params_fused (params, img, mat, can_warp, can_transform, can_flip, border_replicate, cv2_inter=cv2.INTER_CUBIC):
+    """
+    same as warp_by_params of cv2.warpAffine(img, mat, (w,w)),
+    but samples img once by one combined map, instead of interpolation per step.
+
+    mat     affine matrix from img to the resolution of params, see get_resize_mat
+    """
+    if params['rw'] is not None:
+        raise ValueError('warp_by_params_fused: resolution of params should be >= 64')
+
+    mapx, mapy = get_warp_maps(params, can_warp, can_transform)
+
+    imat = cv2.invertAffineTransform(mat)
+    src_mapx = imat[0,0]*mapx + imat[0,1]*mapy + imat[0,2]
+    src_mapy = imat[1,0]*mapx + imat[1,1]*mapy + imat[1,2]
+
+    img = cv2.remap(img, src_mapx.astype(np.float32), src_mapy.astype(np.float32), cv2_inter, borderMode=(cv2.BORDER_REPLICATE if border_replicate else cv2.BORDER_CONSTANT) )
+
+    if len(img.shape) == 2:
+        img = img[...,None]
+    if can_flip and params['flip']:
+        img = img[:,::-1,...]
+    return img
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+
+class JobJournal(object):
+    """
+    Append-only journal of completed items of a job,
+    so the job restarted after crash skips them.
+
+    File is JSON lines: header with hash of config of the job,
+    then {'key' : str, 'outputs' : [str, ...]} per completed item.
+    Journal written with other config is discarded on open,
+    incomplete last line written at crash is dropped.
+
+    Every item is written to OS at once, fsync is batched to one per fsync_interval seconds,
+    so the crash of machine loses at most fsync_interval seconds of completed items.
+
+    check_outputs   default of is_done, False for jobs where the user may delete outputs
+                    which should not be made again
+    """
+
+    def __init__(self, path, config=None, fsync_interval=10.0, check_outputs=True):
+        self.path = Path(path)
+        self.config_hash = JobJournal.get_config_hash(config)
+        self.fsync_interval = fsync_interval
+        self.check_outputs = check_outputs
+        self.items = {}
+        self.f = None
+        self.fsync_time = time.time()
+        self.is_resumed = False
+        self.open()
+
+    @staticmethod
+    def get_config_hash(config):
+        return hashlib.sha1( json.dumps(config, sort_keys=True, default=str).encode('utf-8') ).hexdigest()
+
+    @staticmethod
+    def exists(path):
+        return Path(path).exists()
+
+    def open(self):
+        is_valid = False
+        if self.path.exists():
+            lines = self.path.read_bytes().split(b'\n')
+            try:
+                header = json.loads(lines[0])
+                is_valid = header.get('config_hash', None) == self.config_hash
+            except:
+                pass
+
+            if is_valid:
+                # last line is empty if the file was not cut
+                is_valid = lines[-1] == b''
+                for line in lines[1:-1]:
+                    try:
+                        item = json.loads(line)
+                        self.items[item['key']] = item['outputs']
+                    except:
+                        is_valid = False
+                        break
+                self.is_resumed = len(self.items) != 0
+
+        if not is_valid:
+            # new journal, or rewrite without broken tail
+            tmp_path = self.path.parent / (self.path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write( json.dumps( {'config_hash' : self.config_hash} ) + '\n' )
+                for key, outputs in self.items.items():
+                    f.write( json.dumps( {'key' : key, 'outputs' : outputs} ) + '\n' )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+        self.f = open(self.path, 'a')
+
+    def __len__(self):
+        return len(self.items)
+
+    def is_done(self, key, check_outputs=None):
+        """
+        returns True if item is completed,
+        and all its outputs exist if check_outputs, by default self.check_outputs
+        """
+        outputs = self.items.get(key, None)
+        if outputs is None:
+            return False
+        if check_outputs is None:
+            check_outputs = self.check_outputs
+        if check_outputs:
+            return all ( Path(output).exists() for output in outputs )
+        return True
+
+    def get_outputs(self, key):
+        return self.items.get(key, None)
+
+    def add(self, key, outputs=None):
+        outputs = [ str(output) for output in outputs ] if outputs is not None else []
+        self.items[key] = outputs
+        self.f.write( json.dumps( {'key' : key, 'outputs' : outputs} ) + '\n' )
+        self.f.flush()
+
+        if time.time() - self.fsync_time >= self.fsync_interval:
+            self.fsync()
+
+    def fsync(self):
+        if self.f is not None:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.fsync_time = time.time()
+
+    def close(self):
+        if self.f is not None:
+            self.fsync()
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        """
+        closes and deletes the journal, when the job is completed
+        """
+        self.close()
+        if self.path.exists():
+            self.path.unlink()
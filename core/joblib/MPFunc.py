@@ -1,4 +1,5 @@
 import multiprocessing
+import time
 from core.interact import interact as io
 
 class MPFunc():
@@ -8,6 +9,8 @@ class MPFunc():
         self.s2c = multiprocessing.Queue()
         self.c2s = multiprocessing.Queue()
         self.lock = multiprocessing.Lock()
+        # seconds spent in calls of this process, includes waiting for other callers
+        self.call_time = 0.0
         
         io.add_process_messages_callback(self.io_callback)
 
@@ -17,9 +20,12 @@ class MPFunc():
             self.s2c.put ( self.func (*func_args, **func_kwargs) )
 
     def __call__(self, *args, **kwargs):
+        t = time.perf_counter()
         with self.lock:
             self.c2s.put ( (args, kwargs) )
-            return self.s2c.get()
+            result = self.s2c.get()
+        self.call_time += time.perf_counter()-t
+        return result
 
     def __getstate__(self):
-        return {'s2c':self.s2c, 'c2s':self.c2s, 'lock':self.lock}
+        return {'s2c':self.s2c, 'c2s':self.c2s, 'lock':self.lock, 'call_time':0.0}
@@ -1,15 +1,41 @@
 import multiprocessing
 import queue as Queue
+import sys
 import threading
 import time
+import weakref
+
+import numpy as np
+
+from .SubprocessorBase import Subprocessor
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
 
 
 class SubprocessGenerator(object):
-    
+    """
+    shared_memory   transfer batches which are list of np.ndarray
+                    through ring of shared memory slabs instead of pickling them to the queue.
+
+                    Slabs are sized from the first batch and owned by the consumer.
+                    Batch is returned as views of the slab, the slab is given back to the generator
+                    when no view of it is referenced anymore,
+                    new slab is added if the consumer holds too many of them.
+
+    backend         'process' - generator_func runs in subprocess with a copy of user_param
+                    'thread'  - generator_func runs in a thread with user_param itself,
+                                batches are passed by reference, shared_memory is not used.
+
+    cv2_num_threads optional, cap of OpenCV thread pool set in the generator,
+                    with 'thread' backend it is set for the whole process.
+    """
     @staticmethod
-    def launch_thread(generator): 
+    def launch_thread(generator):
         generator._start()
-        
+
     @staticmethod
     def start_in_parallel( generator_list ):
         """
@@ -22,32 +48,77 @@ class SubprocessGenerator(object):
 
         while not all ([generator._is_started() for generator in generator_list]):
             time.sleep(0.005)
-    
-    def __init__(self, generator_func, user_param=None, prefetch=2, start_now=True):
+
+    def __init__(self, generator_func, user_param=None, prefetch=2, start_now=True, shared_memory=False, backend='process', cv2_num_threads=None):
         super().__init__()
+        if backend not in Subprocessor.backends:
+            raise ValueError(f"Unknown backend {backend}, must be one of {Subprocessor.backends}")
+
         self.prefetch = prefetch
         self.generator_func = generator_func
         self.user_param = user_param
-        self.sc_queue = multiprocessing.Queue()
-        self.cs_queue = multiprocessing.Queue()
+        self.backend = backend
+        self.cv2_num_threads = cv2_num_threads
+        self.shared_memory = shared_memory and backend == 'process' and SubprocessGenerator.is_shared_memory_supported()
+        if backend == 'thread':
+            self.sc_queue = Queue.Queue()
+            self.cs_queue = Queue.Queue()
+        else:
+            self.sc_queue = multiprocessing.Queue()
+            self.cs_queue = multiprocessing.Queue()
         self.p = None
+
+        # consumer side slabs
+        self.slabs = []
+        self.held_slabs = {}
+        weakref.finalize(self, SubprocessGenerator.unlink_slabs, self.slabs)
+
         if start_now:
             self._start()
 
+    @staticmethod
+    def is_shared_memory_supported():
+        return shared_memory is not None
+
     def _start(self):
         if self.p == None:
+            if self.shared_memory:
+                # subprocess has to share the tracker of slabs, orelse its tracker unlinks them on exit
+                resource_tracker.ensure_running()
+
             user_param = self.user_param
             self.user_param = None
-            p = multiprocessing.Process(target=self.process_func, args=(user_param,) )
+            if self.backend == 'thread':
+                p = threading.Thread(target=self.process_func, args=(user_param,) )
+            else:
+                p = multiprocessing.Process(target=self.process_func, args=(user_param,) )
             p.daemon = True
             p.start()
             self.p = p
-            
+
     def _is_started(self):
         return self.p is not None
-        
+
     def process_func(self, user_param):
+        if self.cv2_num_threads is not None:
+            Subprocessor.set_cv2_num_threads(self.cv2_num_threads)
+
         self.generator_func = self.generator_func(user_param)
+
+        # generator side slabs
+        slabs = {}
+        free_slab_ids = []
+
+        def process_sc_msg(msg):
+            if msg == 1:
+                self.prefetch += 1
+            else:
+                _, slab_id, name = msg
+                if slab_id not in slabs:
+                    slabs[slab_id] = shared_memory.SharedMemory(name=name)
+                free_slab_ids.append(slab_id)
+
+        is_first = True
         while True:
             while self.prefetch > -1:
                 try:
@@ -55,10 +126,46 @@ class SubprocessGenerator(object):
                 except StopIteration:
                     self.cs_queue.put (None)
                     return
-                self.cs_queue.put (gen_data)
+
+                if self.shared_memory and not is_first and SubprocessGenerator.is_shm_batch(gen_data):
+                    layout, nbytes = SubprocessGenerator.get_layout(gen_data)
+
+                    while len(free_slab_ids) == 0:
+                        process_sc_msg(self.sc_queue.get())
+
+                    slab_id = free_slab_ids.pop(0)
+                    slab = slabs[slab_id]
+                    if nbytes <= slab.size:
+                        for ar, (offset, dtype, shape) in zip(gen_data, layout):
+                            np.ndarray(shape, dtype, buffer=slab.buf, offset=offset)[...] = ar
+                        self.cs_queue.put ( ('shm', slab_id, layout) )
+                    else:
+                        # batch is bigger than the slab
+                        free_slab_ids.insert(0, slab_id)
+                        self.cs_queue.put (gen_data)
+                else:
+                    self.cs_queue.put (gen_data)
+
+                is_first = False
                 self.prefetch -= 1
-            self.sc_queue.get()
-            self.prefetch += 1
+            process_sc_msg(self.sc_queue.get())
+
+    @staticmethod
+    def is_shm_batch(gen_data):
+        return isinstance(gen_data, (list, tuple)) and len(gen_data) != 0 and \
+               all( isinstance(ar, np.ndarray) and ar.dtype != np.object_ for ar in gen_data )
+
+    @staticmethod
+    def get_layout(gen_data):
+        """
+        returns list of (offset, dtype, shape) of arrays in slab, size of slab
+        """
+        layout = []
+        nbytes = 0
+        for ar in gen_data:
+            layout.append ( (nbytes, ar.dtype.str, ar.shape) )
+            nbytes += (ar.nbytes + 63) // 64 * 64
+        return layout, nbytes
 
     def __iter__(self):
         return self
@@ -66,14 +173,71 @@ class SubprocessGenerator(object):
     def __getstate__(self):
         self_dict = self.__dict__.copy()
         del self_dict['p']
+        del self_dict['slabs']
+        del self_dict['held_slabs']
         return self_dict
 
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.slabs = []
+        self.held_slabs = {}
+
+    def _add_slab(self, nbytes):
+        slab = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self.slabs.append(slab)
+        self.sc_queue.put ( ('slab', len(self.slabs)-1, slab.name) )
+
+    def _release_slabs(self):
+        for slab_id in list(self.held_slabs.keys()):
+            # only self.held_slabs and getrefcount argument reference the owner,
+            # all views of the batch are deleted
+            if sys.getrefcount(self.held_slabs[slab_id]) <= 2:
+                del self.held_slabs[slab_id]
+                self.sc_queue.put ( ('slab', slab_id, self.slabs[slab_id].name) )
+
     def __next__(self):
         self._start()
         gen_data = self.cs_queue.get()
         if gen_data is None:
-            self.p.terminate()
+            if self.backend == 'process':
+                self.p.terminate()
             self.p.join()
+            self.close()
             raise StopIteration()
+
+        if self.shared_memory:
+            if len(self.slabs) == 0 and SubprocessGenerator.is_shm_batch(gen_data):
+                # first batch came through the queue, make the ring of its size
+                _, nbytes = SubprocessGenerator.get_layout(gen_data)
+                for _ in range(self.prefetch+2):
+                    self._add_slab(nbytes)
+
+            if isinstance(gen_data, tuple) and len(gen_data) == 3 and isinstance(gen_data[0], str) and gen_data[0] == 'shm':
+                _, slab_id, layout = gen_data
+                owner = np.frombuffer(self.slabs[slab_id].buf, np.uint8)
+                gen_data = [ owner[offset:offset+int(np.prod(shape))*np.dtype(dtype).itemsize].view(dtype).reshape(shape) for offset, dtype, shape in layout ]
+                self.held_slabs[slab_id] = owner
+                owner = None
+
+            self._release_slabs()
+
+            # the generator always needs prefetch+1 slabs not held by consumer
+            if len(self.slabs) != 0 and len(self.slabs) - len(self.held_slabs) < self.prefetch+1:
+                self._add_slab(self.slabs[0].size)
+
         self.sc_queue.put (1)
         return gen_data
+
+    def close(self):
+        """
+        unlinks shared memory slabs, views of them should not be used after
+        """
+        SubprocessGenerator.unlink_slabs(self.slabs)
+
+    @staticmethod
+    def unlink_slabs(slabs):
+        for slab in slabs:
+            try:
+                slab.unlink()
+            except:
+                pass
@@ -1,9 +1,17 @@
 import traceback
 import multiprocessing
+import queue
+import threading
 import time
 import sys
+
+import numpy as np
+
+from core import osex
 from core.interact import interact as io
 
+from .SubprocessorTelemetry import SubprocessorTelemetry
+
 
 class Subprocessor(object):
 
@@ -11,10 +19,16 @@ class Subprocessor(object):
         pass
 
     class Cli(object):
-        def __init__ ( self, client_dict ):
-            s2c = multiprocessing.Queue()
-            c2s = multiprocessing.Queue()
-            self.p = multiprocessing.Process(target=self._subprocess_run, args=(client_dict,s2c,c2s) )
+        def __init__ ( self, client_dict, backend='process', cv2_num_threads=None ):
+            if backend == 'thread':
+                s2c = queue.Queue()
+                c2s = queue.Queue()
+                self.p = threading.Thread(target=self._subprocess_run, args=(client_dict,s2c,c2s,cv2_num_threads) )
+            else:
+                s2c = multiprocessing.Queue()
+                c2s = multiprocessing.Queue()
+                self.p = multiprocessing.Process(target=self._subprocess_run, args=(client_dict,s2c,c2s,cv2_num_threads) )
+            self.backend = backend
             self.s2c = s2c
             self.c2s = c2s
             self.p.daemon = True
@@ -27,8 +41,12 @@ class Subprocessor(object):
             self.host_dict = None
 
         def kill(self):
-            self.p.terminate()
-            self.p.join()
+            if self.backend == 'thread':
+                # thread cannot be terminated, it exits on close when it is free, orelse it is abandoned as daemon
+                self.s2c.put ( {'op': 'close'} )
+            else:
+                self.p.terminate()
+                self.p.join()
 
         #overridable optional
         def on_initialize(self, client_dict):
@@ -50,15 +68,33 @@ class Subprocessor(object):
             #return string identificator of your 'data'
             return "undefined"
 
+        def add_section_time(self, section, t):
+            """
+            adds time in seconds spent in named part of process_data, reported in telemetry
+            """
+            self.section_times[section] = self.section_times.get(section, 0.0) + t
+
         def log_info(self, msg): self.c2s.put ( {'op': 'log_info', 'msg':msg } )
         def log_err(self, msg): self.c2s.put ( {'op': 'log_err' , 'msg':msg } )
         def progress_bar_inc(self, c): self.c2s.put ( {'op': 'progress_bar_inc' , 'c':c } )
 
-        def _subprocess_run(self, client_dict, s2c, c2s):
+        def journal_add(self, key, outputs):
+            """
+            records 'key' as done in journal of host, can be called from any thread of client.
+            For data which outputs are completed after process_data returned,
+            get_journal_outputs of host returns None for such data.
+            """
+            self.c2s.put ( {'op': 'journal_add', 'key' : key, 'outputs' : outputs } )
+
+        def _subprocess_run(self, client_dict, s2c, c2s, cv2_num_threads=None):
             self.c2s = c2s
+            self.section_times = {}
             data = None
             is_error = False
             try:
+                if cv2_num_threads is not None:
+                    Subprocessor.set_cv2_num_threads(cv2_num_threads)
+
                 self.on_initialize(client_dict)
 
                 c2s.put ( {'op': 'init_ok'} )
@@ -68,14 +104,43 @@ class Subprocessor(object):
                     op = msg.get('op','')
                     if op == 'data':
                         data = msg['data']
-                        result = self.process_data (data)
-                        c2s.put ( {'op': 'success', 'data' : data, 'result' : result} )
+                        t = time.perf_counter()
+                        try:
+                            result = self.process_data (data)
+                        except (Subprocessor.SilenceException, MemoryError):
+                            # out of memory, data is returned to host and client stays alive
+                            c2s.put ( {'op': 'requeue', 'data' : data} )
+                            data = None
+                            continue
+                        c2s.put ( {'op': 'success', 'data' : data, 'result' : result, 'process_time' : time.perf_counter()-t, 'sections' : self.section_times} )
+                        self.section_times = {}
+                        data = None
+                    elif op == 'data_chunk':
+                        chunk = msg['data']
+                        results = []
+                        process_times = []
+                        requeue_data = None
+                        for i, data in enumerate(chunk):
+                            try:
+                                t = time.perf_counter()
+                                results.append ( self.process_data (data) )
+                                process_times.append ( time.perf_counter()-t )
+                            except (Subprocessor.SilenceException, MemoryError):
+                                requeue_data = chunk[i:]
+                                break
+                            except:
+                                # processed part of chunk is returned as success, the rest is returned to host with error
+                                c2s.put ( {'op': 'success_chunk', 'data' : chunk[:i], 'result' : results, 'process_time' : process_times, 'sections' : self.section_times} )
+                                data = chunk[i:]
+                                raise
+                        c2s.put ( {'op': 'success_chunk', 'data' : chunk[:len(results)], 'result' : results, 'process_time' : process_times, 'sections' : self.section_times} )
+                        if requeue_data is not None:
+                            c2s.put ( {'op': 'requeue', 'data' : requeue_data} )
+                        self.section_times = {}
                         data = None
                     elif op == 'close':
                         break
 
-                    time.sleep(0.001)
-
                 self.on_finalize()
                 c2s.put ( {'op': 'finalized'} )
             except Subprocessor.SilenceException as e:
@@ -84,9 +149,11 @@ class Subprocessor(object):
                 err_msg = traceback.format_exc()
                 c2s.put ( {'op': 'error', 'data' : data, 'err_msg' : err_msg} )
 
-            c2s.close()
-            s2c.close()
-            self.c2s = None
+            if not isinstance(c2s, queue.Queue):
+                # thread backend shares queues and self with the host
+                c2s.close()
+                s2c.close()
+                self.c2s = None
 
         # disable pickling
         def __getstate__(self):
@@ -94,16 +161,112 @@ class Subprocessor(object):
         def __setstate__(self, d):
             self.__dict__.update(d)
 
+    # adaptive chunk is grown until processing of chunk takes about this time
+    chunk_target_time = 0.05
+    chunk_max_size = 256
+
+    backends = ['process', 'thread']
+
+    # memory autoscale: clients are paused while available memory is below memory_reserve,
+    # and resumed one by one while it is above memory_reserve + 2 * memory needed by client
+    memory_check_interval = 1.0
+    memory_scale_up_interval = 2.0
+    memory_reserve = 1024**3
+    memory_client_min = 256*1024**2
+    # data which is out of memory more times is handled as error, its client is terminated
+    memory_max_requeues = 3
+
+    # JSON lines file of SubprocessorTelemetry, None - disabled
+    telemetry_path = None
+    telemetry_interval = 5.0
+
     #overridable
-    def __init__(self, name, SubprocessorCli_class, no_response_time_sec = 0, io_loop_sleep_time=0.005, initialize_subprocesses_in_serial=False):
+    def __init__(self, name, SubprocessorCli_class, no_response_time_sec = 0, io_loop_sleep_time=0.005, initialize_subprocesses_in_serial=False, chunk_size=1, backend='process', cv2_num_threads=None, journal=None, memory_autoscale=False, min_clients=1):
+        """
+        chunk_size      number of data from get_data sent to subprocess at once,
+                        for jobs where processing of data is cheaper than transfer.
+                        0 - adaptive, 1 - no chunks.
+                        on_result and on_data_return are still called per data.
+
+        backend         'process' - every client is a subprocess
+                        'thread'  - every client is a thread of this process, with the same Cli semantics.
+                                    No copy of memory per client, for jobs in OpenCV/NumPy which release the GIL.
+                                    Cli of a thread which does not respond in no_response_time_sec is abandoned.
+
+        cv2_num_threads     optional, cap of OpenCV thread pool set in clients,
+                            with 'thread' backend it is set for the whole process.
+
+        journal         optional JobJournal. Data from get_data which is done in journal is skipped,
+                        see get_journal_key, get_journal_outputs, on_journal_skip.
+
+        memory_autoscale    all clients get data at start, the number of them is scaled down to min_clients
+                            and back by available system memory and memory used by clients while processing.
+                            Data of client out of memory (MemoryError or SilenceException) is returned by on_data_return
+                            and the client is paused, up to memory_max_requeues times per data.
+                            Without autoscale, or when the data keeps failing, such client is terminated.
+        """
         if not issubclass(SubprocessorCli_class, Subprocessor.Cli):
             raise ValueError("SubprocessorCli_class must be subclass of Subprocessor.Cli")
 
+        if backend not in Subprocessor.backends:
+            raise ValueError(f"Unknown backend {backend}, must be one of {Subprocessor.backends}")
+
         self.name = name
         self.SubprocessorCli_class = SubprocessorCli_class
         self.no_response_time_sec = no_response_time_sec
         self.io_loop_sleep_time = io_loop_sleep_time
         self.initialize_subprocesses_in_serial = initialize_subprocesses_in_serial
+        self.chunk_size = chunk_size
+        self.backend = backend
+        self.cv2_num_threads = cv2_num_threads
+        self.journal = journal
+        self.memory_autoscale = memory_autoscale
+        self.min_clients = max(1, min_clients)
+
+    def log_active_clients(self, available=None):
+        msg = f"{self.name}: {self.active_clients_count} of {len(self.clis)} workers active"
+        if available is not None:
+            msg += f", {available / 1024**3:.1f}GB memory available"
+        io.log_info(msg)
+
+    def update_active_clients(self):
+        t = time.time()
+        if t - self.memory_check_time < Subprocessor.memory_check_interval:
+            return
+        self.memory_check_time = t
+
+        available = osex.get_available_memory()
+        if available is None:
+            if self.active_clients_count < len(self.clis):
+                # unknown on this platform
+                self.active_clients_count = len(self.clis)
+                self.log_active_clients()
+            return
+
+        # memory used by client while processing, as growth of its RSS
+        client_memory = Subprocessor.memory_client_min
+        for cli in self.clis:
+            rss = osex.get_process_rss(cli.p.pid) if cli.backend == 'process' else None
+            if rss is not None:
+                cli.rss_min = min(cli.rss_min, rss) if cli.rss_min is not None else rss
+                cli.rss_max = max(cli.rss_max, rss) if cli.rss_max is not None else rss
+                client_memory = max(client_memory, cli.rss_max - cli.rss_min)
+
+        if available < Subprocessor.memory_reserve:
+            if self.active_clients_count > self.min_clients:
+                self.active_clients_count -= 1
+                self.scale_time = t
+                self.log_active_clients(available)
+        elif available > Subprocessor.memory_reserve + 2*client_memory:
+            if self.active_clients_count < len(self.clis) and t - self.scale_time >= Subprocessor.memory_scale_up_interval:
+                self.active_clients_count += 1
+                self.scale_time = t
+                self.log_active_clients(available)
+
+    @staticmethod
+    def set_cv2_num_threads(num_threads):
+        import cv2
+        cv2.setNumThreads(num_threads)
 
     #overridable
     def process_info_generator(self):
@@ -140,6 +303,22 @@ class Subprocessor(object):
         #return result that will be returned in func run()
         return None
 
+    #overridable optional
+    def get_journal_key(self, data):
+        #return string identificator of 'data' in journal, None - 'data' is not journaled
+        return None
+
+    #overridable optional
+    def get_journal_outputs(self, data, result):
+        #return list of output filepaths of 'result', item is redone on restart if any of them does not exist
+        #None - 'result' is not recorded, e.g. failed
+        return []
+
+    #overridable optional
+    def on_journal_skip(self, host_dict, data, outputs):
+        #'data' was done in previous run with 'outputs', do what on_result does for it
+        pass
+
     #overridable
     def on_tick(self):
         #tick in main loop
@@ -155,6 +334,27 @@ class Subprocessor(object):
             return self.get_result()
 
         self.clis = []
+        telemetry = self.telemetry = SubprocessorTelemetry(self.name, Subprocessor.telemetry_path, Subprocessor.telemetry_interval)
+        journal = self.journal
+
+        def get_next_data(host_dict):
+            while True:
+                data = self.get_data(host_dict)
+                if data is None or journal is None:
+                    return data
+                key = self.get_journal_key(data)
+                if key is None or not journal.is_done(key):
+                    return data
+                self.on_journal_skip(host_dict, data, journal.get_outputs(key))
+
+        def on_result(host_dict, data, result):
+            self.on_result (host_dict, data, result)
+            if journal is not None:
+                key = self.get_journal_key(data)
+                if key is not None:
+                    outputs = self.get_journal_outputs(data, result)
+                    if outputs is not None:
+                        journal.add(key, outputs)
 
         def cli_init_dispatcher(cli):
             while not cli.c2s.empty():
@@ -177,14 +377,19 @@ class Subprocessor(object):
         #getting info about name of subprocesses, host and client dicts, and spawning them
         for name, host_dict, client_dict in self.process_info_generator():
             try:
-                cli = self.SubprocessorCli_class(client_dict)
+                cli = self.SubprocessorCli_class(client_dict, backend=self.backend, cv2_num_threads=self.cv2_num_threads)
                 cli.state = 1
                 cli.sent_time = 0
                 cli.sent_data = None
+                cli.sent_chunk = False
+                cli.chunk_size = self.chunk_size if self.chunk_size != 0 else 1
                 cli.name = name
                 cli.host_dict = host_dict
+                cli.rss_min = None
+                cli.rss_max = None
 
                 self.clis.append (cli)
+                telemetry.add_client(name)
 
                 if self.initialize_subprocesses_in_serial:
                     while True:
@@ -211,19 +416,54 @@ class Subprocessor(object):
 
         #ok some processes survived, initialize host logic
 
+        # clients after active_clients_count in self.clis are paused
+        self.active_clients_count = len(self.clis)
+        # id of data sent to client : [data, times out of memory]
+        requeues = {}
+        if self.memory_autoscale:
+            self.memory_check_time = 0
+            self.scale_time = 0
+
         self.on_clients_initialized()
 
         #main loop of data processing
         while True:
             for cli in self.clis[:]:
+                queue_depth = 0
                 while not cli.c2s.empty():
                     obj = cli.c2s.get()
+                    queue_depth += 1
                     op = obj.get('op','')
                     if op == 'success':
                         #success processed data, return data and result to on_result
-                        self.on_result (cli.host_dict, obj['data'], obj['result'])
-                        self.sent_data = None
+                        requeues.pop(id(cli.sent_data), None)
+                        telemetry.add_result(cli.name, obj['process_time'])
+                        telemetry.add_sections(cli.name, obj['sections'])
+                        t = time.perf_counter()
+                        on_result (cli.host_dict, obj['data'], obj['result'])
+                        telemetry.add_host_time('on_result', time.perf_counter()-t)
+                        cli.sent_data = None
                         cli.state = 0
+                    elif op == 'success_chunk':
+                        telemetry.add_sections(cli.name, obj['sections'])
+                        for data in cli.sent_data[:len(obj['data'])]:
+                            requeues.pop(id(data), None)
+                        t = time.perf_counter()
+                        for data, result, process_time in zip(obj['data'], obj['result'], obj['process_time']):
+                            telemetry.add_result(cli.name, process_time)
+                            on_result (cli.host_dict, data, result)
+                        telemetry.add_host_time('on_result', time.perf_counter()-t)
+
+                        if len(obj['data']) == len(cli.sent_data):
+                            if self.chunk_size == 0:
+                                # grow or shrink the chunk to chunk_target_time
+                                data_time = (time.time() - cli.sent_time) / len(cli.sent_data)
+                                cli.chunk_size = int(np.clip( self.chunk_target_time / max(data_time, 1e-6), 1, self.chunk_max_size ))
+                            cli.sent_data = None
+                            cli.state = 0
+                        else:
+                            # partial result before error
+                            cli.sent_data = cli.sent_data[len(obj['data']):]
                     elif op == 'error':
                         #some error occured while process data, returning chunk to on_data_return
                         err_msg = obj.get('err_msg', None)
@@ -231,36 +471,99 @@ class Subprocessor(object):
                             io.log_info(f'Error while processing data: {err_msg}')
                             
                         if 'data' in obj.keys():
-                            self.on_data_return (cli.host_dict, obj['data'] )                        
+                            if cli.sent_chunk:
+                                if obj['data'] is not None:
+                                    for data in obj['data'][::-1]:
+                                        self.on_data_return (cli.host_dict, data )
+                            else:
+                                self.on_data_return (cli.host_dict, obj['data'] )
                         #and killing process
                         cli.kill()
                         self.clis.remove(cli)
+                    elif op == 'requeue':
+                        #client is out of memory, returning data to on_data_return.
+                        #host objects of the data are returned, so the same data is recognized when it is sent again
+                        sent_data = cli.sent_data if cli.sent_chunk else [cli.sent_data]
+                        is_retry = True
+                        for data in sent_data:
+                            data_requeues = requeues.setdefault(id(data), [data, 0])
+                            data_requeues[1] += 1
+                            if data_requeues[1] > Subprocessor.memory_max_requeues:
+                                is_retry = False
+
+                        for data in sent_data[::-1]:
+                            self.on_data_return (cli.host_dict, data )
+                        cli.sent_data = None
+                        cli.state = 0
+
+                        if self.memory_autoscale and is_retry:
+                            if self.active_clients_count > self.min_clients:
+                                self.active_clients_count -= 1
+                                self.scale_time = time.time()
+                            io.log_info(f'{cli.name} is out of memory, data is requeued.')
+                            self.log_active_clients()
+                        else:
+                            io.log_info(f'{cli.name} is out of memory, terminating it.')
+                            cli.kill()
+                            self.clis.remove(cli)
+                            break
                     elif op == 'log_info':
                         io.log_info(obj['msg'])
                     elif op == 'log_err':
                         io.log_err(obj['msg'])
                     elif op == 'progress_bar_inc':
                         io.progress_bar_inc(obj['c'])
+                    elif op == 'journal_add':
+                        if journal is not None:
+                            journal.add(obj['key'], obj['outputs'])
+                telemetry.add_queue_depth(cli.name, queue_depth)
 
             for cli in self.clis[:]:
                 if cli.state == 1:
                     if cli.sent_time != 0 and self.no_response_time_sec != 0 and (time.time() - cli.sent_time) > self.no_response_time_sec:
                         #subprocess busy too long
                         print ( '%s doesnt response, terminating it.' % (cli.name) )
-                        self.on_data_return (cli.host_dict, cli.sent_data )
+                        if cli.sent_chunk:
+                            for data in cli.sent_data[::-1]:
+                                self.on_data_return (cli.host_dict, data )
+                        else:
+                            self.on_data_return (cli.host_dict, cli.sent_data )
                         cli.kill()
                         self.clis.remove(cli)
 
-            for cli in self.clis[:]:
-                if cli.state == 0:
+            if self.memory_autoscale:
+                self.update_active_clients()
+
+            for n_cli, cli in enumerate(self.clis[:]):
+                if cli.state == 0 and n_cli < self.active_clients_count:
                     #free state of subprocess, get some data from get_data
-                    data = self.get_data(cli.host_dict)
-                    if data is not None:
-                        #and send it to subprocess
-                        cli.s2c.put ( {'op': 'data', 'data' : data} )
-                        cli.sent_time = time.time()
-                        cli.sent_data = data
-                        cli.state = 1
+                    t = time.perf_counter()
+                    if self.chunk_size == 1:
+                        data = get_next_data(cli.host_dict)
+                        if data is not None:
+                            #and send it to subprocess
+                            cli.s2c.put ( {'op': 'data', 'data' : data} )
+                            cli.sent_time = time.time()
+                            cli.sent_data = data
+                            cli.sent_chunk = False
+                            cli.state = 1
+                    else:
+                        chunk = []
+                        while len(chunk) < cli.chunk_size:
+                            data = get_next_data(cli.host_dict)
+                            if data is None:
+                                break
+                            chunk.append(data)
+
+                        if len(chunk) != 0:
+                            cli.s2c.put ( {'op': 'data_chunk', 'data' : chunk} )
+                            cli.sent_time = time.time()
+                            cli.sent_data = chunk
+                            cli.sent_chunk = True
+                            cli.state = 1
+                    telemetry.add_host_time('get_data', time.perf_counter()-t)
+
+            telemetry.tick()
 
             if self.io_loop_sleep_time != 0:
                 io.process_messages(self.io_loop_sleep_time)
@@ -276,20 +579,44 @@ class Subprocessor(object):
             cli.s2c.put ( {'op': 'close'} )
             cli.sent_time = time.time()
 
+        def on_finalize_message(cli, obj):
+            # returns True if client is finalized
+            obj_op = obj['op']
+            if obj_op == 'finalized':
+                return True
+            elif obj_op == 'journal_add':
+                # outputs completed in on_finalize of client
+                if journal is not None:
+                    journal.add(obj['key'], obj['outputs'])
+                # client is still completing its work
+                cli.sent_time = time.time()
+            elif obj_op == 'log_err':
+                io.log_err(obj['msg'])
+            return False
+
         while True:
             for cli in self.clis[:]:
+                if cli.state == 2:
+                    continue
+
                 terminate_it = False
                 while not cli.c2s.empty():
-                    obj = cli.c2s.get()
-                    obj_op = obj['op']
-                    if obj_op == 'finalized':
+                    if on_finalize_message(cli, cli.c2s.get()):
                         terminate_it = True
                         break
 
-                if (time.time() - cli.sent_time) > 30:
+                if not terminate_it and (time.time() - cli.sent_time) > 30:
                     terminate_it = True
-
-                if terminate_it:
+                    cli.kill()
+                    # messages sent before the client was stopped
+                    while True:
+                        try:
+                            if on_finalize_message(cli, cli.c2s.get(timeout=0.1)):
+                                break
+                        except:
+                            break
+                    cli.state = 2
+                elif terminate_it:
                     cli.state = 2
                     cli.kill()
 
@@ -297,6 +624,9 @@ class Subprocessor(object):
                 break
 
         #finalizing host logic and return result
+        telemetry.finalize()
+        if journal is not None:
+            journal.fsync()
         self.on_clients_finalized()
 
         return self.get_result()
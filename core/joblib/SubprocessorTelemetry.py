@@ -0,0 +1,135 @@
+import json
+import random
+import time
+
+import numpy as np
+
+from core.interact import interact as io
+
+
+class SubprocessorTelemetry(object):
+    """
+    Collects throughput and latency of clients of Subprocessor,
+    and time spent by the host in get_data and on_result.
+
+    Report of the last interval is appended as JSON line to path every interval seconds,
+    summary of the whole run is appended at finalize().
+
+    Latency is time of process_data measured in client.
+    queue_depth is the max number of messages which waited in the queue of client for the host.
+    """
+    reservoir_size = 4096
+
+    class Stats(object):
+        def __init__(self):
+            self.items = 0
+            self.busy_time = 0.0
+            self.latencies = []
+            self.latencies_count = 0
+            self.queue_depth = 0
+            self.sections = {}
+
+        def add_latency(self, t):
+            reservoir_size = SubprocessorTelemetry.reservoir_size
+            self.items += 1
+            self.busy_time += t
+            self.latencies_count += 1
+            if len(self.latencies) < reservoir_size:
+                self.latencies.append(t)
+            else:
+                # reservoir sampling keeps p95 estimate in fixed memory
+                i = random.randrange(self.latencies_count)
+                if i < reservoir_size:
+                    self.latencies[i] = t
+
+        def get_dict(self, elapsed):
+            if len(self.latencies) != 0:
+                latency_mean = self.busy_time / self.items
+                latency_p95 = float(np.percentile(self.latencies, 95))
+            else:
+                latency_mean = latency_p95 = None
+
+            return {'items' : self.items,
+                    'items_per_sec' : self.items / elapsed if elapsed > 0 else 0.0,
+                    'busy_time' : self.busy_time,
+                    'idle_time' : max(0.0, elapsed - self.busy_time),
+                    'latency_mean' : latency_mean,
+                    'latency_p95' : latency_p95,
+                    'queue_depth' : self.queue_depth,
+                    'sections' : self.sections }
+
+    def __init__(self, name, path=None, interval=5.0):
+        self.name = name
+        self.path = path
+        self.interval = interval
+        self.start_time = self.report_time = time.time()
+
+        self.clients = {}
+        self.host_times = {'get_data' : 0.0, 'on_result' : 0.0}
+        self.total_clients = {}
+        self.total_host_times = {'get_data' : 0.0, 'on_result' : 0.0}
+
+    def add_client(self, name):
+        self.clients[name] = SubprocessorTelemetry.Stats()
+        self.total_clients[name] = SubprocessorTelemetry.Stats()
+
+    def add_host_time(self, op, t):
+        self.host_times[op] += t
+        self.total_host_times[op] += t
+
+    def add_result(self, name, process_time):
+        self.clients[name].add_latency(process_time)
+        self.total_clients[name].add_latency(process_time)
+
+    def add_sections(self, name, sections):
+        for stats in [self.clients[name], self.total_clients[name]]:
+            for section, t in sections.items():
+                stats.sections[section] = stats.sections.get(section, 0.0) + t
+
+    def add_queue_depth(self, name, depth):
+        for stats in [self.clients[name], self.total_clients[name]]:
+            stats.queue_depth = max(stats.queue_depth, depth)
+
+    def get_report(self, clients, host_times, elapsed, summary=False):
+        return {'name' : self.name,
+                'time' : time.time(),
+                'elapsed' : elapsed,
+                'summary' : summary,
+                'items' : sum( stats.items for stats in clients.values() ),
+                'host' : dict(host_times),
+                'clients' : { name : stats.get_dict(elapsed) for name, stats in clients.items() } }
+
+    def write(self, report):
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write( json.dumps(report) + '\n' )
+
+    def tick(self):
+        if self.path is None:
+            return
+
+        t = time.time()
+        if t - self.report_time >= self.interval:
+            self.write ( self.get_report(self.clients, self.host_times, t - self.report_time) )
+            self.report_time = t
+            for name in self.clients.keys():
+                self.clients[name] = SubprocessorTelemetry.Stats()
+            for op in self.host_times.keys():
+                self.host_times[op] = 0.0
+
+    def finalize(self):
+        """
+        writes and logs summary of the run, returns it as dict
+        """
+        report = self.get_report(self.total_clients, self.total_host_times, time.time() - self.start_time, summary=True)
+        if self.path is not None:
+            self.write(report)
+
+            io.log_info (f"{self.name}: {report['items']} items in {report['elapsed']:.1f}s, get_data {report['host']['get_data']:.1f}s, on_result {report['host']['on_result']:.1f}s")
+            for name, stats in report['clients'].items():
+                if stats['items'] == 0:
+                    continue
+                sections = ''.join( f", {section} {t/stats['items']*1000:.1f}ms" for section, t in stats['sections'].items() )
+                io.log_info (f"{name}: {stats['items_per_sec']:.2f} items/s, busy {stats['busy_time']/max(report['elapsed'],1e-6)*100:.0f}%, "
+                             f"latency mean {stats['latency_mean']*1000:.1f}ms p95 {stats['latency_p95']*1000:.1f}ms, queue depth {stats['queue_depth']}{sections}")
+        return report
@@ -2,4 +2,5 @@ from .SubprocessorBase import Subprocessor
 from .ThisThreadGenerator import ThisThreadGenerator
 from .SubprocessGenerator import SubprocessGenerator
 from .MPFunc import MPFunc
-from .MPClassFuncOnDemand import MPClassFuncOnDemand
\ No newline at end of file
+from .MPClassFuncOnDemand import MPClassFuncOnDemand
+from .JobJournal import JobJournal
\ No newline at end of file
@@ -1,7 +1,8 @@
 from .MPSharedList import MPSharedList
+import bisect
+import collections
 import multiprocessing
 import threading
-import time
 
 import numpy as np
 
@@ -26,19 +27,16 @@ class IndexHost():
         sq = self.sq
 
         while True:
-            while not sq.empty():
-                obj = sq.get()
-                cq_id, count = obj[0], obj[1]
+            obj = sq.get()
+            cq_id, count = obj[0], obj[1]
 
-                result = []
-                for i in range(count):
-                    if len(shuffle_idxs) == 0:
-                        shuffle_idxs = idxs.copy()
-                        rnd_state.shuffle(shuffle_idxs)
-                    result.append(shuffle_idxs.pop())
-                self.cqs[cq_id].put (result)
-
-            time.sleep(0.001)
+            result = []
+            for i in range(count):
+                if len(shuffle_idxs) == 0:
+                    shuffle_idxs = idxs.copy()
+                    rnd_state.shuffle(shuffle_idxs)
+                result.append(shuffle_idxs.pop())
+            self.cqs[cq_id].put (result)
 
     def create_cli(self):
         cq = multiprocessing.Queue()
@@ -61,10 +59,101 @@ class IndexHost():
         def multi_get(self, count):
             self.sq.put ( (self.cq_id,count) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
+
+class ShardedIndexHost():
+    """
+    Provides random shuffled indexes for multiprocesses,
+    for samples split to shards of contiguous indexes.
+
+    Indexes are drawn only from active_shards_count shards at a time,
+    so the working set of the readers stays in page cache.
+    Exhausted shard is replaced by the next shard of the epoch,
+    the shards active at the end of epoch are the first shards of the next epoch.
+    Every index is provided exactly once per epoch as with IndexHost.
+
+    prefetch_func(shard_id)     optional, called for the shard which will be activated next
+    """
+    def __init__(self, shards_lens, active_shards_count=2, prefetch_func=None, rnd_seed=None):
+        if sum(shards_lens) == 0:
+            raise ValueError('ShardedIndexHost: all shards are empty.')
+
+        self.sq = multiprocessing.Queue()
+        self.cqs = []
+        self.clis = []
+        self.thread = threading.Thread(target=self.host_thread, args=(shards_lens, active_shards_count, prefetch_func, rnd_seed) )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def host_thread(self, shards_lens, active_shards_count, prefetch_func, rnd_seed):
+        rnd_state = np.random.RandomState(rnd_seed) if rnd_seed is not None else np.random
+
+        shards_starts = np.concatenate( [ [0], np.cumsum(shards_lens) ] ).astype(np.int64)
+        shards_count = len(shards_lens)
+        active_shards_count = max(1, min(active_shards_count, shards_count))
+
+        shards_queue = []
+        active_shards = []
+        shuffle_idxs = {}
+        hot_shards = []
+        sq = self.sq
+
+        def activate_next_shard():
+            shard_id = shards_queue.pop(0)
+            idxs = [*range(shards_starts[shard_id], shards_starts[shard_id+1])]
+            rnd_state.shuffle(idxs)
+            shuffle_idxs[shard_id] = idxs
+            active_shards.append(shard_id)
+            hot_shards.append(shard_id)
+            del hot_shards[:-active_shards_count]
+            if prefetch_func is not None and len(shards_queue) != 0:
+                prefetch_func(shards_queue[0])
+
+        while True:
+            obj = sq.get()
+            cq_id, count = obj[0], obj[1]
+
+            result = []
+            for i in range(count):
+                if len(active_shards) == 0:
+                    # new epoch, starting from the shards read last
+                    shards_queue = [ shard_id for shard_id in range(shards_count) if shard_id not in hot_shards ]
+                    rnd_state.shuffle(shards_queue)
+                    shards_queue = [ shard_id for shard_id in hot_shards if shards_lens[shard_id] != 0 ] + \
+                                   [ shard_id for shard_id in shards_queue if shards_lens[shard_id] != 0 ]
+                    while len(active_shards) < active_shards_count and len(shards_queue) != 0:
+                        activate_next_shard()
+                    if len(active_shards) == 0:
+                        # no indexes, client gets what is drawn
+                        break
+
+                # shard with more remaining indexes is chosen more often, so the active shards run out together
+                n = rnd_state.randint( sum( len(shuffle_idxs[shard_id]) for shard_id in active_shards ) )
+                for shard_id in active_shards:
+                    n -= len(shuffle_idxs[shard_id])
+                    if n < 0:
+                        break
+
+                result.append( shuffle_idxs[shard_id].pop() )
+
+                if len(shuffle_idxs[shard_id]) == 0:
+                    active_shards.remove(shard_id)
+                    if len(shards_queue) != 0:
+                        activate_next_shard()
+
+            self.cqs[cq_id].put (result)
+
+    def create_cli(self):
+        cq = multiprocessing.Queue()
+        self.cqs.append ( cq )
+        cq_id = len(self.cqs)-1
+        return IndexHost.Cli(self.sq, cq, cq_id)
+
+    # disable pickling
+    def __getstate__(self):
+        return dict()
+    def __setstate__(self, d):
+        self.__dict__.update(d)
 
 class Index2DHost():
     """
@@ -94,40 +183,37 @@ class Index2DHost():
         sq = self.sq
 
         while True:
-            while not sq.empty():
-                obj = sq.get()
-                cq_id, count = obj[0], obj[1]
+            obj = sq.get()
+            cq_id, count = obj[0], obj[1]
 
-                result = []
-                for i in range(count):
-                    if len(shuffle_idxs) == 0:
-                        shuffle_idxs = idxs.copy()
-                        np.random.shuffle(shuffle_idxs)
+            result = []
+            for i in range(count):
+                if len(shuffle_idxs) == 0:
+                    shuffle_idxs = idxs.copy()
+                    np.random.shuffle(shuffle_idxs)
 
-                    idx_1D = shuffle_idxs.pop()
+                idx_1D = shuffle_idxs.pop()
                     
-                    #print(f'idx_1D = {idx_1D}, len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
+                #print(f'idx_1D = {idx_1D}, len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
                     
-                    if len(shuffle_idxs_2D[idx_1D]) == 0:
-                        shuffle_idxs_2D[idx_1D] = idxs_2D[idx_1D].copy()
-                        #print(f'new shuffle_idxs_2d for {idx_1D} = { shuffle_idxs_2D[idx_1D] }')
+                if len(shuffle_idxs_2D[idx_1D]) == 0:
+                    shuffle_idxs_2D[idx_1D] = idxs_2D[idx_1D].copy()
+                    #print(f'new shuffle_idxs_2d for {idx_1D} = { shuffle_idxs_2D[idx_1D] }')
                         
-                        #print(f'len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
+                    #print(f'len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
                     
-                        np.random.shuffle( shuffle_idxs_2D[idx_1D] )
+                    np.random.shuffle( shuffle_idxs_2D[idx_1D] )
 
-                    idx_2D = shuffle_idxs_2D[idx_1D].pop()
+                idx_2D = shuffle_idxs_2D[idx_1D].pop()
                     
-                    #print(f'len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
+                #print(f'len(shuffle_idxs_2D[idx_1D])= {len(shuffle_idxs_2D[idx_1D])}')
                     
-                    #print(f'idx_2D = {idx_2D}')
+                #print(f'idx_2D = {idx_2D}')
                     
 
-                    result.append( indexes2D[idx_1D][idx_2D])
-
-                self.cqs[cq_id].put (result)
+                result.append( indexes2D[idx_1D][idx_2D])
 
-            time.sleep(0.001)
+            self.cqs[cq_id].put (result)
 
     def create_cli(self):
         cq = multiprocessing.Queue()
@@ -150,10 +236,7 @@ class Index2DHost():
         def multi_get(self, count):
             self.sq.put ( (self.cq_id,count) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
 
 class ListHost():
     def __init__(self, list_):
@@ -168,29 +251,26 @@ class ListHost():
     def host_thread(self):
         sq = self.sq
         while True:
-            while not sq.empty():
-                obj = sq.get()
-                cq_id, cmd = obj[0], obj[1]
-
-                if cmd == 0:
-                    self.cqs[cq_id].put ( len(self.m_list) )
-                elif cmd == 1:
-                    idx = obj[2]
-                    item = self.m_list[idx ]
-                    self.cqs[cq_id].put ( item )
-                elif cmd == 2:
-                    result = []
-                    for item in obj[2]:
-                        result.append ( self.m_list[item] )
-                    self.cqs[cq_id].put ( result )
-                elif cmd == 3:
-                    self.m_list.insert(obj[2], obj[3])
-                elif cmd == 4:
-                    self.m_list.append(obj[2])
-                elif cmd == 5:
-                    self.m_list.extend(obj[2])
-
-            time.sleep(0.005)
+            obj = sq.get()
+            cq_id, cmd = obj[0], obj[1]
+
+            if cmd == 0:
+                self.cqs[cq_id].put ( len(self.m_list) )
+            elif cmd == 1:
+                idx = obj[2]
+                item = self.m_list[idx ]
+                self.cqs[cq_id].put ( item )
+            elif cmd == 2:
+                result = []
+                for item in obj[2]:
+                    result.append ( self.m_list[item] )
+                self.cqs[cq_id].put ( result )
+            elif cmd == 3:
+                self.m_list.insert(obj[2], obj[3])
+            elif cmd == 4:
+                self.m_list.append(obj[2])
+            elif cmd == 5:
+                self.m_list.extend(obj[2])
 
     def create_cli(self):
         cq = multiprocessing.Queue()
@@ -216,26 +296,17 @@ class ListHost():
         def __len__(self):
             self.sq.put ( (self.cq_id,0) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
 
         def __getitem__(self, key):
             self.sq.put ( (self.cq_id,1,key) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
 
         def multi_get(self, keys):
             self.sq.put ( (self.cq_id,2,keys) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
 
         def insert(self, index, item):
             self.sq.put ( (self.cq_id,3,index,item) )
@@ -248,30 +319,176 @@ class ListHost():
 
 
 
+class LRUCacheHost():
+    """
+    Provides LRU cache of numpy arrays in shared memory for multiprocesses.
+
+    Arrays are stored in one shared buffer of max_bytes,
+    least recently used ones are evicted to fit new ones.
+    Index of the cache is kept by the host thread, data is copied by the clients.
+
+    hits, misses and used_bytes are updated by the host thread.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.used_bytes = 0
+        self.buffer = multiprocessing.RawArray('B', max_bytes)
+        self.sq = multiprocessing.Queue()
+        self.cqs = []
+        self.thread = threading.Thread(target=self.host_thread, args=(max_bytes,) )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def host_thread(self, max_bytes):
+        # key : [offset, size, shape, dtype, pins count], shape is None until data is written
+        entries = collections.OrderedDict()
+        # sorted (offset, size) of free blocks of the buffer
+        free_blocks = [ (0, max_bytes) ]
+
+        def alloc(size):
+            for i, (offset, block_size) in enumerate(free_blocks):
+                if block_size >= size:
+                    if block_size == size:
+                        free_blocks.pop(i)
+                    else:
+                        free_blocks[i] = (offset+size, block_size-size)
+                    return offset
+            return None
+
+        def free(offset, size):
+            i = bisect.bisect(free_blocks, (offset, size))
+            free_blocks.insert(i, (offset, size))
+            # merge with next and prev blocks
+            if i+1 < len(free_blocks) and offset+size == free_blocks[i+1][0]:
+                free_blocks[i] = (offset, size+free_blocks.pop(i+1)[1])
+            if i > 0 and free_blocks[i-1][0]+free_blocks[i-1][1] == offset:
+                free_blocks[i-1] = (free_blocks[i-1][0], free_blocks[i-1][1]+free_blocks.pop(i)[1])
+
+        sq = self.sq
+        while True:
+            obj = sq.get()
+            cq_id, cmd = obj[0], obj[1]
+
+            if cmd == 0:
+                # get, entry is pinned until released
+                entry = entries.get(obj[2], None)
+                if entry is None or entry[2] is None:
+                    self.misses += 1
+                    self.cqs[cq_id].put (None)
+                else:
+                    self.hits += 1
+                    entries.move_to_end(obj[2])
+                    entry[4] += 1
+                    self.cqs[cq_id].put ( (entry[0], entry[2], entry[3]) )
+            elif cmd == 1:
+                # release
+                entry = entries.get(obj[2], None)
+                if entry is not None:
+                    entry[4] -= 1
+            elif cmd == 2:
+                # alloc, entry is pinned until written
+                key, size = obj[2], obj[3]
+                offset = None
+                if key not in entries and size <= max_bytes:
+                    offset = alloc(size)
+                    if offset is None:
+                        for evict_key in list(entries.keys()):
+                            evict_entry = entries[evict_key]
+                            if evict_entry[4] == 0:
+                                entries.pop(evict_key)
+                                free(evict_entry[0], evict_entry[1])
+                                self.used_bytes -= evict_entry[1]
+                                offset = alloc(size)
+                                if offset is not None:
+                                    break
+                    if offset is not None:
+                        entries[key] = [offset, size, None, None, 1]
+                        self.used_bytes += size
+                self.cqs[cq_id].put (offset)
+            elif cmd == 3:
+                # written
+                entry = entries.get(obj[2], None)
+                if entry is not None:
+                    entry[2], entry[3] = obj[3], obj[4]
+                    entry[4] -= 1
+
+    def create_cli(self):
+        cq = multiprocessing.Queue()
+        self.cqs.append ( cq )
+        cq_id = len(self.cqs)-1
+        return LRUCacheHost.Cli(self.sq, cq, cq_id, self.buffer)
+
+    # disable pickling
+    def __getstate__(self):
+        return dict()
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+    class Cli():
+        def __init__(self, sq, cq, cq_id, buffer):
+            self.sq = sq
+            self.cq = cq
+            self.cq_id = cq_id
+            self.buffer = buffer
+            self.buffer_view = None
+
+        def __getstate__(self):
+            return {'sq':self.sq, 'cq':self.cq, 'cq_id':self.cq_id, 'buffer':self.buffer, 'buffer_view':None}
+
+        def get_array(self, offset, shape, dtype):
+            if self.buffer_view is None:
+                self.buffer_view = memoryview(self.buffer).cast('B')
+            return np.frombuffer(self.buffer_view, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+        def get(self, key):
+            """
+            returns copy of cached array, or None
+            """
+            self.sq.put ( (self.cq_id,0,key) )
+            result = self.cq.get()
+            if result is None:
+                return None
+
+            arr = self.get_array(*result).copy()
+            self.sq.put ( (self.cq_id,1,key) )
+            return arr
+
+        def put(self, key, arr):
+            """
+            returns False if the array is already cached or does not fit
+            """
+            arr = np.ascontiguousarray(arr)
+            self.sq.put ( (self.cq_id,2,key,arr.nbytes) )
+            offset = self.cq.get()
+            if offset is None:
+                return False
+
+            self.get_array(offset, arr.shape, arr.dtype)[...] = arr
+            self.sq.put ( (self.cq_id,3,key,arr.shape,arr.dtype.str) )
+            return True
+
+
 class DictHost():
     def __init__(self, d, num_users):
-        self.sqs = [ multiprocessing.Queue() for _ in range(num_users) ]
+        self.sq = multiprocessing.Queue()
         self.cqs = [ multiprocessing.Queue() for _ in range(num_users) ]
 
         self.thread = threading.Thread(target=self.host_thread, args=(d,) )
         self.thread.daemon = True
         self.thread.start()
 
-        self.clis = [ DictHostCli(sq,cq) for sq, cq in zip(self.sqs, self.cqs) ]
+        self.clis = [ DictHostCli(self.sq, cq, n_user) for n_user, cq in enumerate(self.cqs) ]
 
     def host_thread(self, d):
         while True:
-            for sq, cq in zip(self.sqs, self.cqs):
-                if not sq.empty():
-                    obj = sq.get()
-                    cmd = obj[0]
-                    if cmd == 0:
-                        cq.put (d[ obj[1] ])
-                    elif cmd == 1:
-                        cq.put ( list(d.keys()) )
-
-            time.sleep(0.005)
-
+            obj = self.sq.get()
+            n_user, cmd = obj[0], obj[1]
+            if cmd == 0:
+                self.cqs[n_user].put (d[ obj[2] ])
+            elif cmd == 1:
+                self.cqs[n_user].put ( list(d.keys()) )
 
     def get_cli(self, n_user):
         return self.clis[n_user]
@@ -283,21 +500,15 @@ class DictHost():
         self.__dict__.update(d)
 
 class DictHostCli():
-    def __init__(self, sq, cq):
+    def __init__(self, sq, cq, n_user):
         self.sq = sq
         self.cq = cq
+        self.n_user = n_user
 
     def __getitem__(self, key):
-        self.sq.put ( (0,key) )
-
-        while True:
-            if not self.cq.empty():
-                return self.cq.get()
-            time.sleep(0.001)
+        self.sq.put ( (self.n_user,0,key) )
+        return self.cq.get()
 
     def keys(self):
-        self.sq.put ( (1,) )
-        while True:
-            if not self.cq.empty():
-                return self.cq.get()
-            time.sleep(0.001)
+        self.sq.put ( (self.n_user,1) )
+        return self.cq.get()
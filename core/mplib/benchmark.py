@@ -0,0 +1,43 @@
+"""
+Microbenchmark of mplib hosts
+
+    python -m core.mplib.benchmark
+
+request latency     mean time of IndexHost.Cli.multi_get from client processes
+idle cpu            cpu time used by the process with idle hosts
+"""
+import multiprocessing
+import time
+
+from core import mplib
+
+
+def client_func(cli, requests_count, batch_size, result_q):
+    cli.multi_get(batch_size)
+    t = time.perf_counter()
+    for _ in range(requests_count):
+        cli.multi_get(batch_size)
+    result_q.put ( (time.perf_counter() - t) / requests_count )
+
+def bench_latency(clients_count=16, requests_count=500, batch_size=64):
+    host = mplib.IndexHost(100000)
+    result_q = multiprocessing.Queue()
+    ps = [ multiprocessing.Process(target=client_func, args=(host.create_cli(), requests_count, batch_size, result_q), daemon=True) for _ in range(clients_count) ]
+    for p in ps:
+        p.start()
+    latencies = [ result_q.get() for _ in ps ]
+    for p in ps:
+        p.join()
+    return sum(latencies) / len(latencies)
+
+def bench_idle_cpu(hosts_count=16, duration=3.0):
+    hosts = [ mplib.IndexHost(1000) for _ in range(hosts_count) ]
+    clis = [ host.create_cli() for host in hosts ]
+    time.sleep(0.5)
+    t = time.process_time()
+    time.sleep(duration)
+    return (time.process_time() - t) / duration
+
+if __name__ == "__main__":
+    print(f"request latency, 16 clients : {bench_latency()*1000000:.0f} us")
+    print(f"idle cpu, 16 hosts          : {bench_idle_cpu()*100:.1f} % of core")
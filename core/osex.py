@@ -34,4 +34,68 @@ def get_screen_size():
         pass
         
     return (1366, 768)
-        
\ No newline at end of file
+        
+def get_available_memory():
+    """
+    returns bytes of memory available for new allocations without swapping, or None if unknown
+    """
+    try:
+        if sys.platform[0:3] == 'win':
+            import ctypes
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [ ('dwLength', wintypes.DWORD),
+                             ('dwMemoryLoad', wintypes.DWORD),
+                             ('ullTotalPhys', ctypes.c_ulonglong),
+                             ('ullAvailPhys', ctypes.c_ulonglong),
+                             ('ullTotalPageFile', ctypes.c_ulonglong),
+                             ('ullAvailPageFile', ctypes.c_ulonglong),
+                             ('ullTotalVirtual', ctypes.c_ulonglong),
+                             ('ullAvailVirtual', ctypes.c_ulonglong),
+                             ('ullAvailExtendedVirtual', ctypes.c_ulonglong) ]
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys
+        elif 'linux' in sys.platform:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+    except:
+        pass
+    return None
+
+def get_process_rss(pid):
+    """
+    returns resident memory in bytes of process, or None if unknown
+    """
+    try:
+        if sys.platform[0:3] == 'win':
+            import ctypes
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [ ('cb', wintypes.DWORD),
+                             ('PageFaultCount', wintypes.DWORD),
+                             ('PeakWorkingSetSize', ctypes.c_size_t),
+                             ('WorkingSetSize', ctypes.c_size_t),
+                             ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                             ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                             ('PagefileUsage', ctypes.c_size_t),
+                             ('PeakPagefileUsage', ctypes.c_size_t) ]
+            PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+            handle = windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+            if handle:
+                try:
+                    counters = PROCESS_MEMORY_COUNTERS()
+                    counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+                    if windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                        return counters.WorkingSetSize
+                finally:
+                    windll.kernel32.CloseHandle(handle)
+        elif 'linux' in sys.platform:
+            with open(f'/proc/{pid}/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except:
+        pass
+    return None
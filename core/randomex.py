@@ -1,5 +1,23 @@
+import threading
+
 import numpy as np
 
+_thread_local = threading.local()
+
+def get_rnd_state():
+    """
+    returns random state of the current thread.
+    Main thread uses global np.random, other threads have own np.random.RandomState seeded from it,
+    so workers of 'thread' backend do not share one sequence.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return np.random
+
+    rnd_state = getattr(_thread_local, 'rnd_state', None)
+    if rnd_state is None:
+        rnd_state = _thread_local.rnd_state = np.random.RandomState( np.random.randint(0x80000000) )
+    return rnd_state
+
 def random_normal( size=(1,), trunc_val = 2.5 ):
     len = np.array(size).prod()
     result = np.empty ( (len,) , dtype=np.float32)
@@ -31,8 +31,6 @@ def create_flask_app(s2c, c2s, s2flask, kwargs):
         while not s2flask.empty():
             s2flask.get()
         queue.put({'op': op})
-        while s2flask.empty():
-            pass
         s2flask.get()
 
     @app.route('/save', methods=['POST'])
@@ -43,6 +43,7 @@ if __name__ == "__main__":
                         jpeg_quality            = arguments.jpeg_quality,
                         cpu_only                = arguments.cpu_only,
                         force_gpu_idxs          = [ int(x) for x in arguments.force_gpu_idxs.split(',') ] if arguments.force_gpu_idxs is not None else None,
+                        memory_autoscale        = arguments.memory_autoscale,
                       )
 
     p = subparsers.add_parser( "extract", help="Extract the faces from a pictures.")
@@ -60,6 +61,7 @@ if __name__ == "__main__":
     p.add_argument('--manual-window-size', type=int, dest="manual_window_size", default=1368, help="Manual fix window size. Default: 1368.")
     p.add_argument('--cpu-only', action="store_true", dest="cpu_only", default=False, help="Extract on CPU..")
     p.add_argument('--force-gpu-idxs', dest="force_gpu_idxs", default=None, help="Force to choose GPU indexes separated by comma.")
+    p.add_argument('--memory-autoscale', action="store_true", dest="memory_autoscale", default=False, help="Pause workers while system memory is low and resume them when it is available.")
 
     p.set_defaults (func=process_extract)
 
@@ -89,6 +91,9 @@ if __name__ == "__main__":
         if arguments.restore_faceset_metadata:
             Util.restore_faceset_metadata_folder (input_path=arguments.input_dir)
 
+        if arguments.convert_faceset_metadata:
+            Util.convert_faceset_metadata_folder (input_path=arguments.input_dir)
+
         if arguments.pack_faceset:
             io.log_info ("Performing faceset packing...\r\n")
             from samplelib import PackedFaceset
@@ -105,6 +110,7 @@ if __name__ == "__main__":
     p.add_argument('--recover-original-aligned-filename', action="store_true", dest="recover_original_aligned_filename", default=False, help="Recover original aligned filename.")
     p.add_argument('--save-faceset-metadata', action="store_true", dest="save_faceset_metadata", default=False, help="Save faceset metadata to file.")
     p.add_argument('--restore-faceset-metadata', action="store_true", dest="restore_faceset_metadata", default=False, help="Restore faceset metadata to file. Image filenames must be the same as used with save.")
+    p.add_argument('--convert-faceset-metadata', action="store_true", dest="convert_faceset_metadata", default=False, help="Convert pickled metadata of aligned faces to the binary format.")
     p.add_argument('--pack-faceset', action="store_true", dest="pack_faceset", default=False, help="")
     p.add_argument('--unpack-faceset', action="store_true", dest="unpack_faceset", default=False, help="")
 
@@ -113,6 +119,9 @@ if __name__ == "__main__":
     def process_train(arguments):
         osex.set_process_lowest_prio()
 
+        if arguments.image_cache_gb > 0:
+            from samplelib import SampleGeneratorFace
+            SampleGeneratorFace.image_cache_bytes = int(arguments.image_cache_gb*1024**3)
 
         kwargs = {'model_class_name'         : arguments.model_name,
                   'saved_models_path'        : Path(arguments.model_dir),
@@ -150,6 +159,8 @@ if __name__ == "__main__":
     p.add_argument('--flask-preview', action="store_true", dest="flask_preview", default=False,
                    help="Launches a flask server to view the previews in a web browser")
 
+    p.add_argument('--image-cache-gb', type=float, dest="image_cache_gb", default=0, help="Cache decoded faces of each faceset in memory up to this size in GB, shared by all sample generators.")
+
     p.add_argument('--execute-program', dest="execute_program", default=[], action='append', nargs='+')
     p.set_defaults (func=process_train)
 
@@ -164,7 +175,8 @@ if __name__ == "__main__":
                       output_mask_path       = Path(arguments.output_mask_dir),
                       aligned_path           = Path(arguments.aligned_dir) if arguments.aligned_dir is not None else None,
                       force_gpu_idxs         = arguments.force_gpu_idxs,
-                      cpu_only               = arguments.cpu_only)
+                      cpu_only               = arguments.cpu_only,
+                      memory_autoscale       = arguments.memory_autoscale)
 
     p = subparsers.add_parser( "merge", help="Merger")
     p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory. A directory containing the files you wish to process.")
@@ -176,6 +188,7 @@ if __name__ == "__main__":
     p.add_argument('--force-model-name', dest="force_model_name", default=None, help="Forcing to choose model name from model/ folder.")
     p.add_argument('--cpu-only', action="store_true", dest="cpu_only", default=False, help="Merge on CPU.")
     p.add_argument('--force-gpu-idxs', dest="force_gpu_idxs", default=None, help="Force to choose GPU indexes separated by comma.")
+    p.add_argument('--memory-autoscale', action="store_true", dest="memory_autoscale", default=False, help="Pause workers while system memory is low and resume them when it is available.")
     p.set_defaults(func=process_merge)
 
     videoed_parser = subparsers.add_parser( "videoed", help="Video processing.").add_subparsers()
@@ -247,13 +260,15 @@ if __name__ == "__main__":
         from mainscripts import FacesetEnhancer
         FacesetEnhancer.process_folder ( Path(arguments.input_dir),
                                          cpu_only=arguments.cpu_only,
-                                         force_gpu_idxs=arguments.force_gpu_idxs
+                                         force_gpu_idxs=arguments.force_gpu_idxs,
+                                         memory_autoscale=arguments.memory_autoscale
                                        )
 
     p = facesettool_parser.add_parser ("enhance", help="Enhance details in DFL faceset.")
     p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of aligned faces.")
     p.add_argument('--cpu-only', action="store_true", dest="cpu_only", default=False, help="Process on CPU.")
     p.add_argument('--force-gpu-idxs', dest="force_gpu_idxs", default=None, help="Force to choose GPU indexes separated by comma.")
+    p.add_argument('--memory-autoscale', action="store_true", dest="memory_autoscale", default=False, help="Pause workers while system memory is low and resume them when it is available.")
 
     p.set_defaults(func=process_faceset_enhancer)
     
@@ -266,7 +281,59 @@ if __name__ == "__main__":
         from mainscripts import FacesetResizer
         FacesetResizer.process_folder ( Path(arguments.input_dir) )
     p.set_defaults(func=process_faceset_resizer)
-    
+
+    def process_faceset_append(arguments):
+        osex.set_process_lowest_prio()
+        from samplelib import PackedFaceset
+        PackedFaceset.append ( Path(arguments.input_dir), pathex.get_image_paths(arguments.faces_dir) )
+
+    p = facesettool_parser.add_parser ("append", help="Append faces to packed faceset.")
+    p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of packed faceset.")
+    p.add_argument('--faces-dir', required=True, action=fixPathAction, dest="faces_dir", help="Directory of aligned faces to append. Faces with the same filename are replaced.")
+    p.set_defaults(func=process_faceset_append)
+
+    def process_faceset_delete(arguments):
+        osex.set_process_lowest_prio()
+        from samplelib import PackedFaceset
+        PackedFaceset.delete ( Path(arguments.input_dir), [ Path(x).name for x in pathex.get_image_paths(arguments.faces_dir) ] )
+
+    p = facesettool_parser.add_parser ("delete", help="Delete faces from packed faceset.")
+    p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of packed faceset.")
+    p.add_argument('--faces-dir', required=True, action=fixPathAction, dest="faces_dir", help="Directory of faces with the filenames to delete, for example trash directory of sorter.")
+    p.set_defaults(func=process_faceset_delete)
+
+    def process_faceset_compact(arguments):
+        osex.set_process_lowest_prio()
+        from samplelib import PackedFaceset
+        PackedFaceset.compact ( Path(arguments.input_dir) )
+
+    p = facesettool_parser.add_parser ("compact", help="Remove deleted faces from packed faceset.")
+    p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of packed faceset.")
+    p.set_defaults(func=process_faceset_compact)
+
+    def process_faceset_shard(arguments):
+        osex.set_process_lowest_prio()
+        from samplelib import PackedFaceset
+        shards_dirs = [ Path(os.path.abspath(os.path.expanduser(x))) for x in arguments.shards_dirs ] if arguments.shards_dirs is not None else []
+        PackedFaceset.shard ( Path(arguments.input_dir), shards_dirs, arguments.shards_count )
+
+    p = facesettool_parser.add_parser ("shard", help="Split packed faceset to shards.")
+    p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of packed faceset.")
+    p.add_argument('--shards-count', type=int, required=True, dest="shards_count", help="Number of shards.")
+    p.add_argument('--shard-dir', action="append", dest="shards_dirs", default=None, help="Directory for shards, can be repeated to place the shards on different drives. Default is the input directory.")
+    p.set_defaults(func=process_faceset_shard)
+
+    def process_faceset_verify(arguments):
+        osex.set_process_lowest_prio()
+        from samplelib import PackedFaceset
+        samples = PackedFaceset.load ( Path(arguments.input_dir), verify=True )
+        if samples is not None:
+            io.log_info (f"{len(samples)} faces are valid.")
+
+    p = facesettool_parser.add_parser ("verify", help="Check integrity of packed faceset.")
+    p.add_argument('--input-dir', required=True, action=fixPathAction, dest="input_dir", help="Input directory of packed faceset.")
+    p.set_defaults(func=process_faceset_verify)
+
     def process_dev_test(arguments):
         osex.set_process_lowest_prio()
         from mainscripts import dev_misc
@@ -333,8 +400,12 @@ if __name__ == "__main__":
         parser.print_help()
         exit(0)
     parser.set_defaults(func=bad_args)
+    parser.add_argument('--telemetry-file', action=fixPathAction, dest="telemetry_file", default=None, help="Append per worker throughput and latency of jobs to this JSON lines file, summary is printed at the end of job.")
 
     arguments = parser.parse_args()
+    if arguments.telemetry_file is not None:
+        from core.joblib import Subprocessor
+        Subprocessor.telemetry_path = arguments.telemetry_file
     arguments.func(arguments)
 
     if exit_code == 0:
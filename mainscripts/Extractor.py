@@ -5,7 +5,9 @@ import operator
 import os
 import shutil
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -17,7 +19,7 @@ from core import imagelib
 from core import mathlib
 from facelib import FaceType, LandmarksProcessor
 from core.interact import interact as io
-from core.joblib import Subprocessor
+from core.joblib import JobJournal, Subprocessor
 from core.leras import nn
 from core import pathex
 from core.cv2ex import *
@@ -79,6 +81,62 @@ class ExtractSubprocessor(Subprocessor):
 
             self.cached_image = (None, None)
 
+            if self.type == 'all' or self.type == 'final':
+                self.file_writer = ThreadPoolExecutor(max_workers=2)
+                self.file_writer_futures = []
+                # futures of files written by current data
+                self.data_write_futures = []
+
+        #override
+        def on_finalize(self):
+            if self.type == 'all' or self.type == 'final':
+                self.wait_file_writes(0)
+                self.file_writer.shutdown()
+
+        def write_file(self, filepath, data):
+            # limit pending writes, so slow storage does not accumulate encoded faces in memory
+            self.wait_file_writes(16)
+            future = self.file_writer.submit(ExtractSubprocessor.Cli.write_file_func, filepath, data)
+            self.file_writer_futures.append ( (filepath, future) )
+            self.data_write_futures.append (future)
+
+        def journal_add_on_writes(self, key, outputs, futures):
+            """
+            records key as done in journal when all futures of its written outputs are completed successfully
+            """
+            if len(futures) == 0:
+                self.journal_add(key, outputs)
+                return
+
+            lock = threading.Lock()
+            pending = [len(futures)]
+            def on_done(future):
+                with lock:
+                    pending[0] -= 1
+                    if pending[0] != 0:
+                        return
+                if all ( f.exception() is None for f in futures ):
+                    self.journal_add(key, outputs)
+
+            for future in futures:
+                future.add_done_callback(on_done)
+
+        def wait_file_writes(self, max_pending):
+            while len(self.file_writer_futures) > max_pending:
+                filepath, future = self.file_writer_futures.pop(0)
+                try:
+                    future.result()
+                except:
+                    self.log_err (f'Failed to write {filepath}: {traceback.format_exc()}')
+
+        @staticmethod
+        def write_file_func(filepath, data):
+            # the face file appears complete or not at all, so outputs recorded in journal are valid after crash
+            tmp_filepath = filepath.parent / (filepath.name + '.tmp')
+            with open(tmp_filepath, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filepath, filepath)
+
         #override
         def process_data(self, data):
             if 'landmarks' in self.type and len(data.rects) == 0:
@@ -112,6 +170,7 @@ class ExtractSubprocessor(Subprocessor):
                                                                 )
 
             if self.type == 'final' or self.type == 'all':
+                self.data_write_futures = []
                 data = ExtractSubprocessor.Cli.final_stage(data=data,
                                                            image=image,
                                                            face_type=self.face_type,
@@ -119,7 +178,10 @@ class ExtractSubprocessor(Subprocessor):
                                                            jpeg_quality=self.jpeg_quality,
                                                            output_debug_path=self.output_debug_path,
                                                            final_output_path=self.final_output_path,
+                                                           write_func=self.write_file,
                                                            )
+                # key of get_journal_key of host
+                self.journal_add_on_writes(str(data.filepath), data.final_output_files, self.data_write_futures)
             return data
 
         @staticmethod
@@ -203,7 +265,15 @@ class ExtractSubprocessor(Subprocessor):
                         jpeg_quality,
                         output_debug_path=None,
                         final_output_path=None,
+                        write_func=None,
                         ):
+            """
+            write_func      func(filepath, bytes) used to write the face files,
+                            by default files are written synchronously
+            """
+            if write_func is None:
+                write_func = ExtractSubprocessor.Cli.write_file_func
+
             data.final_output_files = []
             filepath = data.filepath
             rects = data.rects
@@ -245,16 +315,19 @@ class ExtractSubprocessor(Subprocessor):
                     output_path = data.force_output_path
 
                 output_filepath = output_path / f"{filepath.stem}_{face_idx}.jpg"
-                cv2_imwrite(output_filepath, face_image, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality ] )
+                ret, buf = cv2.imencode('.jpg', face_image, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality ] )
+                if not ret:
+                    continue
 
-                dflimg = DFLJPG.load(output_filepath)
+                # embed metadata into the encoded buffer and write the file once
+                dflimg = DFLJPG.load(output_filepath, loader_func=lambda x: buf.tobytes() )
                 dflimg.set_face_type(FaceType.toString(face_type))
                 dflimg.set_landmarks(face_image_landmarks.tolist())
                 dflimg.set_source_filename(filepath.name)
                 dflimg.set_source_rect(rect)
                 dflimg.set_source_landmarks(image_landmarks.tolist())
                 dflimg.set_image_to_face_mat(image_to_face_mat)
-                dflimg.save()
+                write_func(output_filepath, dflimg.dump())
 
                 data.final_output_files.append (output_filepath)
                 face_idx += 1
@@ -304,7 +377,9 @@ class ExtractSubprocessor(Subprocessor):
         elif type == 'final':
             return [ (i, 'CPU', 'CPU%d' % (i), 0 ) for i in (range(min(8, multiprocessing.cpu_count())) if not DEBUG else [0]) ]
 
-    def __init__(self, input_data, type, image_size=None, jpeg_quality=None, face_type=None, output_debug_path=None, manual_window_size=0, max_faces_from_image=0, final_output_path=None, device_config=None):
+    journal_filename = 'extract.journal'
+
+    def __init__(self, input_data, type, image_size=None, jpeg_quality=None, face_type=None, output_debug_path=None, manual_window_size=0, max_faces_from_image=0, final_output_path=None, device_config=None, journal=None, memory_autoscale=False):
         if type == 'landmarks-manual':
             for x in input_data:
                 x.manual = True
@@ -324,7 +399,9 @@ class ExtractSubprocessor(Subprocessor):
         self.devices = ExtractSubprocessor.get_devices_for_config(self.type, device_config)
 
         super().__init__('Extractor', ExtractSubprocessor.Cli,
-                             999999 if type == 'landmarks-manual' or DEBUG else 120)
+                             999999 if type == 'landmarks-manual' or DEBUG else 120,
+                             journal=journal if type == 'all' or type == 'final' else None,
+                             memory_autoscale=memory_autoscale and type != 'landmarks-manual')
 
     #override
     def on_clients_initialized(self):
@@ -646,6 +723,22 @@ class ExtractSubprocessor(Subprocessor):
     def get_result(self):
         return self.result
 
+    #override
+    def get_journal_key(self, data):
+        return str(data.filepath)
+
+    #override
+    def get_journal_outputs(self, data, result):
+        # recorded by client when the files are written, see Cli.journal_add_on_writes
+        return None
+
+    #override
+    def on_journal_skip(self, host_dict, data, outputs):
+        data.final_output_files = [ Path(output) for output in outputs ]
+        data.faces_detected = len(outputs)
+        self.result.append ( data )
+        io.progress_bar_inc(1)
+
 
 class DeletedFilesSearcherSubprocessor(Subprocessor):
     class Cli(Subprocessor.Cli):
@@ -669,7 +762,7 @@ class DeletedFilesSearcherSubprocessor(Subprocessor):
         self.input_paths = input_paths
         self.debug_paths_stems = [ Path(d).stem for d in debug_paths]
         self.result = []
-        super().__init__('DeletedFilesSearcherSubprocessor', DeletedFilesSearcherSubprocessor.Cli, 60)
+        super().__init__('DeletedFilesSearcherSubprocessor', DeletedFilesSearcherSubprocessor.Cli, 60, chunk_size=0)
 
     #override
     def process_info_generator(self):
@@ -717,6 +810,7 @@ def main(detector=None,
          jpeg_quality=None,
          cpu_only = False,
          force_gpu_idxs = None,
+         memory_autoscale = False,
          ):
 
     if not input_path.exists():
@@ -741,12 +835,17 @@ def main(detector=None,
     output_images_paths = pathex.get_image_paths(output_path)
     output_debug_path = output_path.parent / (output_path.name + '_debug')
 
+    journal_path = output_path / ExtractSubprocessor.journal_filename
+
     continue_extraction = False
     if not manual_output_debug_fix and len(output_images_paths) > 0:
-        if len(output_images_paths) > 128:
+        if len(output_images_paths) > 128 or JobJournal.exists(journal_path):
             continue_extraction = io.input_bool ("Continue extraction?", True, help_message="Extraction can be continued, but you must specify the same options again.")
 
-        if len(output_images_paths) > 128 and continue_extraction:
+        if continue_extraction and JobJournal.exists(journal_path):
+            # done images are skipped by journal
+            pass
+        elif len(output_images_paths) > 128 and continue_extraction:
             try:
                 input_image_paths = input_image_paths[ [ Path(x).stem for x in input_image_paths ].index ( Path(output_images_paths[-128]).stem.split('_')[0] ) : ]
             except:
@@ -756,6 +855,8 @@ def main(detector=None,
                 io.input(f"\n WARNING !!! \n {output_path} contains files! \n They will be deleted. \n Press enter to continue.\n")
                 for filename in output_images_paths:
                     Path(filename).unlink()
+                if JobJournal.exists(journal_path):
+                    journal_path.unlink()
 
     device_config = nn.DeviceConfig.GPUIndexes( force_gpu_idxs or nn.ask_choose_device_idxs(choose_only_one=detector=='manual', suggest_all_gpu=True) ) \
                     if not cpu_only else nn.DeviceConfig.CPU()
@@ -804,15 +905,32 @@ def main(detector=None,
             for filename in pathex.get_image_paths(output_debug_path):
                 Path(filename).unlink()
 
+    journal = None
+    if not manual_output_debug_fix:
+        journal_existed = JobJournal.exists(journal_path)
+        journal = JobJournal(journal_path, config={'detector' : detector,
+                                                   'face_type' : face_type,
+                                                   'max_faces_from_image' : max_faces_from_image,
+                                                   'image_size' : image_size,
+                                                   'jpeg_quality' : jpeg_quality},
+                                 # faces deleted by user during extraction are not extracted again
+                                 check_outputs=False)
+        if continue_extraction and journal_existed and not journal.is_resumed:
+            io.log_info ("Options differ from the previous run, all images will be extracted again.")
+
     images_found = len(input_image_paths)
     faces_detected = 0
     if images_found != 0:
         if detector == 'manual':
             io.log_info ('Performing manual extract...')
-            data = ExtractSubprocessor ([ ExtractSubprocessor.Data(Path(filename)) for filename in input_image_paths ], 'landmarks-manual', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, manual_window_size=manual_window_size, device_config=device_config).run()
+            input_data = [ ExtractSubprocessor.Data(Path(filename)) for filename in input_image_paths ]
+            if journal is not None:
+                # manual pass is not repeated for images extracted in previous run
+                input_data = [ data for data in input_data if not journal.is_done(str(data.filepath)) ]
+            data = ExtractSubprocessor (input_data, 'landmarks-manual', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, manual_window_size=manual_window_size, device_config=device_config).run()
 
             io.log_info ('Performing 3rd pass...')
-            data = ExtractSubprocessor (data, 'final', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, final_output_path=output_path, device_config=device_config).run()
+            data = ExtractSubprocessor (data, 'final', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, final_output_path=output_path, device_config=device_config, journal=journal, memory_autoscale=memory_autoscale).run()
 
         else:
             io.log_info ('Extracting faces...')
@@ -824,7 +942,9 @@ def main(detector=None,
                                          output_debug_path if output_debug else None,
                                          max_faces_from_image=max_faces_from_image,
                                          final_output_path=output_path,
-                                         device_config=device_config).run()
+                                         device_config=device_config,
+                                         journal=journal,
+                                         memory_autoscale=memory_autoscale).run()
 
         faces_detected += sum([d.faces_detected for d in data])
 
@@ -835,9 +955,11 @@ def main(detector=None,
                 fix_data = [ ExtractSubprocessor.Data(d.filepath) for d in data if d.faces_detected == 0 ]
                 io.log_info ('Performing manual fix for %d images...' % (len(fix_data)) )
                 fix_data = ExtractSubprocessor (fix_data, 'landmarks-manual', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, manual_window_size=manual_window_size, device_config=device_config).run()
-                fix_data = ExtractSubprocessor (fix_data, 'final', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, final_output_path=output_path, device_config=device_config).run()
+                fix_data = ExtractSubprocessor (fix_data, 'final', image_size, jpeg_quality, face_type, output_debug_path if output_debug else None, final_output_path=output_path, device_config=device_config, memory_autoscale=memory_autoscale).run()
                 faces_detected += sum([d.faces_detected for d in fix_data])
 
+    if journal is not None:
+        journal.remove()
 
     io.log_info ('-------------------------')
     io.log_info ('Images found:        %d' % (images_found) )
@@ -3,7 +3,7 @@ import shutil
 
 from DFLIMG import *
 from core.interact import interact as io
-from core.joblib import Subprocessor
+from core.joblib import JobJournal, Subprocessor
 from core.leras import nn
 from core import pathex
 from core.cv2ex import *
@@ -12,14 +12,14 @@ from core.cv2ex import *
 class FacesetEnhancerSubprocessor(Subprocessor):
 
     #override
-    def __init__(self, image_paths, output_dirpath, device_config):
+    def __init__(self, image_paths, output_dirpath, device_config, journal=None, memory_autoscale=False):
         self.image_paths = image_paths
         self.output_dirpath = output_dirpath
         self.result = []
         self.nn_initialize_mp_lock = multiprocessing.Lock()
         self.devices = FacesetEnhancerSubprocessor.get_devices_for_config(device_config)
 
-        super().__init__('FacesetEnhancer', FacesetEnhancerSubprocessor.Cli, 600)
+        super().__init__('FacesetEnhancer', FacesetEnhancerSubprocessor.Cli, 600, journal=journal, memory_autoscale=memory_autoscale)
 
     #override
     def on_clients_initialized(self):
@@ -60,6 +60,19 @@ class FacesetEnhancerSubprocessor(Subprocessor):
     def get_result(self):
         return self.result
 
+    #override
+    def get_journal_key(self, data):
+        return str(data)
+
+    #override
+    def get_journal_outputs(self, data, result):
+        return [ result[2] ] if result[0] == 1 else None
+
+    #override
+    def on_journal_skip(self, host_dict, data, outputs):
+        io.progress_bar_inc(1)
+        self.result +=[ (data, Path(outputs[0])) ]
+
     @staticmethod
     def get_devices_for_config (device_config):
         devices = device_config.devices
@@ -122,7 +135,7 @@ class FacesetEnhancerSubprocessor(Subprocessor):
 
             return (0, filepath, None)
 
-def process_folder ( dirpath, cpu_only=False, force_gpu_idxs=None ):
+def process_folder ( dirpath, cpu_only=False, force_gpu_idxs=None, memory_autoscale=False ):
     device_config = nn.DeviceConfig.GPUIndexes( force_gpu_idxs or nn.ask_choose_device_idxs(suggest_all_gpu=True) ) \
                     if not cpu_only else nn.DeviceConfig.CPU()
 
@@ -134,13 +147,18 @@ def process_folder ( dirpath, cpu_only=False, force_gpu_idxs=None ):
     io.log_info (f"Enhancing faceset in {dirpath_parts}")
     io.log_info ( f"Processing to {output_dirpath_parts}")
 
-    output_images_paths = pathex.get_image_paths(output_dirpath)
-    if len(output_images_paths) > 0:
-        for filename in output_images_paths:
-            Path(filename).unlink()
+    journal = JobJournal(output_dirpath / 'enhance.journal', config={'input_dir' : dirpath})
+    if journal.is_resumed:
+        io.log_info (f"Continuing previous run, {len(journal)} files are already processed.")
+    else:
+        output_images_paths = pathex.get_image_paths(output_dirpath)
+        if len(output_images_paths) > 0:
+            for filename in output_images_paths:
+                Path(filename).unlink()
 
     image_paths = [Path(x) for x in pathex.get_image_paths( dirpath )]
-    result = FacesetEnhancerSubprocessor ( image_paths, output_dirpath, device_config=device_config).run()
+    result = FacesetEnhancerSubprocessor ( image_paths, output_dirpath, device_config=device_config, journal=journal, memory_autoscale=memory_autoscale).run()
+    journal.remove()
 
     is_merge = io.input_bool (f"\r\nMerge {output_dirpath_parts} to {dirpath_parts} ?", True)
     if is_merge:
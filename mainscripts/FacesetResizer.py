@@ -5,7 +5,7 @@ import cv2
 from core import pathex
 from core.cv2ex import *
 from core.interact import interact as io
-from core.joblib import Subprocessor
+from core.joblib import JobJournal, Subprocessor
 from DFLIMG import *
 from facelib import FaceType, LandmarksProcessor
 
@@ -13,14 +13,14 @@ from facelib import FaceType, LandmarksProcessor
 class FacesetResizerSubprocessor(Subprocessor):
 
     #override
-    def __init__(self, image_paths, output_dirpath, image_size, face_type=None):
+    def __init__(self, image_paths, output_dirpath, image_size, face_type=None, journal=None):
         self.image_paths = image_paths
         self.output_dirpath = output_dirpath
         self.image_size = image_size
         self.face_type = face_type
         self.result = []
 
-        super().__init__('FacesetResizer', FacesetResizerSubprocessor.Cli, 600)
+        super().__init__('FacesetResizer', FacesetResizerSubprocessor.Cli, 600, chunk_size=0, backend='thread', cv2_num_threads=1, journal=journal)
 
     #override
     def on_clients_initialized(self):
@@ -59,6 +59,19 @@ class FacesetResizerSubprocessor(Subprocessor):
     def get_result(self):
         return self.result
 
+    #override
+    def get_journal_key(self, data):
+        return str(data)
+
+    #override
+    def get_journal_outputs(self, data, result):
+        return [ result[2] ] if result[0] == 1 else None
+
+    #override
+    def on_journal_skip(self, host_dict, data, outputs):
+        io.progress_bar_inc(1)
+        self.result +=[ (data, Path(outputs[0])) ]
+
     class Cli(Subprocessor.Cli):
 
         #override
@@ -187,13 +200,18 @@ def process_folder ( dirpath):
     io.log_info (f"Resizing faceset in {dirpath_parts}")
     io.log_info ( f"Processing to {output_dirpath_parts}")
 
-    output_images_paths = pathex.get_image_paths(output_dirpath)
-    if len(output_images_paths) > 0:
-        for filename in output_images_paths:
-            Path(filename).unlink()
+    journal = JobJournal(output_dirpath / 'resize.journal', config={'input_dir' : dirpath, 'image_size' : image_size, 'face_type' : face_type})
+    if journal.is_resumed:
+        io.log_info (f"Continuing previous run, {len(journal)} files are already processed.")
+    else:
+        output_images_paths = pathex.get_image_paths(output_dirpath)
+        if len(output_images_paths) > 0:
+            for filename in output_images_paths:
+                Path(filename).unlink()
 
     image_paths = [Path(x) for x in pathex.get_image_paths( dirpath )]
-    result = FacesetResizerSubprocessor ( image_paths, output_dirpath, image_size, face_type).run()
+    result = FacesetResizerSubprocessor ( image_paths, output_dirpath, image_size, face_type, journal=journal).run()
+    journal.remove()
 
     is_merge = io.input_bool (f"\r\nMerge {output_dirpath_parts} to {dirpath_parts} ?", True)
     if is_merge:
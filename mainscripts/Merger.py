@@ -10,9 +10,9 @@ import samplelib
 from core import pathex
 from core.cv2ex import *
 from core.interact import interact as io
-from core.joblib import MPClassFuncOnDemand, MPFunc
+from core.joblib import JobJournal, MPClassFuncOnDemand, MPFunc
 from core.leras import nn
-from DFLIMG import DFLIMG
+from DFLIMG import DFLIMG, DFLIndex
 from facelib import FaceEnhancer, FaceType, LandmarksProcessor, XSegNet
 from merger import FrameInfo, InteractiveMergerSubprocessor, MergerConfig
 
@@ -26,7 +26,8 @@ def main (model_class_name=None,
           output_mask_path=None,
           aligned_path=None,
           force_gpu_idxs=None,
-          cpu_only=None):
+          cpu_only=None,
+          memory_autoscale=False):
     io.log_info ("Running merger.\r\n")
 
     try:
@@ -90,27 +91,37 @@ def main (model_class_name=None,
                 io.log_err(f"Error occured while loading samplelib.PackedFaceset.load {str(aligned_path)}, {traceback.format_exc()}")
 
 
+            def dflimg_alignment(filepath, dflimg):
+                if dflimg is None or not dflimg.has_data():
+                    io.log_err (f"{filepath.name} is not a dfl image file")
+                    return None
+                return dflimg.get_source_filename(), dflimg.get_source_landmarks()
+
             if packed_samples is not None:
                 io.log_info ("Using packed faceset.")
                 def generator():
                     for sample in io.progress_bar_generator( packed_samples, "Collecting alignments"):
                         filepath = Path(sample.filename)
-                        yield filepath, DFLIMG.load(filepath, loader_func=lambda x: sample.read_raw_file()  )
+                        yield filepath, dflimg_alignment(filepath, DFLIMG.load(filepath, loader_func=lambda x: sample.read_raw_file(), header_only=True ) )
             else:
                 def generator():
+                    index = DFLIndex.load(aligned_path)
                     for filepath in io.progress_bar_generator( pathex.get_image_paths(aligned_path), "Collecting alignments"):
                         filepath = Path(filepath)
-                        yield filepath, DFLIMG.load(filepath)
+                        idx = index.get_idx(filepath)
+                        if idx is not None:
+                            yield filepath, (index.get(idx, 'source_filename'), index.get(idx, 'source_landmarks') )
+                        else:
+                            yield filepath, dflimg_alignment(filepath, DFLIMG.load(filepath, header_only=True) )
 
             alignments = {}
             multiple_faces_detected = False
 
-            for filepath, dflimg in generator():
-                if dflimg is None or not dflimg.has_data():
-                    io.log_err (f"{filepath.name} is not a dfl image file")
+            for filepath, alignment in generator():
+                if alignment is None:
                     continue
 
-                source_filename = dflimg.get_source_filename()
+                source_filename, source_landmarks = alignment
                 if source_filename is None:
                     continue
 
@@ -121,7 +132,7 @@ def main (model_class_name=None,
                     alignments[ source_filename_stem ] = []
 
                 alignments_ar = alignments[ source_filename_stem ]
-                alignments_ar.append ( (dflimg.get_source_landmarks(), filepath, source_filepath ) )
+                alignments_ar.append ( (source_landmarks, filepath, source_filepath ) )
 
                 if len(alignments_ar) > 1:
                     multiple_faces_detected = True
@@ -192,6 +203,16 @@ def main (model_class_name=None,
             if False:
                 pass
             else:
+                journal = None
+                if not is_interactive:
+                    journal = JobJournal(output_path / 'merge.journal', config={'model' : model_class_name,
+                                                                                'model_iter' : model.get_iter(),
+                                                                                'cfg' : cfg.get_config(),
+                                                                                'input_dir' : input_path,
+                                                                                'frames_count' : len(frames) })
+                    if journal.is_resumed:
+                        io.log_info (f"Continuing previous merge, {len(journal)} frames are already merged.")
+
                 InteractiveMergerSubprocessor (
                             is_interactive         = is_interactive,
                             merger_session_filepath = model.get_strpath_storage_for_file('merger_session.dat'),
@@ -206,8 +227,13 @@ def main (model_class_name=None,
                             output_mask_path       = output_mask_path,
                             model_iter             = model.get_iter(),
                             subprocess_count       = subprocess_count,
+                            journal                = journal,
+                            memory_autoscale       = memory_autoscale,
                         ).run()
 
+                if journal is not None:
+                    journal.remove()
+
         model.finalize()
 
     except Exception as e:
@@ -29,7 +29,7 @@ class BlurEstimatorSubprocessor(Subprocessor):
         #override
         def process_data(self, data):
             filepath = Path( data[0] )
-            dflimg = DFLIMG.load (filepath)
+            dflimg = DFLIMG.load (filepath, header_only=True)
 
             if dflimg is None or not dflimg.has_data():
                 self.log_err (f"{filepath.name} is not a dfl image file")
@@ -60,7 +60,7 @@ class BlurEstimatorSubprocessor(Subprocessor):
         self.estimate_motion_blur = estimate_motion_blur
         self.img_list = []
         self.trash_img_list = []
-        super().__init__('BlurEstimator', BlurEstimatorSubprocessor.Cli, 60)
+        super().__init__('BlurEstimator', BlurEstimatorSubprocessor.Cli, 60, chunk_size=0)
 
     #override
     def on_clients_initialized(self):
@@ -132,7 +132,7 @@ def sort_by_face_yaw(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Loading"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         if dflimg is None or not dflimg.has_data():
             io.log_err (f"{filepath.name} is not a dfl image file")
@@ -155,7 +155,7 @@ def sort_by_face_pitch(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Loading"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         if dflimg is None or not dflimg.has_data():
             io.log_err (f"{filepath.name} is not a dfl image file")
@@ -178,7 +178,7 @@ def sort_by_face_source_rect_size(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Loading"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         if dflimg is None or not dflimg.has_data():
             io.log_err (f"{filepath.name} is not a dfl image file")
@@ -362,7 +362,7 @@ def sort_by_hist_dissim(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Loading"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         image = cv2_imread(str(filepath))
 
@@ -414,7 +414,7 @@ def sort_by_origname(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Loading"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         if dflimg is None or not dflimg.has_data():
             io.log_err (f"{filepath.name} is not a dfl image file")
@@ -457,7 +457,7 @@ class FinalLoaderSubprocessor(Subprocessor):
             filepath = Path(data[0])
 
             try:
-                dflimg = DFLIMG.load (filepath)
+                dflimg = DFLIMG.load (filepath, header_only=True)
 
                 if dflimg is None or not dflimg.has_data():
                     self.log_err (f"{filepath.name} is not a dfl image file")
@@ -497,7 +497,7 @@ class FinalLoaderSubprocessor(Subprocessor):
         self.result = []
         self.result_trash = []
 
-        super().__init__('FinalLoader', FinalLoaderSubprocessor.Cli, 60)
+        super().__init__('FinalLoader', FinalLoaderSubprocessor.Cli, 60, chunk_size=0)
 
     #override
     def on_clients_initialized(self):
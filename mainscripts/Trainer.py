@@ -162,6 +162,11 @@ def trainerThread (s2c, c2s, e,
 
                             io.log_info(loss_string)
 
+                            for generator in model.get_training_data_generators() or []:
+                                stats_text = generator.get_stats_text()
+                                if stats_text is not None:
+                                    io.log_info(stats_text)
+
                             save_iter = iter
                         else:
                             for loss_value in loss_history[-1]:
@@ -20,7 +20,7 @@ def save_faceset_metadata_folder(input_path):
     d = {}
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Processing"):
         filepath = Path(filepath)
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
         if dflimg is None or not dflimg.has_data():
             io.log_info(f"{filepath} is not a dfl image file")
             continue
@@ -77,6 +77,23 @@ def restore_faceset_metadata_folder(input_path):
 
     metadata_filepath.unlink()
 
+def convert_faceset_metadata_folder(input_path):
+    input_path = Path(input_path)
+    io.log_info ("Converting faceset metadata to the binary format...\r\n")
+
+    files_converted = 0
+    for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path, image_extensions=['.jpg'], return_Path_class=True), "Processing"):
+        dflimg = DFLIMG.load (filepath, header_only=True)
+        if dflimg is None or not dflimg.has_data():
+            io.log_info(f"{filepath} is not a dfl image file")
+            continue
+
+        if dflimg.has_pickled_dict():
+            dflimg.save()
+            files_converted += 1
+
+    io.log_info(f"Files converted: {files_converted}")
+
 def add_landmarks_debug_images(input_path):
     io.log_info ("Adding landmarks debug images...")
 
@@ -113,7 +130,7 @@ def recover_original_aligned_filename(input_path):
     for filepath in io.progress_bar_generator( pathex.get_image_paths(input_path), "Processing"):
         filepath = Path(filepath)
 
-        dflimg = DFLIMG.load (filepath)
+        dflimg = DFLIMG.load (filepath, header_only=True)
 
         if dflimg is None or not dflimg.has_data():
             io.log_err (f"{filepath.name} is not a dfl image file")
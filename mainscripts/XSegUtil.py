@@ -116,7 +116,7 @@ def fetch_xseg(input_path):
     
     files_copied = []
     for filepath in io.progress_bar_generator(images_paths, "Processing"):
-        dflimg = DFLIMG.load(filepath)
+        dflimg = DFLIMG.load(filepath, header_only=True)
         if dflimg is None or not dflimg.has_data():
             io.log_info(f'{filepath} is not a DFLIMG')
             continue
@@ -149,7 +149,7 @@ def remove_xseg(input_path):
     
     files_processed = 0
     for filepath in io.progress_bar_generator(images_paths, "Processing"):
-        dflimg = DFLIMG.load(filepath)
+        dflimg = DFLIMG.load(filepath, header_only=True)
         if dflimg is None or not dflimg.has_data():
             io.log_info(f'{filepath} is not a DFLIMG')
             continue
@@ -174,7 +174,7 @@ def remove_xseg_labels(input_path):
     
     files_processed = 0
     for filepath in io.progress_bar_generator(images_paths, "Processing"):
-        dflimg = DFLIMG.load(filepath)
+        dflimg = DFLIMG.load(filepath, header_only=True)
         if dflimg is None or not dflimg.has_data():
             io.log_info(f'{filepath} is not a DFLIMG')
             continue
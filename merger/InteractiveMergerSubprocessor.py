@@ -2,6 +2,7 @@ import multiprocessing
 import os
 import pickle
 import sys
+import time
 import traceback
 from pathlib import Path
 
@@ -96,13 +97,17 @@ class InteractiveMergerSubprocessor(Subprocessor):
                     h,w,c = img_bgr.shape
                     img_mask = np.zeros( (h,w,1), dtype=img_bgr.dtype)
                     
+                t = time.perf_counter()
                 cv2_imwrite (pf.output_filepath, img_bgr)
                 cv2_imwrite (pf.output_mask_filepath, img_mask)
+                self.add_section_time('write', time.perf_counter()-t)
 
                 if pf.need_return_image:
                     pf.image = np.concatenate ([img_bgr, img_mask], axis=-1)
 
             else:
+                t = time.perf_counter()
+                predict_time = self.predictor_func.call_time
                 if cfg.type == MergerConfig.TYPE_MASKED:
                     try:
                         final_img = MergeMasked (self.predictor_func, self.predictor_input_shape,
@@ -122,9 +127,14 @@ class InteractiveMergerSubprocessor(Subprocessor):
                                                    cfg, pf.prev_temporal_frame_infos,
                                                         pf.frame_info,
                                                         pf.next_temporal_frame_infos )
+                predict_time = self.predictor_func.call_time - predict_time
+                self.add_section_time('predict', predict_time)
+                self.add_section_time('merge', time.perf_counter()-t-predict_time)
 
+                t = time.perf_counter()
                 cv2_imwrite (pf.output_filepath,      final_img[...,0:3] )
                 cv2_imwrite (pf.output_mask_filepath, final_img[...,3:4] )
+                self.add_section_time('write', time.perf_counter()-t)
 
                 if pf.need_return_image:
                     pf.image = final_img
@@ -140,11 +150,14 @@ class InteractiveMergerSubprocessor(Subprocessor):
 
 
     #override
-    def __init__(self, is_interactive, merger_session_filepath, predictor_func, predictor_input_shape, face_enhancer_func, xseg_256_extract_func, merger_config, frames, frames_root_path, output_path, output_mask_path, model_iter, subprocess_count=4):
+    def __init__(self, is_interactive, merger_session_filepath, predictor_func, predictor_input_shape, face_enhancer_func, xseg_256_extract_func, merger_config, frames, frames_root_path, output_path, output_mask_path, model_iter, subprocess_count=4, journal=None, memory_autoscale=False):
+        """
+        journal     optional JobJournal of non interactive merge, merged frames of previous run are not merged again
+        """
         if len (frames) == 0:
             raise ValueError ("len (frames) == 0")
 
-        super().__init__('Merger', InteractiveMergerSubprocessor.Cli, io_loop_sleep_time=0.001)
+        super().__init__('Merger', InteractiveMergerSubprocessor.Cli, io_loop_sleep_time=0.001, journal=journal, memory_autoscale=memory_autoscale)
 
         self.is_interactive = is_interactive
         self.merger_session_filepath = Path(merger_session_filepath)
@@ -231,7 +244,7 @@ class InteractiveMergerSubprocessor(Subprocessor):
             if not frames_equal:
                 session_data = None
 
-        if session_data is None:
+        if session_data is None and not (journal is not None and journal.is_resumed):
             for filename in pathex.get_image_paths(self.output_path): #remove all images in output_path
                 Path(filename).unlink()
 
@@ -571,4 +584,18 @@ class InteractiveMergerSubprocessor(Subprocessor):
 
     #override
     def get_result(self):
-        return 0
\ No newline at end of file
+        return 0
+
+    #override
+    def get_journal_key(self, pf):
+        return str(pf.frame_info.filepath)
+
+    #override
+    def get_journal_outputs(self, pf_sent, pf_result):
+        return [pf_result.output_filepath, pf_result.output_mask_filepath]
+
+    #override
+    def on_journal_skip(self, host_dict, pf, outputs):
+        frame = self.frames[pf.idx]
+        frame.is_processing = False
+        frame.is_done = True
\ No newline at end of file
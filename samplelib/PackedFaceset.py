@@ -1,17 +1,54 @@
+import mmap
+import multiprocessing
+import os
 import pickle
 import shutil
 import struct
+import traceback
+import zlib
 from pathlib import Path
 
+import cv2
+import numpy as np
+
 import samplelib.SampleLoader
+from core import imagelib
+from core.cv2ex import *
 from core.interact import interact as io
+from core.joblib import Subprocessor
+from DFLIMG import DFLIMG
+from facelib import FaceType
 from samplelib import Sample
 from core import pathex
 
+from .Sample import SampleType
+from .SampleImageCache import SampleImageCache
+
 packed_faceset_filename = 'faceset.pak'
+shards_manifest_filename = 'faceset.shards'
+
+def get_pixel_cache_filename(resolution):
+    return f'{packed_faceset_filename}.{resolution}.px'
 
 class PackedFaceset():
-    VERSION = 1
+    """
+    version 2 layout:
+        version, index offset, index size
+        sample files, appended
+        index segment, pickled dict, see load_index()
+
+    append() and delete() write a new index segment at the end of file,
+    compact() rewrites the file without deleted samples.
+    Version 1 files are readable and converted by append(), delete() and compact().
+
+    A sharded faceset has faceset.shards instead of faceset.pak,
+    a text file with a path of packed shard per line, relative to the faceset directory or absolute.
+    Shards are written by shard() and can be placed on different drives.
+    """
+    VERSION = 2
+
+    # filename : (pid, mmap) of the packed files opened by this process
+    mmaps = {}
 
     @staticmethod
     def pack(samples_path):
@@ -34,62 +71,29 @@ class PackedFaceset():
         else:
             image_paths = pathex.get_image_paths(samples_path)
 
-        samples = samplelib.SampleLoader.load_face_samples(image_paths)
-        samples_len = len(samples)
-
-        samples_configs = []
-        for sample in io.progress_bar_generator (samples, "Processing"):
-            sample_filepath = Path(sample.filename)
-            sample.filename = sample_filepath.name
-
-            if as_person_faceset:
-                sample.person_name = sample_filepath.parent.name
-            samples_configs.append ( sample.get_config() )
-        samples_bytes = pickle.dumps(samples_configs, 4)
-
-        of = open(samples_dat_path, "wb")
-        of.write ( struct.pack ("Q", PackedFaceset.VERSION ) )
-        of.write ( struct.pack ("Q", len(samples_bytes) ) )
-        of.write ( samples_bytes )
-
-        del samples_bytes   #just free mem
-        del samples_configs
-
-        sample_data_table_offset = of.tell()
-        of.write ( bytes( 8*(samples_len+1) ) ) #sample data offset table
-
-        data_start_offset = of.tell()
-        offsets = []
-
-        for sample in io.progress_bar_generator(samples, "Packing"):
-            try:
-                if sample.person_name is not None:
-                    sample_path = samples_path / sample.person_name / sample.filename
-                else:
-                    sample_path = samples_path / sample.filename
-
-
-                with open(sample_path, "rb") as f:
-                   b = f.read()
-
-                offsets.append ( of.tell() - data_start_offset )
-                of.write(b)
-            except:
-                raise Exception(f"error while processing sample {sample_path}")
+        PackedFaceset.close_mmaps()
+        with open(samples_dat_path, "wb") as of:
+            of.write ( struct.pack ("QQQ", PackedFaceset.VERSION, 0, 0 ) )
+            packer = PackSubprocessor(image_paths, of, as_person_faceset)
+            index = packer.run()
+            if packer.is_completed():
+                PackedFaceset.write_index(of, index)
+
+        if not packer.is_completed():
+            samples_dat_path.unlink()
+            io.log_err(f"Packing is not completed, {packer.next_write_idx} of {len(image_paths)} files are processed. Original files are kept.")
+            return
 
-        offsets.append ( of.tell() )
+        pixel_cache_resolution = io.input_int("Resolution of pre-decoded pixel cache", 0, help_message="Stores the faces decoded and resized to the training resolution of the model next to the packed faceset. Removes jpeg decoding from training at the cost of disk space. Used only by models of the face type of the faceset. 0 - no cache")
+        if pixel_cache_resolution != 0:
+            PackedFaceset.pack_pixel_cache(samples_path, pixel_cache_resolution)
 
-        of.seek(sample_data_table_offset, 0)
-        for offset in offsets:
-            of.write ( struct.pack("Q", offset) )
-        of.seek(0,2)
-        of.close()
-        
         if io.input_bool(f"Delete original files?", True):
-            for filename in io.progress_bar_generator(image_paths, "Deleting files"):
+            # skipped files are kept
+            for filename in io.progress_bar_generator(packer.packed_paths, "Deleting files"):
                 Path(filename).unlink()
 
-            if as_person_faceset:
+            if as_person_faceset and len(packer.packed_paths) == len(image_paths):
                 for dir_name in io.progress_bar_generator(dir_names, "Deleting dirs"):
                     dir_path = samples_path / dir_name
                     try:
@@ -100,7 +104,8 @@ class PackedFaceset():
     @staticmethod
     def unpack(samples_path):
         samples_dat_path = samples_path / packed_faceset_filename
-        if not samples_dat_path.exists():
+        shards_paths = PackedFaceset.get_shards_paths(samples_path)
+        if shards_paths is None and not samples_dat_path.exists():
             io.log_info(f"{samples_dat_path} : file not found.")
             return
 
@@ -119,38 +124,586 @@ class PackedFaceset():
             with open(target_filepath, "wb") as f:
                 f.write( sample.read_raw_file() )
 
-        samples_dat_path.unlink()
+        PackedFaceset.close_mmaps()
+        if shards_paths is not None:
+            for shard_path in shards_paths:
+                shard_path.unlink()
+            (samples_path / shards_manifest_filename).unlink()
+        else:
+            samples_dat_path.unlink()
+
+        for pixel_cache_path in samples_path.glob( get_pixel_cache_filename('*') ):
+            pixel_cache_path.unlink()
+
+    @staticmethod
+    def get_mmap(filename):
+        """
+        returns read-only mmap of the packed file.
+
+        The file is mapped once per process, a mapping inherited by fork is not reused.
+        """
+        pid = os.getpid()
+        pid_mm = PackedFaceset.mmaps.get(filename, None)
+        if pid_mm is None or pid_mm[0] != pid:
+            with open(filename, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_RANDOM'):
+                # samples are read in random order, disable readahead
+                mm.madvise(mmap.MADV_RANDOM)
+
+            pid_mm = PackedFaceset.mmaps[filename] = (pid, mm)
+        return pid_mm[1]
+
+    @staticmethod
+    def close_mmaps():
+        pid = os.getpid()
+        for pid_mm in PackedFaceset.mmaps.values():
+            if pid_mm[0] == pid:
+                pid_mm[1].close()
+        PackedFaceset.mmaps = {}
+
+    @staticmethod
+    def prefetch(filename):
+        """
+        asks the OS to read the packed file into page cache in background
+        """
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
 
     @staticmethod
     def path_contains(samples_path):
         samples_dat_path = samples_path / packed_faceset_filename
-        return samples_dat_path.exists()
+        return samples_dat_path.exists() or (samples_path / shards_manifest_filename).exists()
+
+    @staticmethod
+    def get_shards_paths(samples_path):
+        """
+        returns list of shard paths of sharded faceset, or None if the faceset is not sharded
+        """
+        manifest_path = samples_path / shards_manifest_filename
+        if not manifest_path.exists():
+            return None
+
+        shards_paths = []
+        for line in manifest_path.read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+            if len(line) != 0:
+                shards_paths.append ( samples_path / line )
+        return shards_paths
+
+    @staticmethod
+    def get_shards_lens(samples_path):
+        """
+        returns list of samples count of each shard, in order of samples of load(),
+        or None if the faceset is not sharded
+        """
+        shards_paths = PackedFaceset.get_shards_paths(samples_path)
+        if shards_paths is None:
+            return None
+
+        shards_lens = []
+        for shard_path in shards_paths:
+            _, index = PackedFaceset.load_index(shard_path)
+            shards_lens.append ( index['deleted'].count(False) )
+        return shards_lens
     
     @staticmethod
-    def load(samples_path):
+    def write_index(f, index):
+        """
+        appends index segment to the end of file opened for writing and points the header to it.
+
+        The previous index segment is left in place, so the file stays valid if writing is interrupted.
+        Every written index gets new random 'index_id', so caches of the file recognize any change of it.
+        """
+        index['index_id'] = struct.unpack("Q", os.urandom(8) )[0]
+        f.seek(0, 2)
+        index_offset = f.tell()
+        index_bytes = pickle.dumps(index, 4)
+        f.write(index_bytes)
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(8, 0)
+        f.write ( struct.pack ("QQ", index_offset, len(index_bytes) ) )
+        f.flush()
+
+    @staticmethod
+    def load_index(samples_dat_path):
+        """
+        returns version, index of the packed file.
+
+        index
+            samples_configs, offsets, sizes, deleted   lists of all samples, including tombstoned
+            crcs                                       list of crc32 of sample data, None for version 1 files
+            index_id                                   id of the index segment, see write_index
+        """
+        with open(samples_dat_path, "rb") as f:
+            version, = struct.unpack("Q", f.read(8) )
+
+            if version == 1:
+                sizeof_samples_bytes, = struct.unpack("Q", f.read(8) )
+                samples_configs = pickle.loads ( f.read(sizeof_samples_bytes) )
+                samples_len = len(samples_configs)
+
+                offsets = [ struct.unpack("Q", f.read(8) )[0] for _ in range(samples_len+1) ]
+                data_start_offset = f.tell()
+
+                index = {'samples_configs' : samples_configs,
+                         'offsets' : [ data_start_offset+offsets[i] for i in range(samples_len) ],
+                         'sizes' : [ offsets[i+1]-offsets[i] for i in range(samples_len) ],
+                         'deleted' : [False]*samples_len,
+                         'crcs' : [None]*samples_len }
+            elif version == 2:
+                index_offset, index_size = struct.unpack("QQ", f.read(16) )
+                f.seek(index_offset, 0)
+                index = pickle.loads ( f.read(index_size) )
+            else:
+                raise NotImplementedError
+
+        if 'index_id' not in index:
+            # file written before index_id, its mtime changes on every write
+            index['index_id'] = os.stat(samples_dat_path).st_mtime_ns
+
+        return version, index
+
+    @staticmethod
+    def load(samples_path, verify=False):
+        """
+        returns samples of packed or sharded faceset, or None if there is no packed faceset
+
+        verify      check crc of sample data, corrupted samples are skipped
+        """
+        shards_paths = PackedFaceset.get_shards_paths(samples_path)
+        if shards_paths is not None:
+            samples = []
+            for shard_path in shards_paths:
+                samples += PackedFaceset.load_file(shard_path, verify=verify)
+            return samples
+
         samples_dat_path = samples_path / packed_faceset_filename
         if not samples_dat_path.exists():
             return None
+        return PackedFaceset.load_file(samples_dat_path, verify=verify)
 
-        f = open(samples_dat_path, "rb")
-        version, = struct.unpack("Q", f.read(8) )
-        if version != PackedFaceset.VERSION:
-            raise NotImplementedError
+    @staticmethod
+    def load_file(samples_dat_path, verify=False):
+        """
+        returns samples of the packed file
+        """
+        _, index = PackedFaceset.load_index(samples_dat_path)
 
-        sizeof_samples_bytes, = struct.unpack("Q", f.read(8) )
+        if verify:
+            mm = memoryview( PackedFaceset.get_mmap(str(samples_dat_path)) )
+
+        entries = zip(index['samples_configs'], index['offsets'], index['sizes'], index['deleted'], index['crcs'])
+        if verify:
+            entries = io.progress_bar_generator( list(entries), "Verifying")
 
-        samples_configs = pickle.loads ( f.read(sizeof_samples_bytes) )
         samples = []
-        for sample_config in samples_configs:
+        for sample_config, offset, size, deleted, crc in entries:
+            if deleted:
+                continue
+
+            if verify and crc is not None and zlib.crc32(mm[offset:offset+size]) != crc:
+                io.log_err(f"{sample_config['filename']} is corrupted in {samples_dat_path}")
+                continue
             sample_config = pickle.loads(pickle.dumps (sample_config))
-            samples.append ( Sample (**sample_config) )
+            sample = Sample (**sample_config)
+            sample.set_filename_offset_size( str(samples_dat_path), offset, size )
+            samples.append (sample)
+
+        return samples
 
-        offsets = [ struct.unpack("Q", f.read(8) )[0] for _ in range(len(samples)+1) ]
-        data_start_offset = f.tell()
-        f.close()
+    @staticmethod
+    def append(samples_path, image_paths):
+        """
+        appends faces to the packed faceset.
+        Samples with the same filename are replaced.
+        """
+        samples_dat_path = samples_path / packed_faceset_filename
+        if not samples_dat_path.exists():
+            io.log_info(f"{samples_dat_path} : file not found.")
+            return
 
-        for i, sample in enumerate(samples):
-            start_offset, end_offset = offsets[i], offsets[i+1]
-            sample.set_filename_offset_size( str(samples_dat_path), data_start_offset+start_offset, end_offset-start_offset )
+        version, _ = PackedFaceset.load_index(samples_dat_path)
+        if version != PackedFaceset.VERSION:
+            io.log_info(f"Converting {samples_dat_path} to version {PackedFaceset.VERSION}.")
+            PackedFaceset.compact(samples_path)
+        _, index = PackedFaceset.load_index(samples_dat_path)
 
-        return samples
+        samples = samplelib.SampleLoader.load_face_samples(image_paths)
+
+        filename_to_idx = { (config['person_name'], config['filename']) : i for i, config in enumerate(index['samples_configs']) if not index['deleted'][i] }
+
+        PackedFaceset.close_mmaps()
+        with open(samples_dat_path, "r+b") as of:
+            for sample in io.progress_bar_generator(samples, "Appending"):
+                sample_path = Path(sample.filename)
+                sample.filename = sample_path.name
+
+                idx = filename_to_idx.get( (sample.person_name, sample.filename), None)
+                if idx is not None:
+                    index['deleted'][idx] = True
+
+                b = sample_path.read_bytes()
+                of.seek(0, 2)
+                index['samples_configs'].append ( sample.get_config() )
+                index['offsets'].append ( of.tell() )
+                index['sizes'].append ( len(b) )
+                index['deleted'].append (False)
+                index['crcs'].append ( zlib.crc32(b) )
+                of.write(b)
+
+            PackedFaceset.write_index(of, index)
+
+        io.log_info(f"Appended {len(samples)} faces.")
+
+    @staticmethod
+    def delete(samples_path, filenames):
+        """
+        marks samples with filenames as deleted, the data is removed by compact()
+        """
+        samples_dat_path = samples_path / packed_faceset_filename
+        if not samples_dat_path.exists():
+            io.log_info(f"{samples_dat_path} : file not found.")
+            return
+
+        version, _ = PackedFaceset.load_index(samples_dat_path)
+        if version != PackedFaceset.VERSION:
+            io.log_info(f"Converting {samples_dat_path} to version {PackedFaceset.VERSION}.")
+            PackedFaceset.compact(samples_path)
+        _, index = PackedFaceset.load_index(samples_dat_path)
+
+        filenames = set(filenames)
+        deleted_count = 0
+        for i, config in enumerate(index['samples_configs']):
+            if not index['deleted'][i] and config['filename'] in filenames:
+                index['deleted'][i] = True
+                deleted_count += 1
+
+        if deleted_count != 0:
+            PackedFaceset.close_mmaps()
+            with open(samples_dat_path, "r+b") as of:
+                PackedFaceset.write_index(of, index)
+
+        io.log_info(f"Deleted {deleted_count} faces.")
+
+    @staticmethod
+    def compact(samples_path):
+        """
+        rewrites the packed faceset without deleted samples and stale index segments.
+
+        The new file is written next to the old one and replaces it when complete.
+        """
+        samples_dat_path = samples_path / packed_faceset_filename
+        if not samples_dat_path.exists():
+            io.log_info(f"{samples_dat_path} : file not found.")
+            return
+
+        _, index = PackedFaceset.load_index(samples_dat_path)
+        live_idxs = [ i for i, deleted in enumerate(index['deleted']) if not deleted ]
+
+        samples_tmp_path = samples_path / (packed_faceset_filename + '.tmp')
+        PackedFaceset.write_file(samples_dat_path, index, live_idxs, samples_tmp_path, "Compacting")
+
+        PackedFaceset.close_mmaps()
+        os.replace(samples_tmp_path, samples_dat_path)
+
+    @staticmethod
+    def write_file(samples_dat_path, index, idxs, output_path, desc):
+        """
+        writes samples idxs of the packed file with index to a new packed file
+        """
+        new_index = {'samples_configs' : [],
+                     'offsets' : [],
+                     'sizes' : [],
+                     'deleted' : [False]*len(idxs),
+                     'crcs' : [] }
+
+        with open(samples_dat_path, "rb") as f, open(output_path, "wb") as of:
+            of.write ( struct.pack ("QQQ", PackedFaceset.VERSION, 0, 0 ) )
+
+            for i in io.progress_bar_generator(idxs, desc):
+                f.seek(index['offsets'][i], 0)
+                b = f.read(index['sizes'][i])
+
+                crc = zlib.crc32(b)
+                if index['crcs'][i] is not None and index['crcs'][i] != crc:
+                    io.log_err(f"{index['samples_configs'][i]['filename']} is corrupted in {samples_dat_path}")
+
+                new_index['samples_configs'].append ( index['samples_configs'][i] )
+                new_index['crcs'].append ( crc )
+                new_index['offsets'].append ( of.tell() )
+                new_index['sizes'].append ( len(b) )
+                of.write(b)
+
+            PackedFaceset.write_index(of, new_index)
+
+    @staticmethod
+    def shard(samples_path, shards_dirs, shards_count):
+        """
+        splits faceset.pak into shards_count packed shards placed in shards_dirs in turn,
+        and replaces it with faceset.shards manifest
+        """
+        samples_dat_path = samples_path / packed_faceset_filename
+        if not samples_dat_path.exists():
+            io.log_info(f"{samples_dat_path} : file not found.")
+            return
+
+        if len(shards_dirs) == 0:
+            shards_dirs = [samples_path]
+
+        _, index = PackedFaceset.load_index(samples_dat_path)
+        live_idxs = [ i for i, deleted in enumerate(index['deleted']) if not deleted ]
+        shards_count = max(1, min(shards_count, len(live_idxs)) )
+
+        # samples of the shard are contiguous, so persons are not spread over all shards
+        shards_paths = []
+        for shard_id in range(shards_count):
+            shard_dir = Path(shards_dirs[shard_id % len(shards_dirs)])
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            shard_path = shard_dir / f'{samples_path.name}.{shard_id}.pak'
+
+            shard_idxs = live_idxs[ shard_id*len(live_idxs) // shards_count : (shard_id+1)*len(live_idxs) // shards_count ]
+            PackedFaceset.write_file(samples_dat_path, index, shard_idxs, shard_path, f"Writing shard {shard_id+1}/{shards_count}")
+            shards_paths.append(shard_path)
+
+        manifest = []
+        for shard_path in shards_paths:
+            try:
+                manifest.append ( str(shard_path.relative_to(samples_path)) )
+            except ValueError:
+                manifest.append ( str(shard_path.resolve()) )
+        pathex.write_bytes_safe (samples_path / shards_manifest_filename, ("\n".join(manifest)+"\n").encode('utf-8') )
+
+        PackedFaceset.close_mmaps()
+        samples_dat_path.unlink()
+        for pixel_cache_path in samples_path.glob( get_pixel_cache_filename('*') ):
+            pixel_cache_path.unlink()
+
+        io.log_info(f"{len(live_idxs)} faces are written to {shards_count} shards.")
+
+    @staticmethod
+    def pack_pixel_cache(samples_path, resolution):
+        """
+        writes decoded faces of the packed faceset resized to resolution x resolution,
+        with the decoded xseg mask if the sample has one.
+
+        file layout:
+            version, samples count, resolution, index_id of faceset.pak
+            offset table of sample blocks, samples count+1 entries
+            sample blocks: uint8 BGR pixels [, uint8 mask pixels]
+        """
+        samples_dat_path = samples_path / packed_faceset_filename
+        samples = PackedFaceset.load(samples_path)
+        if samples is None:
+            io.log_info(f"{samples_dat_path} : file not found.")
+            return
+
+        _, index = PackedFaceset.load_index(samples_dat_path)
+
+        samples_len = len(samples)
+        with open(samples_path / get_pixel_cache_filename(resolution), "wb") as of:
+            of.write ( struct.pack ("QQQQ", PackedFacesetPixelCache.VERSION, samples_len, resolution, index['index_id'] ) )
+
+            sample_data_table_offset = of.tell()
+            of.write ( bytes( 8*(samples_len+1) ) )
+            data_start_offset = of.tell()
+
+            offsets = []
+            for sample in io.progress_bar_generator(samples, "Caching pixels"):
+                offsets.append ( of.tell() - data_start_offset )
+
+                img, mask = SampleImageCache.decode_sample(sample, resolution)
+                of.write ( np.ascontiguousarray(img).tobytes() )
+                if mask is not None:
+                    of.write ( np.ascontiguousarray(mask).tobytes() )
+            offsets.append ( of.tell() - data_start_offset )
+
+            of.seek(sample_data_table_offset, 0)
+            of.write ( np.array(offsets, np.uint64).tobytes() )
+
+        PackedFaceset.close_mmaps()
+
+    @staticmethod
+    def load_pixel_cache(samples_path, resolution):
+        """
+        returns PackedFacesetPixelCache of resolution, or None if there is no valid cache
+        """
+        pixel_cache_path = samples_path / get_pixel_cache_filename(resolution)
+        samples_dat_path = samples_path / packed_faceset_filename
+        if not pixel_cache_path.exists() or not samples_dat_path.exists():
+            return None
+
+        with open(pixel_cache_path, "rb") as f:
+            version, samples_len, cache_resolution, index_id = struct.unpack ("QQQQ", f.read(32) )
+            if version != PackedFacesetPixelCache.VERSION or cache_resolution != resolution:
+                return None
+
+            _, index = PackedFaceset.load_index(samples_dat_path)
+            if index_id != index['index_id']:
+                io.log_info(f"{pixel_cache_path} does not match {samples_dat_path} and will not be used.")
+                return None
+
+            offsets = np.frombuffer( f.read( 8*(samples_len+1) ), np.uint64 ).astype(np.int64)
+            data_start_offset = f.tell()
+
+        return PackedFacesetPixelCache( str(pixel_cache_path), resolution, offsets+data_start_offset )
+
+class PackedFacesetPixelCache():
+    """
+    Pre-decoded pixels of the samples of a packed faceset, indexed as the samples of PackedFaceset.load
+    """
+    VERSION = 2
+
+    def __init__(self, filename, resolution, offsets):
+        self.filename = filename
+        self.resolution = resolution
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def get(self, idx):
+        """
+        returns uint8 BGR image, uint8 mask or None
+        as read-only views of the mapped file
+        """
+        mm = PackedFaceset.get_mmap(self.filename)
+        res = self.resolution
+        start_offset, end_offset = int(self.offsets[idx]), int(self.offsets[idx+1])
+
+        img = np.frombuffer(mm, np.uint8, count=res*res*3, offset=start_offset).reshape( (res,res,3) )
+
+        mask = None
+        if end_offset - start_offset > res*res*3:
+            mask = np.frombuffer(mm, np.uint8, count=res*res, offset=start_offset+res*res*3).reshape( (res,res,1) )
+        return img, mask
+
+class PackSubprocessor(Subprocessor):
+    """
+    reads and validates the files in parallel,
+    the host appends them to the packed file in order of image_paths
+
+    returns index of the packed samples, see is_completed
+    """
+    # max results held in memory while waiting for the result of a preceding file
+    max_pending = 256
+
+    class Cli(Subprocessor.Cli):
+        #override
+        def on_initialize(self, client_dict):
+            self.as_person_faceset = client_dict['as_person_faceset']
+
+        #override
+        def process_data(self, data):
+            idx, filepath = data
+            filepath = Path(filepath)
+
+            try:
+                b = filepath.read_bytes()
+                dflimg = DFLIMG.load (filepath, loader_func=lambda x: b, header_only=True)
+                if dflimg is None or not dflimg.has_data():
+                    self.log_err (f"{filepath.name} is not a dfl image file.")
+                    return idx, None
+
+                sample = Sample(filename=filepath.name,
+                                sample_type=SampleType.FACE,
+                                face_type=FaceType.fromString (dflimg.get_face_type()),
+                                shape=dflimg.get_shape(),
+                                landmarks=dflimg.get_landmarks(),
+                                seg_ie_polys=dflimg.get_seg_ie_polys(),
+                                xseg_mask_compressed=dflimg.get_xseg_mask_compressed(),
+                                eyebrows_expand_mod=dflimg.get_eyebrows_expand_mod(),
+                                source_filename=dflimg.get_source_filename(),
+                                person_name=filepath.parent.name if self.as_person_faceset else None)
+            except:
+                self.log_err (f"Exception occured while processing file {filepath}. Error: {traceback.format_exc()}")
+                return idx, None
+
+            return idx, (sample.get_config(), b, zlib.crc32(b) )
+
+        #override
+        def get_data_name (self, data):
+            return data[1]
+
+    #override
+    def __init__(self, image_paths, of, as_person_faceset):
+        self.image_paths = image_paths
+        self.of = of
+        self.as_person_faceset = as_person_faceset
+
+        self.idxs = [*range(len(image_paths))]
+        self.pending = {}
+        self.next_write_idx = 0
+        self.packed_paths = []
+        self.index = {'samples_configs' : [],
+                      'offsets' : [],
+                      'sizes' : [],
+                      'deleted' : [],
+                      'crcs' : [] }
+        super().__init__('Pack', PackSubprocessor.Cli, 60, chunk_size=0)
+
+    #override
+    def on_clients_initialized(self):
+        io.progress_bar ("Packing", len (self.image_paths))
+
+    #override
+    def on_clients_finalized(self):
+        io.progress_bar_close()
+
+    #override
+    def process_info_generator(self):
+        for i in range(min(multiprocessing.cpu_count(), 8) ):
+            yield 'CPU%d' % (i), {}, {'as_person_faceset' : self.as_person_faceset}
+
+    #override
+    def get_data(self, host_dict):
+        if len (self.idxs) > 0 and self.idxs[0] < self.next_write_idx + PackSubprocessor.max_pending:
+            idx = self.idxs.pop(0)
+            return idx, self.image_paths[idx]
+        return None
+
+    #override
+    def on_data_return (self, host_dict, data):
+        self.idxs.insert(0, data[0])
+
+    #override
+    def on_result (self, host_dict, data, result):
+        idx, sample_data = result
+        self.pending[idx] = sample_data
+
+        # write results in order of image_paths
+        while self.next_write_idx in self.pending:
+            sample_data = self.pending.pop(self.next_write_idx)
+            self.next_write_idx += 1
+
+            if sample_data is not None:
+                sample_config, b, crc = sample_data
+                self.index['samples_configs'].append (sample_config)
+                self.index['offsets'].append ( self.of.tell() )
+                self.index['sizes'].append ( len(b) )
+                self.index['deleted'].append (False)
+                self.index['crcs'].append (crc)
+                self.of.write(b)
+                self.packed_paths.append (self.image_paths[self.next_write_idx-1])
+
+        io.progress_bar_inc(1)
+
+    #override
+    def get_result(self):
+        return self.index
+
+    def is_completed(self):
+        """
+        returns True if all files are processed and written, unreadable files are skipped
+        """
+        return self.next_write_idx == len(self.image_paths) and len(self.pending) == 0
@@ -1,9 +1,11 @@
+import pickle
 from enum import IntEnum
 from pathlib import Path
 
 import cv2
 import numpy as np
 
+import samplelib
 from core.cv2ex import *
 from facelib import LandmarksProcessor
 from core import imagelib
@@ -21,12 +23,17 @@ class SampleType(IntEnum):
     QTY = 4
 
 class Sample(object):
+    reduced_decode_flags = { 2 : cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+                             4 : cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+                             8 : cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION }
+
     __slots__ = ['sample_type',
                  'filename',
                  'face_type',
                  'shape',
                  'landmarks',
-                 'seg_ie_polys',
+                 '_seg_ie_polys',
+                 '_seg_ie_polys_data',
                  'xseg_mask',
                  'xseg_mask_compressed',
                  'eyebrows_expand_mod',
@@ -79,6 +86,20 @@ class Sample(object):
 
         self._filename_offset_size = None
 
+    @property
+    def seg_ie_polys(self):
+        # pickled polys of SampleTable are loaded on first access
+        if self._seg_ie_polys is None:
+            data = self._seg_ie_polys_data
+            self._seg_ie_polys = SegIEPolys.load( pickle.loads(data) ) if data is not None else SegIEPolys()
+            self._seg_ie_polys_data = None
+        return self._seg_ie_polys
+
+    @seg_ie_polys.setter
+    def seg_ie_polys(self, seg_ie_polys):
+        self._seg_ie_polys = seg_ie_polys
+        self._seg_ie_polys_data = None
+
     def has_xseg_mask(self):
         return self.xseg_mask is not None or self.xseg_mask_compressed is not None
         
@@ -99,19 +120,43 @@ class Sample(object):
         self._filename_offset_size = (filename, offset, size)
 
     def read_raw_file(self, filename=None):
+        """
+        returns bytes of the file,
+        or memoryview into the mapped packed faceset
+        """
         if self._filename_offset_size is not None:
             filename, offset, size = self._filename_offset_size
-            with open(filename, "rb") as f:
-                f.seek( offset, 0)
-                return f.read (size)
+            return memoryview( samplelib.PackedFaceset.get_mmap(filename) )[offset:offset+size]
         else:
             with open(filename, "rb") as f:
                 return f.read()
 
-    def load_bgr(self):
-        img = cv2_imread (self.filename, loader_func=self.read_raw_file).astype(np.float32) / 255.0
+    def get_reduce_factor(self, min_size):
+        """
+        returns the largest factor of reduced jpeg decode, at which width of the image is still >= min_size,
+        1 if the image should be decoded at full size
+        """
+        if min_size is None or self.shape is None or Path(self.filename).suffix.lower() not in ['.jpg', '.jpeg']:
+            return 1
+        for factor in [8,4,2]:
+            if -(-self.shape[1] // factor) >= min_size:
+                return factor
+        return 1
+
+    def load_bgr(self, min_size=None):
+        img = self.load_bgr_uint8(min_size=min_size).astype(np.float32) / 255.0
         return img
 
+    def load_bgr_uint8(self, min_size=None):
+        """
+        min_size    optional min width of the decoded image,
+                    jpeg is decoded at 1/2, 1/4 or 1/8 by DCT scaling of libjpeg if the result is still >= min_size
+        """
+        factor = self.get_reduce_factor(min_size)
+        if factor != 1:
+            return cv2_imread (self.filename, flags=Sample.reduced_decode_flags[factor], loader_func=self.read_raw_file)
+        return cv2_imread (self.filename, loader_func=self.read_raw_file)
+
     def get_config(self):
         return {'sample_type': self.sample_type,
                 'filename': self.filename,
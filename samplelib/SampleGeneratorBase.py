@@ -32,4 +32,9 @@ class SampleGeneratorBase(object):
     
     #overridable
     def is_initialized(self):
-        return True
\ No newline at end of file
+        return True
+
+    #overridable
+    def get_stats_text(self):
+        # optional line for the log of the trainer
+        return None
\ No newline at end of file
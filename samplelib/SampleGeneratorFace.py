@@ -1,16 +1,18 @@
 import multiprocessing
 import time
 import traceback
+from pathlib import Path
 
 import cv2
 import numpy as np
 
-from core import mplib
+from core import imagelib, mplib
 from core.interact import interact as io
 from core.joblib import SubprocessGenerator, ThisThreadGenerator
 from facelib import LandmarksProcessor
-from samplelib import (SampleGeneratorBase, SampleLoader, SampleProcessor,
-                       SampleType)
+from samplelib import (SampleGeneratorBase, SampleImageCache, SampleLoader,
+                       SampleProcessor, SampleType)
+from samplelib.PackedFaceset import PackedFaceset
 
 
 '''
@@ -21,6 +23,9 @@ output_sample_types = [
                       ]
 '''
 class SampleGeneratorFace(SampleGeneratorBase):
+    # default of image_cache_bytes
+    image_cache_bytes = 0
+
     def __init__ (self, samples_path, debug=False, batch_size=1,
                         random_ct_samples_path=None,
                         sample_process_options=SampleProcessor.Options(),
@@ -28,12 +33,31 @@ class SampleGeneratorFace(SampleGeneratorBase):
                         uniform_yaw_distribution=False,
                         generators_count=4,
                         raise_on_no_data=True,                        
+                        generators_backend='process',
+                        generators_cv2_num_threads=None,
+                        mask_cache_bytes=0,
+                        image_cache_bytes=None,
+                        warp_field_pool=False,
                         **kwargs):
+        """
+        generators_backend          'process' or 'thread', see SubprocessGenerator
+        generators_cv2_num_threads  optional cap of OpenCV thread pool in generators
+        mask_cache_bytes            size of LRU cache of face masks shared by generators, 0 - disabled.
+                                    Cached masks are resized before eyes and mouth levels are applied,
+                                    so edges of these levels differ slightly from masks without the cache
+        image_cache_bytes           size of LRU cache of decoded faces shared by generators, 0 - disabled,
+                                    used if there is no pre-decoded pixel cache of the packed faceset
+        warp_field_pool             random warps are drawn from pools of pre-generated warp fields shared by generators.
+                                    Faster, but warps repeat: a pool has 256..1024 fields with 8 variants each,
+                                    while every generated warp is unique
+        """
 
         super().__init__(debug, batch_size)
         self.initialized = False
         self.sample_process_options = sample_process_options
         self.output_sample_types = output_sample_types
+        self.samples_path = Path(samples_path)
+        self.image_cache = None
         
         if self.debug:
             self.generators_count = 1
@@ -75,7 +99,52 @@ class SampleGeneratorFace(SampleGeneratorBase):
             
             index_host = mplib.Index2DHost( yaws_sample_list )
         else:
-            index_host = mplib.IndexHost(self.samples_len)
+            shards_lens = PackedFaceset.get_shards_lens(Path(samples_path))
+            if shards_lens is not None and sum(shards_lens) == self.samples_len:
+                shards_paths = PackedFaceset.get_shards_paths(Path(samples_path))
+                index_host = mplib.ShardedIndexHost(shards_lens, prefetch_func=lambda shard_id: PackedFaceset.prefetch( str(shards_paths[shard_id]) ) )
+            else:
+                index_host = mplib.IndexHost(self.samples_len)
+
+        # pre-decoded and cached pixels are the whole stored face resized to the resolution of the cache,
+        # so they are used only if all outputs have this resolution and the face type of the samples,
+        # otherwise the face would be cropped out of the downscaled image and upscaled
+        pixel_cache = None
+        resolutions = set( opts['resolution'] for opts in output_sample_types if opts.get('resolution', None) is not None )
+        face_types = set( opts['face_type'] for opts in output_sample_types if opts.get('face_type', None) is not None )
+        is_cache_face_type = False
+        if len(resolutions) == 1:
+            samples_face_types = set( sample.face_type for sample in samples )
+            is_cache_face_type = len(samples_face_types) == 1 and face_types.issubset(samples_face_types)
+
+        if len(resolutions) == 1:
+            resolution = resolutions.pop()
+            if is_cache_face_type:
+                pixel_cache = PackedFaceset.load_pixel_cache(Path(samples_path), resolution )
+            if pixel_cache is not None:
+                if len(pixel_cache) == self.samples_len:
+                    io.log_info (f"Using pre-decoded pixel cache for {samples_path}")
+                else:
+                    pixel_cache = None
+
+            if image_cache_bytes is None:
+                image_cache_bytes = SampleGeneratorFace.image_cache_bytes
+            if pixel_cache is None and image_cache_bytes > 0:
+                if is_cache_face_type:
+                    self.image_cache = SampleImageCache(resolution, image_cache_bytes)
+                    io.log_info (f"Using {image_cache_bytes / 1024**3:.2f}GB cache of decoded faces for {samples_path}")
+                else:
+                    io.log_info (f"Cache of decoded faces is not used for {samples_path}, face type of the model differs from the faceset.")
+
+        # face masks are deterministic per sample, so they are computed once and cached
+        mask_cache = None
+        if mask_cache_bytes > 0 and any( opts.get('sample_type', None) == SampleProcessor.SampleType.FACE_MASK for opts in output_sample_types ):
+            mask_cache = mplib.LRUCacheHost(mask_cache_bytes)
+
+        warp_field_pools = None
+        if warp_field_pool:
+            warp_field_pools = { opts['resolution'] : imagelib.WarpFieldPool(opts['resolution']) \
+                                 for opts in output_sample_types if opts.get('warp', False) and opts.get('resolution', None) is not None }
 
         if random_ct_samples_path is not None:
             ct_samples = SampleLoader.load (SampleType.FACE, random_ct_samples_path)
@@ -85,9 +154,9 @@ class SampleGeneratorFace(SampleGeneratorBase):
             ct_index_host = None
 
         if self.debug:
-            self.generators = [ThisThreadGenerator ( self.batch_func, (samples, index_host.create_cli(), ct_samples, ct_index_host.create_cli() if ct_index_host is not None else None) )]
+            self.generators = [ThisThreadGenerator ( self.batch_func, (samples, index_host.create_cli(), ct_samples, ct_index_host.create_cli() if ct_index_host is not None else None, self.image_cache.create_cli() if self.image_cache is not None else pixel_cache, mask_cache.create_cli() if mask_cache is not None else None, warp_field_pools) )]
         else:
-            self.generators = [SubprocessGenerator ( self.batch_func, (samples, index_host.create_cli(), ct_samples, ct_index_host.create_cli() if ct_index_host is not None else None), start_now=False ) \
+            self.generators = [SubprocessGenerator ( self.batch_func, (samples, index_host.create_cli(), ct_samples, ct_index_host.create_cli() if ct_index_host is not None else None, self.image_cache.create_cli() if self.image_cache is not None else pixel_cache, mask_cache.create_cli() if mask_cache is not None else None, warp_field_pools), start_now=False, shared_memory=True, backend=generators_backend, cv2_num_threads=generators_cv2_num_threads ) \
                                for i in range(self.generators_count) ]
                                
             SubprocessGenerator.start_in_parallel( self.generators )
@@ -99,6 +168,12 @@ class SampleGeneratorFace(SampleGeneratorBase):
     #overridable
     def is_initialized(self):
         return self.initialized
+
+    #override
+    def get_stats_text(self):
+        if self.image_cache is not None:
+            return f"{self.samples_path.name} {self.image_cache.get_stats_text()}"
+        return None
         
     def __iter__(self):
         return self
@@ -112,33 +187,19 @@ class SampleGeneratorFace(SampleGeneratorBase):
         return next(generator)
 
     def batch_func(self, param ):
-        samples, index_host, ct_samples, ct_index_host = param
+        samples, index_host, ct_samples, ct_index_host, pixel_cache, mask_cache, warp_field_pools = param
  
         bs = self.batch_size
         while True:
-            batches = None
-
             indexes = index_host.multi_get(bs)
             ct_indexes = ct_index_host.multi_get(bs) if ct_samples is not None else None
 
-            t = time.time()
-            for n_batch in range(bs):
-                sample_idx = indexes[n_batch]
-                sample = samples[sample_idx]
-
-                ct_sample = None
-                if ct_samples is not None:
-                    ct_sample = ct_samples[ct_indexes[n_batch]]
-
-                try:
-                    x, = SampleProcessor.process ([sample], self.sample_process_options, self.output_sample_types, self.debug, ct_sample=ct_sample)
-                except:
-                    raise Exception ("Exception occured in sample %s. Error: %s" % (sample.filename, traceback.format_exc() ) )
-
-                if batches is None:
-                    batches = [ [] for _ in range(len(x)) ]
-
-                for i in range(len(x)):
-                    batches[i].append ( x[i] )
+            batch_samples = [ samples[sample_idx] for sample_idx in indexes ]
+            batch_ct_samples = [ ct_samples[ct_idx] for ct_idx in ct_indexes ] if ct_samples is not None else None
+            if isinstance(pixel_cache, SampleImageCache.Cli):
+                cached_pixels = [ pixel_cache.get(sample_idx, samples[sample_idx]) for sample_idx in indexes ]
+            else:
+                cached_pixels = [ pixel_cache.get(sample_idx) for sample_idx in indexes ] if pixel_cache is not None else None
 
-            yield [ np.array(batch) for batch in batches]
+            yield SampleProcessor.process_batch (batch_samples, self.sample_process_options, self.output_sample_types, self.debug, ct_samples=batch_ct_samples, cached_pixels=cached_pixels,
+                                                 sample_idxs=indexes, mask_cache=mask_cache, warp_field_pools=warp_field_pools)
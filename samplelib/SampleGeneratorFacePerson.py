@@ -1,5 +1,6 @@
 import copy
 import multiprocessing
+import threading
 import traceback
 
 import cv2
@@ -39,36 +40,33 @@ class Index2DHost():
         sq = self.sq
 
         while True:
-            while not sq.empty():
-                obj = sq.get()
-                cq_id, cmd = obj[0], obj[1]
+            obj = sq.get()
+            cq_id, cmd = obj[0], obj[1]
 
-                if cmd == 0: #get_1D
-                    count = obj[2]
+            if cmd == 0: #get_1D
+                count = obj[2]
 
-                    result = []
+                result = []
+                for i in range(count):
+                    if len(shuffle_idxs) == 0:
+                        shuffle_idxs = idxs.copy()
+                        np.random.shuffle(shuffle_idxs)
+                    result.append(shuffle_idxs.pop())
+                self.cqs[cq_id].put (result)
+            elif cmd == 1: #get_2D
+                targ_idxs,count = obj[2], obj[3]
+                result = []
+
+                for targ_idx in targ_idxs:
+                    sub_idxs = []
                     for i in range(count):
-                        if len(shuffle_idxs) == 0:
-                            shuffle_idxs = idxs.copy()
-                            np.random.shuffle(shuffle_idxs)
-                        result.append(shuffle_idxs.pop())
-                    self.cqs[cq_id].put (result)
-                elif cmd == 1: #get_2D
-                    targ_idxs,count = obj[2], obj[3]
-                    result = []
-
-                    for targ_idx in targ_idxs:
-                        sub_idxs = []
-                        for i in range(count):
-                            ar = shuffle_idxs_2D[targ_idx]
-                            if len(ar) == 0:
-                                ar = shuffle_idxs_2D[targ_idx] = idxs_2D[targ_idx].copy()
-                                np.random.shuffle(ar)
-                            sub_idxs.append(ar.pop())
-                        result.append (sub_idxs)
-                    self.cqs[cq_id].put (result)
-
-            time.sleep(0.001)
+                        ar = shuffle_idxs_2D[targ_idx]
+                        if len(ar) == 0:
+                            ar = shuffle_idxs_2D[targ_idx] = idxs_2D[targ_idx].copy()
+                            np.random.shuffle(ar)
+                        sub_idxs.append(ar.pop())
+                    result.append (sub_idxs)
+                self.cqs[cq_id].put (result)
 
     def create_cli(self):
         cq = multiprocessing.Queue()
@@ -91,18 +89,12 @@ class Index2DHost():
         def get_1D(self, count):
             self.sq.put ( (self.cq_id,0, count) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
 
         def get_2D(self, idxs, count):
             self.sq.put ( (self.cq_id,1,idxs,count) )
 
-            while True:
-                if not self.cq.empty():
-                    return self.cq.get()
-                time.sleep(0.001)
+            return self.cq.get()
                 
 '''
 arg
@@ -7,7 +7,7 @@ from enum import IntEnum
 import cv2
 import numpy as np
 from pathlib import Path
-from core import imagelib, mplib, pathex
+from core import imagelib, mplib, pathex, randomex
 from core.imagelib import sd
 from core.cv2ex import *
 from core.interact import interact as io
@@ -18,6 +18,8 @@ from samplelib import (SampleGeneratorBase, SampleLoader, SampleProcessor, Sampl
 class SampleGeneratorFaceXSeg(SampleGeneratorBase):
     def __init__ (self, paths, debug=False, batch_size=1, resolution=256, face_type=None,
                         generators_count=4, data_format="NHWC",
+                        generators_backend='process',
+                        generators_cv2_num_threads=None,
                         **kwargs):
 
         super().__init__(debug, batch_size)
@@ -44,7 +46,7 @@ class SampleGeneratorFaceXSeg(SampleGeneratorBase):
         if self.debug:
             self.generators = [ThisThreadGenerator ( self.batch_func, args )]
         else:
-            self.generators = [SubprocessGenerator ( self.batch_func, args, start_now=False ) for i in range(self.generators_count) ]
+            self.generators = [SubprocessGenerator ( self.batch_func, args, start_now=False, shared_memory=True, backend=generators_backend, cv2_num_threads=generators_cv2_num_threads ) for i in range(self.generators_count) ]
 
             SubprocessGenerator.start_in_parallel( self.generators )
 
@@ -109,6 +111,8 @@ class SampleGeneratorFaceXSeg(SampleGeneratorBase):
                 mask = mask[...,None]
             return img, mask
 
+        rnd_state = randomex.get_rnd_state()
+
         bs = self.batch_size
         while True:
             batches = [ [], [] ]
@@ -118,14 +122,14 @@ class SampleGeneratorFaceXSeg(SampleGeneratorBase):
                 try:
                     if len(shuffle_idxs) == 0:
                         shuffle_idxs = seg_sample_idxs.copy()
-                        np.random.shuffle(shuffle_idxs)
+                        rnd_state.shuffle(shuffle_idxs)
                     sample = samples[shuffle_idxs.pop()]
                     img, mask = gen_img_mask(sample)
 
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         if len(bg_shuffle_idxs) == 0:
                             bg_shuffle_idxs = seg_sample_idxs.copy()
-                            np.random.shuffle(bg_shuffle_idxs)
+                            rnd_state.shuffle(bg_shuffle_idxs)
                         bg_sample = samples[bg_shuffle_idxs.pop()]
 
                         bg_img, bg_mask = gen_img_mask(bg_sample)
@@ -134,13 +138,13 @@ class SampleGeneratorFaceXSeg(SampleGeneratorBase):
                         bg_img  = imagelib.warp_by_params (bg_wp, bg_img,  can_warp=False, can_transform=True, can_flip=True, border_replicate=True)
                         bg_mask = imagelib.warp_by_params (bg_wp, bg_mask, can_warp=False, can_transform=True, can_flip=True, border_replicate=False)
                         bg_img = bg_img*(1-bg_mask)
-                        if np.random.randint(2) == 0:
+                        if rnd_state.randint(2) == 0:
                             bg_img = imagelib.apply_random_hsv_shift(bg_img)
                         else:
                             bg_img = imagelib.apply_random_rgb_levels(bg_img)
 
                         c_mask = 1.0 - (1-bg_mask) * (1-mask)
-                        rnd = 0.15 + np.random.uniform()*0.85
+                        rnd = 0.15 + rnd_state.uniform()*0.85
                         img = img*(c_mask) + img*(1-c_mask)*rnd + bg_img*(1-c_mask)*(1-rnd)
 
                     warp_params = imagelib.gen_warp_params(resolution, random_flip, rotation_range=rotation_range, scale_range=scale_range, tx_range=tx_range, ty_range=ty_range )
@@ -152,30 +156,30 @@ class SampleGeneratorFaceXSeg(SampleGeneratorBase):
                     mask[mask >= 0.5] = 1.0
                     mask = np.clip(mask, 0, 1)
                     
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         # random face flare
-                        krn = np.random.randint( resolution//4, resolution )
+                        krn = rnd_state.randint( resolution//4, resolution )
                         krn = krn - krn % 2 + 1
                         img = img + cv2.GaussianBlur(img*mask, (krn,krn), 0)
 
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         # random bg flare
-                        krn = np.random.randint( resolution//4, resolution )
+                        krn = rnd_state.randint( resolution//4, resolution )
                         krn = krn - krn % 2 + 1
                         img = img + cv2.GaussianBlur(img*(1-mask), (krn,krn), 0)
 
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         img = imagelib.apply_random_hsv_shift(img, mask=sd.random_circle_faded ([resolution,resolution]))
                     else:
                         img = imagelib.apply_random_rgb_levels(img, mask=sd.random_circle_faded ([resolution,resolution]))
                         
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         img = imagelib.apply_random_sharpen( img, sharpen_chance, sharpen_kernel_max_size, mask=sd.random_circle_faded ([resolution,resolution]))
                     else:
                         img = imagelib.apply_random_motion_blur( img, motion_blur_chance, motion_blur_mb_max_size, mask=sd.random_circle_faded ([resolution,resolution]))
                         img = imagelib.apply_random_gaussian_blur( img, gaussian_blur_chance, gaussian_blur_kernel_max_size, mask=sd.random_circle_faded ([resolution,resolution]))
                         
-                    if np.random.randint(2) == 0:
+                    if rnd_state.randint(2) == 0:
                         img = imagelib.apply_random_nearest_resize( img, random_bilinear_resize_chance, random_bilinear_resize_max_size_per, mask=sd.random_circle_faded ([resolution,resolution]))
                     else:
                         img = imagelib.apply_random_bilinear_resize( img, random_bilinear_resize_chance, random_bilinear_resize_max_size_per, mask=sd.random_circle_faded ([resolution,resolution]))
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+from core import imagelib, mplib
+
+
+class SampleImageCache():
+    """
+    Cache of decoded faces of samples resized to resolution, shared by generator processes.
+
+    Faces are stored as uint8 BGR with uint8 xseg mask as 4th channel if the sample has one,
+    in mplib.LRUCacheHost of max_bytes, filled on first use of the sample.
+    Works for packed faceset and folder of images.
+    Only valid for outputs of the face type of the samples, the face is not cropped before resizing.
+    """
+
+    def __init__(self, resolution, max_bytes, xseg_mask=True):
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self.xseg_mask = xseg_mask
+        self.host = mplib.LRUCacheHost(max_bytes)
+
+    @staticmethod
+    def decode_sample(sample, resolution, xseg_mask=True):
+        """
+        returns uint8 BGR image, uint8 mask or None of the sample resized to resolution
+        """
+        img = sample.load_bgr_uint8(min_size=resolution)
+        img = imagelib.normalize_channels(img, 3)
+        if img.shape[0] != resolution or img.shape[1] != resolution:
+            img = cv2.resize (img, (resolution, resolution), interpolation=cv2.INTER_CUBIC )
+
+        mask = None
+        if xseg_mask and sample.has_xseg_mask():
+            mask = sample.get_xseg_mask()
+            if mask.shape[0] != resolution or mask.shape[1] != resolution:
+                mask = cv2.resize (mask, (resolution, resolution), interpolation=cv2.INTER_CUBIC )
+            mask = np.clip( imagelib.normalize_channels(mask, 1)*255, 0, 255 ).astype(np.uint8)
+        return img, mask
+
+    def create_cli(self):
+        return SampleImageCache.Cli(self.host.create_cli(), self.resolution, self.xseg_mask)
+
+    def get_stats_text(self):
+        hits, misses = self.host.hits, self.host.misses
+        hit_rate = hits / (hits+misses) * 100 if hits+misses != 0 else 0.0
+        return f"image cache: hit rate {hit_rate:.1f}%, {self.host.used_bytes / 1024**3:.2f} of {self.max_bytes / 1024**3:.2f}GB used"
+
+    # disable pickling
+    def __getstate__(self):
+        return dict()
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+    class Cli():
+        def __init__(self, cache_cli, resolution, xseg_mask):
+            self.cache_cli = cache_cli
+            self.resolution = resolution
+            self.xseg_mask = xseg_mask
+
+        def get(self, sample_idx, sample):
+            """
+            returns uint8 BGR image, uint8 mask or None
+            """
+            img = self.cache_cli.get(sample_idx)
+            if img is None:
+                img, mask = SampleImageCache.decode_sample(sample, self.resolution, self.xseg_mask)
+                self.cache_cli.put(sample_idx, np.concatenate([img, mask], -1) if mask is not None else img)
+                return img, mask
+
+            if img.shape[-1] == 4:
+                return img[...,:3], img[...,3:]
+            return img, None
@@ -6,13 +6,13 @@ from pathlib import Path
 
 import samplelib.PackedFaceset
 from core import pathex
-from core.mplib import MPSharedList
 from core.interact import interact as io
 from core.joblib import Subprocessor
 from DFLIMG import *
 from facelib import FaceType, LandmarksProcessor
 
 from .Sample import Sample, SampleType
+from .SampleTable import SampleTable
 
 
 class SampleLoader:
@@ -35,7 +35,7 @@ class SampleLoader:
     @staticmethod
     def load(sample_type, samples_path, subdirs=False):
         """
-        Return MPSharedList of samples
+        Return SampleTable of samples
         """
         samples_cache = SampleLoader.samples_cache
 
@@ -61,17 +61,49 @@ class SampleLoader:
                 if result is None:
                     result = SampleLoader.load_face_samples( pathex.get_image_paths(samples_path, subdirs=subdirs) )
 
-                samples[sample_type] = MPSharedList(result)
+                samples[sample_type] = SampleTable(result)
         elif          sample_type == SampleType.FACE_TEMPORAL_SORTED:
                 result = SampleLoader.load (SampleType.FACE, samples_path)
                 result = SampleLoader.upgradeToFaceTemporalSortedSamples(result)
-                samples[sample_type] = MPSharedList(result)
+                samples[sample_type] = SampleTable(result)
 
         return samples[sample_type]
 
     @staticmethod
     def load_face_samples ( image_paths):
-        result = FaceSamplesLoaderSubprocessor(image_paths).run()
+        result = [None]*len(image_paths)
+
+        # metadata of unchanged files is taken from the DFLIndex of their folder
+        dir_indexes = {}
+        unindexed_idxs = []
+        for i, filename in enumerate(image_paths):
+            dir_path = Path(filename).parent
+            index = dir_indexes.get(dir_path, None)
+            if index is None:
+                index = dir_indexes[dir_path] = DFLIndex.load(dir_path)
+
+            idx = index.get_idx(filename)
+            if idx is None:
+                if index.is_skipped(filename):
+                    io.log_err (f"FaceSamplesLoader: {filename} is not a dfl image file.")
+                    result[i] = (filename, None)
+                else:
+                    unindexed_idxs.append(i)
+                continue
+
+            result[i] = (filename, ( FaceType.toString( FaceType(int(index.get(idx, 'face_type'))) ),
+                                     tuple(index.get(idx, 'shape').tolist()),
+                                     index.get(idx, 'landmarks'),
+                                     index.get(idx, 'seg_ie_polys'),
+                                     index.get(idx, 'xseg_mask_compressed'),
+                                     float(index.get(idx, 'eyebrows_expand_mod')),
+                                     index.get(idx, 'source_filename') ) )
+
+        if len(unindexed_idxs) != 0:
+            unindexed_result = FaceSamplesLoaderSubprocessor([ image_paths[i] for i in unindexed_idxs ]).run()
+            for i, r in zip(unindexed_idxs, unindexed_result):
+                result[i] = r
+
         sample_list = []
 
         for filename, data in result:
@@ -112,7 +144,7 @@ class FaceSamplesLoaderSubprocessor(Subprocessor):
         self.image_paths_len = len(image_paths)
         self.idxs = [*range(self.image_paths_len)]
         self.result = [None]*self.image_paths_len
-        super().__init__('FaceSamplesLoader', FaceSamplesLoaderSubprocessor.Cli, 60)
+        super().__init__('FaceSamplesLoader', FaceSamplesLoaderSubprocessor.Cli, 60, chunk_size=0)
 
     #override
     def on_clients_initialized(self):
@@ -153,7 +185,7 @@ class FaceSamplesLoaderSubprocessor(Subprocessor):
         #override
         def process_data(self, data):
             idx, filename = data
-            dflimg = DFLIMG.load (Path(filename))
+            dflimg = DFLIMG.load (Path(filename), header_only=True)
 
             if dflimg is None or not dflimg.has_data():
                 self.log_err (f"FaceSamplesLoader: {filename} is not a dfl image file.")
@@ -1,11 +1,12 @@
 import collections
 import math
+import traceback
 from enum import IntEnum
 
 import cv2
 import numpy as np
 
-from core import imagelib
+from core import imagelib, randomex
 from core.cv2ex import *
 from core.imagelib import sd, LinearMotionBlur
 from core.imagelib.color_transfer import random_lab_rotation
@@ -37,309 +38,541 @@ class SampleProcessor(object):
         FULL_FACE_EYES = 3  # eyes and mouse
 
     class Options(object):
-        def __init__(self, random_flip = True, rotation_range=[-2,2], scale_range=[-0.05, 0.05], tx_range=[-0.05, 0.05], ty_range=[-0.05, 0.05] ):
+        def __init__(self, random_flip = True, rotation_range=[-2,2], scale_range=[-0.05, 0.05], tx_range=[-0.05, 0.05], ty_range=[-0.05, 0.05], fused_warp=True, reduced_decode=True ):
+            """
+            fused_warp      face images and masks are sampled once by the combined map of face transform and random warp,
+                            instead of interpolation per step
+
+            reduced_decode  jpeg faces are decoded at reduced resolution, if outputs are much smaller than the stored face
+            """
             self.random_flip = random_flip
             self.rotation_range = rotation_range
             self.scale_range = scale_range
             self.tx_range = tx_range
             self.ty_range = ty_range
+            self.fused_warp = fused_warp
+            self.reduced_decode = reduced_decode
+
+    OutputOptions = collections.namedtuple('OutputOptions', ['sample_type', 'channel_type', 'resolution', 'nearest_resize_to', 'warp', 'transform',
+                                                             'random_downsample', 'random_noise', 'random_blur', 'random_jpeg', 'motion_blur', 'gaussian_blur', 'random_bilinear_resize',
+                                                             'random_rgb_levels', 'random_hsv_shift', 'random_circle_mask', 'normalize_tanh', 'ct_mode', 'data_format',
+                                                             'border_replicate', 'face_type', 'face_mask_type'])
 
     @staticmethod
-    def process (samples, sample_process_options, output_sample_types, debug, ct_sample=None):
+    def get_output_options(output_sample_types):
+        """
+        returns OutputOptions with defaults per item of output_sample_types
+        """
         SPST = SampleProcessor.SampleType
         SPCT = SampleProcessor.ChannelType
         SPFMT = SampleProcessor.FaceMaskType
 
-        sample_rnd_seed = np.random.randint(0x80000000)
-
-        outputs = []
-        for sample in samples:
-            sample_face_type = sample.face_type
-            sample_bgr = sample.load_bgr()
-            sample_landmarks = sample.landmarks
-            ct_sample_bgr = None
-            h,w,c = sample_bgr.shape
-
-            def get_full_face_mask():
-                xseg_mask = sample.get_xseg_mask()
-                if xseg_mask is not None:
-                    if xseg_mask.shape[0] != h or xseg_mask.shape[1] != w:
-                        xseg_mask = cv2.resize(xseg_mask, (w,h), interpolation=cv2.INTER_CUBIC)
-                        xseg_mask = imagelib.normalize_channels(xseg_mask, 1)
-                    return np.clip(xseg_mask, 0, 1)
-                else:
-                    full_face_mask = LandmarksProcessor.get_image_hull_mask (sample_bgr.shape, sample_landmarks, eyebrows_expand_mod=sample.eyebrows_expand_mod )
-                    return np.clip(full_face_mask, 0, 1)
-
-            def get_eyes_mask():
-                eyes_mask = LandmarksProcessor.get_image_eye_mask (sample_bgr.shape, sample_landmarks)
-                # set eye masks to 1-2
-                clip = np.clip(eyes_mask, 0, 1)
-                clip[clip > 0.1] += 1
-                return clip
-
-            def get_mouth_mask():
-                mouth_mask = LandmarksProcessor.get_image_mouth_mask (sample_bgr.shape, sample_landmarks)
-                # set eye masks to 2-3
-                clip = np.clip(mouth_mask, 0, 1)
-                clip[clip > 0.1] += 2
-                return clip
-
-            is_face_sample = sample_landmarks is not None
-
-            if debug and is_face_sample:
-                LandmarksProcessor.draw_landmarks (sample_bgr, sample_landmarks, (0, 1, 0))
-
-            params_per_resolution = {}
-            warp_rnd_state = np.random.RandomState (sample_rnd_seed-1)
-            for opts in output_sample_types:
-                resolution = opts.get('resolution', None)
-                if resolution is None:
-                    continue
-                params_per_resolution[resolution] = imagelib.gen_warp_params(resolution,
-                                                                             sample_process_options.random_flip,
-                                                                             rotation_range=sample_process_options.rotation_range,
-                                                                             scale_range=sample_process_options.scale_range,
-                                                                             tx_range=sample_process_options.tx_range,
-                                                                             ty_range=sample_process_options.ty_range,
-                                                                             rnd_state=warp_rnd_state)
-
-            outputs_sample = []
-            for opts in output_sample_types:
-                sample_type    = opts.get('sample_type', SPST.NONE)
-                channel_type   = opts.get('channel_type', SPCT.NONE)
-                resolution     = opts.get('resolution', 0)
-                nearest_resize_to = opts.get('nearest_resize_to', None)
-                warp           = opts.get('warp', False)
-                transform      = opts.get('transform', False)
-                random_downsample = opts.get('random_downsample', False)
-                random_noise = opts.get('random_noise', False)
-                random_blur = opts.get('random_blur', False)
-                random_jpeg = opts.get('random_jpeg', False)
-                motion_blur    = opts.get('motion_blur', None)
-                gaussian_blur  = opts.get('gaussian_blur', None)
-                random_bilinear_resize = opts.get('random_bilinear_resize', None)
-                random_rgb_levels = opts.get('random_rgb_levels', False)
-                random_hsv_shift = opts.get('random_hsv_shift', False)
-                random_circle_mask = opts.get('random_circle_mask', False)
-                normalize_tanh = opts.get('normalize_tanh', False)
-                ct_mode        = opts.get('ct_mode', None)
-                data_format    = opts.get('data_format', 'NHWC')
-
-                if sample_type == SPST.FACE_MASK or sample_type == SPST.IMAGE:
-                    border_replicate = False
-                elif sample_type == SPST.FACE_IMAGE:
-                    border_replicate = True
+        output_options = []
+        for opts in output_sample_types:
+            sample_type = opts.get('sample_type', SPST.NONE)
+
+            border_replicate = None
+            if sample_type == SPST.FACE_MASK or sample_type == SPST.IMAGE:
+                border_replicate = False
+            elif sample_type == SPST.FACE_IMAGE:
+                border_replicate = True
+
+            face_type = opts.get('face_type', None)
+            if sample_type == SPST.FACE_IMAGE or sample_type == SPST.FACE_MASK:
+                if face_type is None:
+                    raise ValueError("face_type must be defined for face samples")
+
+            output_options.append ( SampleProcessor.OutputOptions(sample_type=sample_type,
+                                                                  channel_type=opts.get('channel_type', SPCT.NONE),
+                                                                  resolution=opts.get('resolution', None),
+                                                                  nearest_resize_to=opts.get('nearest_resize_to', None),
+                                                                  warp=opts.get('warp', False),
+                                                                  transform=opts.get('transform', False),
+                                                                  random_downsample=opts.get('random_downsample', False),
+                                                                  random_noise=opts.get('random_noise', False),
+                                                                  random_blur=opts.get('random_blur', False),
+                                                                  random_jpeg=opts.get('random_jpeg', False),
+                                                                  motion_blur=opts.get('motion_blur', None),
+                                                                  gaussian_blur=opts.get('gaussian_blur', None),
+                                                                  random_bilinear_resize=opts.get('random_bilinear_resize', None),
+                                                                  random_rgb_levels=opts.get('random_rgb_levels', False),
+                                                                  random_hsv_shift=opts.get('random_hsv_shift', False),
+                                                                  random_circle_mask=opts.get('random_circle_mask', False),
+                                                                  normalize_tanh=opts.get('normalize_tanh', False),
+                                                                  ct_mode=opts.get('ct_mode', None),
+                                                                  data_format=opts.get('data_format', 'NHWC'),
+                                                                  border_replicate=opts.get('border_replicate', border_replicate),
+                                                                  face_type=face_type,
+                                                                  face_mask_type=opts.get('face_mask_type', SPFMT.NONE) ) )
+        return output_options
 
+    @staticmethod
+    def gen_params_per_resolution(sample_process_options, output_options, rnd_state, warp_field_pools=None):
+        """
+        warp_field_pools    optional dict of imagelib.WarpFieldPool per resolution
+        """
+        params_per_resolution = {}
+        for opts in output_options:
+            resolution = opts.resolution
+            if resolution is None:
+                continue
+            params_per_resolution[resolution] = imagelib.gen_warp_params(resolution,
+                                                                         sample_process_options.random_flip,
+                                                                         rotation_range=sample_process_options.rotation_range,
+                                                                         scale_range=sample_process_options.scale_range,
+                                                                         tx_range=sample_process_options.tx_range,
+                                                                         ty_range=sample_process_options.ty_range,
+                                                                         rnd_state=rnd_state,
+                                                                         warp_field_pool=warp_field_pools.get(resolution, None) if warp_field_pools is not None else None)
+        return params_per_resolution
 
-                border_replicate = opts.get('border_replicate', border_replicate)
-                borderMode = cv2.BORDER_REPLICATE if border_replicate else cv2.BORDER_CONSTANT
+    @staticmethod
+    def get_decode_size(sample, sample_process_options, output_options):
+        """
+        returns min width of the decoded image of the sample, which keeps the detail of all outputs,
+        None if the image is required at full size
+        """
+        SPST = SampleProcessor.SampleType
 
+        if not sample_process_options.reduced_decode or sample.shape is None or sample.landmarks is None \
+           or sample.face_type is None or sample.face_type == FaceType.MARK_ONLY:
+            return None
 
-                if sample_type == SPST.FACE_IMAGE or sample_type == SPST.FACE_MASK:
-                    if not is_face_sample:
-                        raise ValueError("face_samples should be provided for sample_type FACE_*")
+        w = sample.shape[1]
+        max_scale = 0.0
+        for opts in output_options:
+            if opts.sample_type == SPST.FACE_IMAGE or opts.sample_type == SPST.FACE_MASK:
+                if opts.face_type == sample.face_type:
+                    scale = opts.resolution / w
+                else:
+                    mat = LandmarksProcessor.get_transform_mat (sample.landmarks, opts.resolution, opts.face_type)
+                    scale = np.sqrt( abs(np.linalg.det(mat[:,:2])) )
+                if opts.nearest_resize_to is not None:
+                    scale *= max(1.0, opts.nearest_resize_to / opts.resolution)
+                max_scale = max(max_scale, scale)
+            elif opts.sample_type == SPST.IMAGE:
+                return None
+
+        if max_scale == 0.0:
+            return None
+        # random transform can zoom in
+        max_scale *= 1 + max(0.0, sample_process_options.scale_range[1])
+        return int(np.ceil(w*max_scale))
 
-                if sample_type == SPST.FACE_IMAGE or sample_type == SPST.FACE_MASK:
-                    face_type      = opts.get('face_type', None)
-                    face_mask_type = opts.get('face_mask_type', SPFMT.NONE)
+    @staticmethod
+    def finalize_output(out_sample, opts, debug, batch=False):
+        """
+        normalization and data format of the output of one sample, or of the whole batch if batch
+        """
+        SPST = SampleProcessor.SampleType
 
-                    if face_type is None:
-                        raise ValueError("face_type must be defined for face samples")
+        if opts.sample_type == SPST.FACE_IMAGE or opts.sample_type == SPST.FACE_MASK:
+            if not debug and opts.normalize_tanh:
+                if batch:
+                    # batch array is owned, normalize in place
+                    out_sample *= 2.0
+                    out_sample -= 1.0
+                    np.clip (out_sample, -1.0, 1.0, out=out_sample)
+                else:
+                    out_sample = np.clip (out_sample * 2.0 - 1.0, -1.0, 1.0)
 
-                    if sample_type == SPST.FACE_MASK:
-                        if face_mask_type == SPFMT.FULL_FACE:
-                            img = get_full_face_mask()
-                        elif face_mask_type == SPFMT.EYES:
-                            img = get_eyes_mask()
-                        elif face_mask_type == SPFMT.FULL_FACE_EYES:
-                            # sets both eyes and mouth mask parts
-                            img = get_full_face_mask()
-                            mask = img.copy()
-                            mask[mask != 0.0] = 1.0
-                            eye_mask = get_eyes_mask() * mask
-                            img = np.where(eye_mask > 1, eye_mask, img)
+        if opts.sample_type == SPST.FACE_IMAGE or opts.sample_type == SPST.FACE_MASK or opts.sample_type == SPST.IMAGE:
+            if opts.data_format == "NCHW":
+                if batch:
+                    out_sample = np.ascontiguousarray( np.transpose(out_sample, (0,3,1,2) ) )
+                else:
+                    out_sample = np.transpose(out_sample, (2,0,1) )
+        return out_sample
 
-                            mouth_mask = get_mouth_mask() * mask
-                            img = np.where(mouth_mask > 2, mouth_mask, img)
-                        else:
-                            img = np.zeros ( sample_bgr.shape[0:2]+(1,), dtype=np.float32)
+    @staticmethod
+    def process (samples, sample_process_options, output_sample_types, debug, ct_sample=None, cached_pixels=None):
+        """
+        returns list of outputs per sample
 
-                        if sample_face_type == FaceType.MARK_ONLY:
-                            mat  = LandmarksProcessor.get_transform_mat (sample_landmarks, warp_resolution, face_type)
-                            img = cv2.warpAffine( img, mat, (warp_resolution, warp_resolution), flags=cv2.INTER_LINEAR )
+        cached_pixels   optional list of (uint8 BGR image, uint8 mask or None) per sample,
+                        pre-decoded pixels used instead of decoding the sample
+        """
+        output_options = SampleProcessor.get_output_options(output_sample_types)
 
-                            img = imagelib.warp_by_params (params_per_resolution[resolution], img, warp, transform, can_flip=True, border_replicate=border_replicate, cv2_inter=cv2.INTER_LINEAR)
-                            img = cv2.resize( img, (resolution,resolution), interpolation=cv2.INTER_LINEAR )
-                        else:
-                            if face_type != sample_face_type:
-                                mat = LandmarksProcessor.get_transform_mat (sample_landmarks, resolution, face_type)
-                                img = cv2.warpAffine( img, mat, (resolution,resolution), borderMode=borderMode, flags=cv2.INTER_LINEAR )
-                            else:
-                                if w != resolution:
-                                    img = cv2.resize( img, (resolution, resolution), interpolation=cv2.INTER_LINEAR )
+        rnd_state = randomex.get_rnd_state()
+        sample_rnd_seed = rnd_state.randint(0x80000000)
 
-                            img = imagelib.warp_by_params (params_per_resolution[resolution], img, warp, transform, can_flip=True, border_replicate=border_replicate, cv2_inter=cv2.INTER_LINEAR)
+        outputs = []
+        for sample_idx, sample in enumerate(samples):
+            if cached_pixels is not None and cached_pixels[sample_idx] is not None:
+                cached_bgr, sample_xseg_mask = cached_pixels[sample_idx]
+                sample_bgr = cached_bgr.astype(np.float32) / 255.0
+            else:
+                sample_bgr = sample.load_bgr(min_size=SampleProcessor.get_decode_size(sample, sample_process_options, output_options))
+                sample_xseg_mask = None
 
-                        if len(img.shape) == 2:
-                            img = img[...,None]
+            params_per_resolution = SampleProcessor.gen_params_per_resolution(sample_process_options, output_options, np.random.RandomState (sample_rnd_seed-1) )
 
-                        if channel_type == SPCT.G:
-                            out_sample = img.astype(np.float32)
-                        else:
-                            raise ValueError("only channel_type.G supported for the mask")
+            outputs += [ SampleProcessor.process_sample (sample, sample_bgr, sample_xseg_mask, params_per_resolution, output_options, debug, rnd_state, sample_rnd_seed, ct_sample=ct_sample,
+                                                         fused_warp=sample_process_options.fused_warp) ]
 
-                    elif sample_type == SPST.FACE_IMAGE:
-                        img = sample_bgr
+        return outputs
 
-                        if random_rgb_levels:
-                            random_mask = sd.random_circle_faded ([w,w], rnd_state=np.random.RandomState (sample_rnd_seed) ) if random_circle_mask else None
-                            img = imagelib.apply_random_rgb_levels(img, mask=random_mask, rnd_state=np.random.RandomState (sample_rnd_seed) )
+    @staticmethod
+    def process_batch (samples, sample_process_options, output_sample_types, debug, ct_samples=None, cached_pixels=None, sample_idxs=None, mask_cache=None, warp_field_pools=None):
+        """
+        returns list of arrays (len(samples), ...) per output_sample_types
+
+        Pixels of the batch are gathered into one uint8 buffer and converted to float at once,
+        warp params are generated for the whole batch, outputs are written into preallocated arrays,
+        then normalized and transposed at once.
+
+        ct_samples      optional list of ct_sample per sample
+        cached_pixels   see process
+        sample_idxs     optional list of indexes of samples, required by mask_cache
+        mask_cache      optional mplib.LRUCacheHost.Cli of face masks, shared by generators of the same samples
+        warp_field_pools    optional dict of imagelib.WarpFieldPool per resolution
+        """
+        output_options = SampleProcessor.get_output_options(output_sample_types)
+
+        rnd_state = randomex.get_rnd_state()
+        batch_size = len(samples)
+        samples_rnd_seed = [ rnd_state.randint(0x80000000) for _ in range(batch_size) ]
+
+        bgrs = []
+        xseg_masks = []
+        for sample_idx, sample in enumerate(samples):
+            if cached_pixels is not None and cached_pixels[sample_idx] is not None:
+                cached_bgr, cached_mask = cached_pixels[sample_idx]
+                bgrs.append (cached_bgr)
+                xseg_masks.append (cached_mask)
+            else:
+                bgrs.append (sample.load_bgr_uint8(min_size=SampleProcessor.get_decode_size(sample, sample_process_options, output_options)))
+                xseg_masks.append (None)
+
+        shapes = set( bgr.shape for bgr in bgrs )
+        if len(shapes) == 1:
+            batch_bgr = np.empty ( (batch_size,)+shapes.pop(), dtype=np.uint8 )
+            for sample_idx, bgr in enumerate(bgrs):
+                batch_bgr[sample_idx] = bgr
+            bgrs = batch_bgr.astype(np.float32)
+            bgrs /= 255.0
+        else:
+            bgrs = [ bgr.astype(np.float32) / 255.0 for bgr in bgrs ]
+
+        params = [ SampleProcessor.gen_params_per_resolution(sample_process_options, output_options, np.random.RandomState (sample_rnd_seed-1), warp_field_pools=warp_field_pools) \
+                   for sample_rnd_seed in samples_rnd_seed ]
+
+        outputs = [None]*len(output_options)
+        for sample_idx, sample in enumerate(samples):
+            try:
+                outputs_sample = SampleProcessor.process_sample (sample, bgrs[sample_idx], xseg_masks[sample_idx], params[sample_idx], output_options, debug, rnd_state, samples_rnd_seed[sample_idx],
+                                                                 ct_sample=ct_samples[sample_idx] if ct_samples is not None else None, finalize=False,
+                                                                 sample_idx=sample_idxs[sample_idx] if sample_idxs is not None else None,
+                                                                 mask_cache=mask_cache if sample_idxs is not None else None,
+                                                                 fused_warp=sample_process_options.fused_warp)
+            except:
+                raise Exception ("Exception occured in sample %s. Error: %s" % (sample.filename, traceback.format_exc() ) )
+
+            for n, out_sample in enumerate(outputs_sample):
+                if outputs[n] is None:
+                    out_sample = np.asarray(out_sample)
+                    outputs[n] = np.empty ( (batch_size,)+out_sample.shape, dtype=out_sample.dtype )
+                outputs[n][sample_idx] = out_sample
+
+        return [ SampleProcessor.finalize_output(outputs[n], opts, debug, batch=True) for n, opts in enumerate(output_options) ]
 
-                        if random_hsv_shift:
-                            random_mask = sd.random_circle_faded ([w,w], rnd_state=np.random.RandomState (sample_rnd_seed+1) ) if random_circle_mask else None
-                            img = imagelib.apply_random_hsv_shift(img, mask=random_mask, rnd_state=np.random.RandomState (sample_rnd_seed+1) )
+    @staticmethod
+    def process_sample (sample, sample_bgr, sample_xseg_mask, params_per_resolution, output_options, debug, rnd_state, sample_rnd_seed, ct_sample=None, finalize=True, sample_idx=None, mask_cache=None, fused_warp=False):
+        """
+        returns list of outputs of one sample
+
+        sample_bgr          float BGR image of the sample, can be of lower resolution than the sample
+        sample_xseg_mask    optional uint8 pre-decoded mask
+        finalize            if False, outputs are not normalized and transposed, see finalize_output
+        sample_idx          index of the sample, key of its masks in mask_cache
+        fused_warp          see Options
+        """
+        SPST = SampleProcessor.SampleType
+        SPCT = SampleProcessor.ChannelType
+        SPFMT = SampleProcessor.FaceMaskType
 
+        sample_face_type = sample.face_type
+        sample_landmarks = sample.landmarks
+
+        if sample_landmarks is not None and sample_bgr.shape[1] != sample.shape[1]:
+            # pre-decoded or reduced decoded pixels of other resolution
+            sample_landmarks = sample_landmarks * ( sample_bgr.shape[1] / sample.shape[1] )
+
+        ct_sample_bgr = None
+        h,w,c = sample_bgr.shape
+
+        def get_cached_mask(mask_name, mask_resolution, mask_func):
+            # mask of sample is deterministic, cached as uint8 resized to mask_resolution
+            key = (sample_idx, mask_name, mask_resolution)
+            if mask_cache is not None:
+                mask = mask_cache.get(key)
+                if mask is not None:
+                    return mask.astype(np.float32) / 255.0
+
+            mask = mask_func()
+            if mask.shape[1] != mask_resolution:
+                mask = cv2.resize( mask, (mask_resolution, mask_resolution), interpolation=cv2.INTER_LINEAR )
+                mask = imagelib.normalize_channels(mask, 1)
+
+            if mask_cache is not None:
+                mask = np.clip(mask*255, 0, 255).astype(np.uint8)
+                mask_cache.put(key, mask)
+                mask = mask.astype(np.float32) / 255.0
+            return mask
+
+        def get_full_face_mask(mask_resolution):
+            def mask_func():
+                xseg_mask = sample_xseg_mask.astype(np.float32) / 255.0 if sample_xseg_mask is not None else sample.get_xseg_mask()
+                if xseg_mask is not None:
+                    if xseg_mask.shape[0] != h or xseg_mask.shape[1] != w:
+                        xseg_mask = cv2.resize(xseg_mask, (w,h), interpolation=cv2.INTER_CUBIC)
+                        xseg_mask = imagelib.normalize_channels(xseg_mask, 1)
+                    return np.clip(xseg_mask, 0, 1)
+                else:
+                    full_face_mask = LandmarksProcessor.get_image_hull_mask (sample_bgr.shape, sample_landmarks, eyebrows_expand_mod=sample.eyebrows_expand_mod )
+                    return np.clip(full_face_mask, 0, 1)
+            return get_cached_mask('full_face', mask_resolution, mask_func)
+
+        def get_eyes_mask(mask_resolution):
+            eyes_mask = get_cached_mask('eyes', mask_resolution, lambda: np.clip(LandmarksProcessor.get_image_eye_mask (sample_bgr.shape, sample_landmarks), 0, 1) )
+            # set eye masks to 1-2
+            eyes_mask[eyes_mask > 0.1] += 1
+            return eyes_mask
+
+        def get_mouth_mask(mask_resolution):
+            mouth_mask = get_cached_mask('mouth', mask_resolution, lambda: np.clip(LandmarksProcessor.get_image_mouth_mask (sample_bgr.shape, sample_landmarks), 0, 1) )
+            # set eye masks to 2-3
+            mouth_mask[mouth_mask > 0.1] += 2
+            return mouth_mask
+
+        is_face_sample = sample_landmarks is not None
+
+        if debug and is_face_sample:
+            LandmarksProcessor.draw_landmarks (sample_bgr, sample_landmarks, (0, 1, 0))
+
+        outputs_sample = []
+        for opts in output_options:
+            sample_type, channel_type, resolution, nearest_resize_to, warp, transform, \
+            random_downsample, random_noise, random_blur, random_jpeg, motion_blur, gaussian_blur, random_bilinear_resize, \
+            random_rgb_levels, random_hsv_shift, random_circle_mask, normalize_tanh, ct_mode, data_format, \
+            border_replicate, face_type, face_mask_type = opts
+
+            borderMode = cv2.BORDER_REPLICATE if border_replicate else cv2.BORDER_CONSTANT
+
+            if sample_type == SPST.FACE_IMAGE or sample_type == SPST.FACE_MASK:
+                if not is_face_sample:
+                    raise ValueError("face_samples should be provided for sample_type FACE_*")
+
+                if sample_type == SPST.FACE_MASK:
+                    mask_resolution = w
+                    if mask_cache is not None and face_type == sample_face_type and sample_face_type != FaceType.MARK_ONLY:
+                        # mask is resized to the resolution anyway, so it is cached resized
+                        mask_resolution = resolution
+
+                    if face_mask_type == SPFMT.FULL_FACE:
+                        img = get_full_face_mask(mask_resolution)
+                    elif face_mask_type == SPFMT.EYES:
+                        img = get_eyes_mask(mask_resolution)
+                    elif face_mask_type == SPFMT.FULL_FACE_EYES:
+                        # sets both eyes and mouth mask parts
+                        img = get_full_face_mask(mask_resolution)
+                        mask = img.copy()
+                        mask[mask != 0.0] = 1.0
+                        eye_mask = get_eyes_mask(mask_resolution) * mask
+                        img = np.where(eye_mask > 1, eye_mask, img)
+
+                        mouth_mask = get_mouth_mask(mask_resolution) * mask
+                        img = np.where(mouth_mask > 2, mouth_mask, img)
+                    else:
+                        img = np.zeros ( sample_bgr.shape[0:2]+(1,), dtype=np.float32)
+
+                    if sample_face_type == FaceType.MARK_ONLY:
+                        mat  = LandmarksProcessor.get_transform_mat (sample_landmarks, warp_resolution, face_type)
+                        img = cv2.warpAffine( img, mat, (warp_resolution, warp_resolution), flags=cv2.INTER_LINEAR )
+
+                        img = imagelib.warp_by_params (params_per_resolution[resolution], img, warp, transform, can_flip=True, border_replicate=border_replicate, cv2_inter=cv2.INTER_LINEAR)
+                        img = cv2.resize( img, (resolution,resolution), interpolation=cv2.INTER_LINEAR )
+                    elif fused_warp and params_per_resolution[resolution]['rw'] is None:
+                        if face_type != sample_face_type:
+                            mat = LandmarksProcessor.get_transform_mat (sample_landmarks, resolution, face_type)
+                        else:
+                            mat = imagelib.get_resize_mat (img.shape[1], resolution)
 
+                        img = imagelib.warp_by_params_fused (params_per_resolution[resolution], img, mat, warp, transform, can_flip=True, border_replicate=border_replicate, cv2_inter=cv2.INTER_LINEAR)
+                    else:
                         if face_type != sample_face_type:
                             mat = LandmarksProcessor.get_transform_mat (sample_landmarks, resolution, face_type)
-                            img = cv2.warpAffine( img, mat, (resolution,resolution), borderMode=borderMode, flags=cv2.INTER_CUBIC )
+                            img = cv2.warpAffine( img, mat, (resolution,resolution), borderMode=borderMode, flags=cv2.INTER_LINEAR )
                         else:
-                            if w != resolution:
-                                img = cv2.resize( img, (resolution, resolution), interpolation=cv2.INTER_CUBIC )
+                            if img.shape[1] != resolution:
+                                img = cv2.resize( img, (resolution, resolution), interpolation=cv2.INTER_LINEAR )
 
-                        # Apply random color transfer
-                        if ct_mode is not None and ct_sample is not None or ct_mode == 'fs-aug':
-                            if ct_mode == 'fs-aug':
-                                img = imagelib.color_augmentation(img, sample_rnd_seed)
-                            else:
-                                if ct_sample_bgr is None:
-                                    ct_sample_bgr = ct_sample.load_bgr()
-                                img = imagelib.color_transfer (ct_mode, img, cv2.resize( ct_sample_bgr, (resolution,resolution), interpolation=cv2.INTER_LINEAR ) )
-
-
-                        randomization_order = ['blur', 'noise', 'jpeg', 'down']
-                        np.random.shuffle(randomization_order)
-                        for random_distortion in randomization_order:
-                            # Apply random blur
-                            if random_distortion == 'blur' and random_blur:
-                                blur_type = np.random.choice(['motion', 'gaussian'])
-
-                                if blur_type == 'motion':
-                                    blur_k = np.random.randint(10, 20)
-                                    blur_angle = 360 * np.random.random()
-                                    img = LinearMotionBlur(img, blur_k, blur_angle)
-                                elif blur_type == 'gaussian':
-                                    blur_sigma = 5 * np.random.random() + 3
-
-                                    if blur_sigma < 5.0:
-                                        kernel_size = 2.9 * blur_sigma  # 97% of weight
-                                    else:
-                                        kernel_size = 2.6 * blur_sigma  # 95% of weight
-                                    kernel_size = int(kernel_size)
-                                    kernel_size = kernel_size + 1 if kernel_size % 2 == 0 else kernel_size
-
-                                    img = cv2.GaussianBlur(img, (kernel_size, kernel_size), blur_sigma)
-
-                            # Apply random noise
-                            if random_distortion == 'noise' and random_noise:
-                                noise_type = np.random.choice(['gaussian', 'laplace', 'poisson'])
-                                noise_scale = (20 * np.random.random() + 20)
-
-                                if noise_type == 'gaussian':
-                                    noise = np.random.normal(scale=noise_scale, size=img.shape)
-                                    img += noise / 255.0
-                                elif noise_type == 'laplace':
-                                    noise = np.random.laplace(scale=noise_scale, size=img.shape)
-                                    img += noise / 255.0
-                                elif noise_type == 'poisson':
-                                    noise_lam = (15 * np.random.random() + 15)
-                                    noise = np.random.poisson(lam=noise_lam, size=img.shape)
-                                    img += noise / 255.0
-
-                            # Apply random jpeg compression
-                            if random_distortion == 'jpeg' and random_jpeg:
-                                img = np.clip(img*255, 0, 255).astype(np.uint8)
-                                jpeg_compression_level = np.random.randint(50, 85)
-                                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_compression_level]
-                                _, enc_img = cv2.imencode('.jpg', img, encode_param)
-                                img = cv2.imdecode(enc_img, cv2.IMREAD_UNCHANGED).astype(np.float32) / 255.0
-
-                            # Apply random downsampling
-                            if random_distortion == 'down' and random_downsample:
-                                down_res = np.random.randint(int(0.125*resolution), int(0.25*resolution))
-                                img = cv2.resize(img, (down_res, down_res), interpolation=cv2.INTER_CUBIC)
-                                img = cv2.resize(img, (resolution, resolution), interpolation=cv2.INTER_CUBIC)
+                        img = imagelib.warp_by_params (params_per_resolution[resolution], img, warp, transform, can_flip=True, border_replicate=border_replicate, cv2_inter=cv2.INTER_LINEAR)
 
-                        img  = imagelib.warp_by_params (params_per_resolution[resolution], img,  warp, transform, can_flip=True, border_replicate=border_replicate)
-                        img = np.clip(img.astype(np.float32), 0, 1)
-
-                        if motion_blur is not None:
-                            random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+2)) if random_circle_mask else None
-                            img = imagelib.apply_random_motion_blur(img, *motion_blur, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+2) )
-
-                        if gaussian_blur is not None:
-                            random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+3)) if random_circle_mask else None
-                            img = imagelib.apply_random_gaussian_blur(img, *gaussian_blur, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+3) )
-
-                        if random_bilinear_resize is not None:
-                            random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+4)) if random_circle_mask else None
-                            img = imagelib.apply_random_bilinear_resize(img, *random_bilinear_resize, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+4) )
-
-
-
-                        # Transform from BGR to desired channel_type
-                        if channel_type == SPCT.BGR:
-                            out_sample = img
-                        elif channel_type == SPCT.LAB_RAND_TRANSFORM:
-                            out_sample = random_lab_rotation(img, sample_rnd_seed)
-                        elif channel_type == SPCT.G:
-                            out_sample = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)[...,None]
-                        elif channel_type == SPCT.GGG:
-                            out_sample = np.repeat ( np.expand_dims(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY),-1), (3,), -1)
-
-                    # Final transformations
-                    if nearest_resize_to is not None:
-                        out_sample = cv2_resize(out_sample, (nearest_resize_to,nearest_resize_to), interpolation=cv2.INTER_NEAREST)
-
-                    if not debug:
-                        if normalize_tanh:
-                            out_sample = np.clip (out_sample * 2.0 - 1.0, -1.0, 1.0)
-                    if data_format == "NCHW":
-                        out_sample = np.transpose(out_sample, (2,0,1) )
-                elif sample_type == SPST.IMAGE:
+                    if len(img.shape) == 2:
+                        img = img[...,None]
+
+                    if channel_type == SPCT.G:
+                        out_sample = img.astype(np.float32)
+                    else:
+                        raise ValueError("only channel_type.G supported for the mask")
+
+                elif sample_type == SPST.FACE_IMAGE:
                     img = sample_bgr
-                    img  = imagelib.warp_by_params (params_per_resolution[resolution], img,  warp, transform, can_flip=True, border_replicate=True)
-                    img  = cv2.resize( img,  (resolution, resolution), interpolation=cv2.INTER_CUBIC )
-                    out_sample = img
-
-                    if data_format == "NCHW":
-                        out_sample = np.transpose(out_sample, (2,0,1) )
-
-
-                elif sample_type == SPST.LANDMARKS_ARRAY:
-                    l = sample_landmarks
-                    l = np.concatenate ( [ np.expand_dims(l[:,0] / w,-1), np.expand_dims(l[:,1] / h,-1) ], -1 )
-                    l = np.clip(l, 0.0, 1.0)
-                    out_sample = l
-                elif sample_type == SPST.PITCH_YAW_ROLL or sample_type == SPST.PITCH_YAW_ROLL_SIGMOID:
-                    pitch,yaw,roll = sample.get_pitch_yaw_roll()
-                    if params_per_resolution[resolution]['flip']:
-                        yaw = -yaw
-
-                    if sample_type == SPST.PITCH_YAW_ROLL_SIGMOID:
-                        pitch = np.clip( (pitch / math.pi) / 2.0 + 0.5, 0, 1)
-                        yaw   = np.clip( (yaw / math.pi) / 2.0 + 0.5, 0, 1)
-                        roll  = np.clip( (roll / math.pi) / 2.0 + 0.5, 0, 1)
-
-                    out_sample = (pitch, yaw)
-                else:
-                    raise ValueError ('expected sample_type')
 
-                outputs_sample.append ( out_sample )
-            outputs += [outputs_sample]
+                    if random_rgb_levels:
+                        random_mask = sd.random_circle_faded ([w,w], rnd_state=np.random.RandomState (sample_rnd_seed) ) if random_circle_mask else None
+                        img = imagelib.apply_random_rgb_levels(img, mask=random_mask, rnd_state=np.random.RandomState (sample_rnd_seed) )
 
-        return outputs
+                    if random_hsv_shift:
+                        random_mask = sd.random_circle_faded ([w,w], rnd_state=np.random.RandomState (sample_rnd_seed+1) ) if random_circle_mask else None
+                        img = imagelib.apply_random_hsv_shift(img, mask=random_mask, rnd_state=np.random.RandomState (sample_rnd_seed+1) )
+
+
+                    is_ct = ct_mode is not None and ct_sample is not None or ct_mode == 'fs-aug'
+
+                    # the face transform can be fused with the random warp, if there is nothing between them
+                    is_fused = fused_warp and params_per_resolution[resolution]['rw'] is None and not is_ct and \
+                               not (random_blur or random_noise or random_jpeg or random_downsample)
+
+                    if face_type != sample_face_type:
+                        mat = LandmarksProcessor.get_transform_mat (sample_landmarks, resolution, face_type)
+                        if not is_fused:
+                            img = cv2.warpAffine( img, mat, (resolution,resolution), borderMode=borderMode, flags=cv2.INTER_CUBIC )
+                    else:
+                        mat = imagelib.get_resize_mat (w, resolution)
+                        if not is_fused and w != resolution:
+                            img = cv2.resize( img, (resolution, resolution), interpolation=cv2.INTER_CUBIC )
+
+                    # Apply random color transfer
+                    if is_ct:
+                        if ct_mode == 'fs-aug':
+                            img = imagelib.color_augmentation(img, sample_rnd_seed)
+                        else:
+                            if ct_sample_bgr is None:
+                                ct_sample_bgr = ct_sample.load_bgr()
+                            img = imagelib.color_transfer (ct_mode, img, cv2.resize( ct_sample_bgr, (resolution,resolution), interpolation=cv2.INTER_LINEAR ) )
+
+
+                    randomization_order = ['blur', 'noise', 'jpeg', 'down']
+                    rnd_state.shuffle(randomization_order)
+                    for random_distortion in randomization_order:
+                        # Apply random blur
+                        if random_distortion == 'blur' and random_blur:
+                            blur_type = rnd_state.choice(['motion', 'gaussian'])
+
+                            if blur_type == 'motion':
+                                blur_k = rnd_state.randint(10, 20)
+                                blur_angle = 360 * rnd_state.random()
+                                img = LinearMotionBlur(img, blur_k, blur_angle)
+                            elif blur_type == 'gaussian':
+                                blur_sigma = 5 * rnd_state.random() + 3
+
+                                if blur_sigma < 5.0:
+                                    kernel_size = 2.9 * blur_sigma  # 97% of weight
+                                else:
+                                    kernel_size = 2.6 * blur_sigma  # 95% of weight
+                                kernel_size = int(kernel_size)
+                                kernel_size = kernel_size + 1 if kernel_size % 2 == 0 else kernel_size
+
+                                img = cv2.GaussianBlur(img, (kernel_size, kernel_size), blur_sigma)
+
+                        # Apply random noise
+                        if random_distortion == 'noise' and random_noise:
+                            noise_type = rnd_state.choice(['gaussian', 'laplace', 'poisson'])
+                            noise_scale = (20 * rnd_state.random() + 20)
+
+                            if noise_type == 'gaussian':
+                                noise = rnd_state.normal(scale=noise_scale, size=img.shape)
+                                img += noise / 255.0
+                            elif noise_type == 'laplace':
+                                noise = rnd_state.laplace(scale=noise_scale, size=img.shape)
+                                img += noise / 255.0
+                            elif noise_type == 'poisson':
+                                noise_lam = (15 * rnd_state.random() + 15)
+                                noise = rnd_state.poisson(lam=noise_lam, size=img.shape)
+                                img += noise / 255.0
+
+                        # Apply random jpeg compression
+                        if random_distortion == 'jpeg' and random_jpeg:
+                            img = np.clip(img*255, 0, 255).astype(np.uint8)
+                            jpeg_compression_level = rnd_state.randint(50, 85)
+                            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_compression_level]
+                            _, enc_img = cv2.imencode('.jpg', img, encode_param)
+                            img = cv2.imdecode(enc_img, cv2.IMREAD_UNCHANGED).astype(np.float32) / 255.0
+
+                        # Apply random downsampling
+                        if random_distortion == 'down' and random_downsample:
+                            down_res = rnd_state.randint(int(0.125*resolution), int(0.25*resolution))
+                            img = cv2.resize(img, (down_res, down_res), interpolation=cv2.INTER_CUBIC)
+                            img = cv2.resize(img, (resolution, resolution), interpolation=cv2.INTER_CUBIC)
+
+                    if is_fused:
+                        img  = imagelib.warp_by_params_fused (params_per_resolution[resolution], img, mat, warp, transform, can_flip=True, border_replicate=border_replicate)
+                    else:
+                        img  = imagelib.warp_by_params (params_per_resolution[resolution], img,  warp, transform, can_flip=True, border_replicate=border_replicate)
+                    img = np.clip(img.astype(np.float32), 0, 1)
+
+                    if motion_blur is not None:
+                        random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+2)) if random_circle_mask else None
+                        img = imagelib.apply_random_motion_blur(img, *motion_blur, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+2) )
+
+                    if gaussian_blur is not None:
+                        random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+3)) if random_circle_mask else None
+                        img = imagelib.apply_random_gaussian_blur(img, *gaussian_blur, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+3) )
+
+                    if random_bilinear_resize is not None:
+                        random_mask = sd.random_circle_faded ([resolution,resolution], rnd_state=np.random.RandomState (sample_rnd_seed+4)) if random_circle_mask else None
+                        img = imagelib.apply_random_bilinear_resize(img, *random_bilinear_resize, mask=random_mask,rnd_state=np.random.RandomState (sample_rnd_seed+4) )
+
+
+
+                    # Transform from BGR to desired channel_type
+                    if channel_type == SPCT.BGR:
+                        out_sample = img
+                    elif channel_type == SPCT.LAB_RAND_TRANSFORM:
+                        out_sample = random_lab_rotation(img, sample_rnd_seed)
+                    elif channel_type == SPCT.G:
+                        out_sample = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)[...,None]
+                    elif channel_type == SPCT.GGG:
+                        out_sample = np.repeat ( np.expand_dims(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY),-1), (3,), -1)
+
+                # Final transformations
+                if nearest_resize_to is not None:
+                    out_sample = cv2_resize(out_sample, (nearest_resize_to,nearest_resize_to), interpolation=cv2.INTER_NEAREST)
+
+            elif sample_type == SPST.IMAGE:
+                img = sample_bgr
+                img  = imagelib.warp_by_params (params_per_resolution[resolution], img,  warp, transform, can_flip=True, border_replicate=True)
+                img  = cv2.resize( img,  (resolution, resolution), interpolation=cv2.INTER_CUBIC )
+                out_sample = img
+
+            elif sample_type == SPST.LANDMARKS_ARRAY:
+                l = sample_landmarks
+                l = np.concatenate ( [ np.expand_dims(l[:,0] / w,-1), np.expand_dims(l[:,1] / h,-1) ], -1 )
+                l = np.clip(l, 0.0, 1.0)
+                out_sample = l
+            elif sample_type == SPST.PITCH_YAW_ROLL or sample_type == SPST.PITCH_YAW_ROLL_SIGMOID:
+                pitch,yaw,roll = sample.get_pitch_yaw_roll()
+                if params_per_resolution[resolution]['flip']:
+                    yaw = -yaw
+
+                if sample_type == SPST.PITCH_YAW_ROLL_SIGMOID:
+                    pitch = np.clip( (pitch / math.pi) / 2.0 + 0.5, 0, 1)
+                    yaw   = np.clip( (yaw / math.pi) / 2.0 + 0.5, 0, 1)
+                    roll  = np.clip( (roll / math.pi) / 2.0 + 0.5, 0, 1)
+
+                out_sample = (pitch, yaw)
+            else:
+                raise ValueError ('expected sample_type')
+
+            if finalize:
+                out_sample = SampleProcessor.finalize_output(out_sample, opts, debug)
+
+            outputs_sample.append ( out_sample )
+
+        return outputs_sample
 
 """
 
@@ -0,0 +1,226 @@
+import bisect
+import multiprocessing
+import pickle
+
+import numpy as np
+
+from facelib import FaceType
+
+from .Sample import Sample, SampleType
+
+sample_types = { int(x) : x for x in SampleType }
+face_types = { int(x) : x for x in FaceType }
+
+
+class SampleTable():
+    """
+    Provides read-only list of Sample stored column-wise in shared memory aka 'multiprocessing.RawArray'
+    Thus no 4GB limit for subprocesses, and a sample is not unpickled on access.
+
+    Samples are returned as new Sample objects with numpy arrays viewing the shared memory,
+    so landmarks and xseg_mask_compressed of the returned sample are read-only.
+
+    supports list concat via + or sum()
+    """
+
+    # name, dtype, shape of row
+    fixed_columns = [ ('sample_type',         np.int8,    () ),
+                      ('face_type',           np.int32,   () ),
+                      ('shape',               np.int32,   (3,) ),
+                      ('shape_ndim',          np.int8,    () ),
+                      ('eyebrows_expand_mod', np.float64, () ),
+                      ('pitch_yaw_roll',      np.float32, (3,) ),
+                      ('has_pitch_yaw_roll',  np.bool_,   () ),
+                      ('packed_offset',       np.int64,   () ),
+                      ('packed_size',         np.int64,   () ),
+                    ]
+
+    # variable size columns of bytes, stored as data and offsets of rows
+    var_columns = ['filename', 'source_filename', 'person_name', 'packed_filename', 'landmarks', 'seg_ie_polys', 'xseg_mask_compressed']
+
+    def __init__(self, samples):
+        if samples is None:
+            self.segments = []
+        else:
+            self.segments = [ SampleTable.bake_data(samples) ]
+        self.update_starts()
+
+    def update_starts(self):
+        self.starts = [0]
+        for segment in self.segments:
+            self.starts.append ( self.starts[-1] + segment['count'] )
+        self.columns = [None]*len(self.segments)
+
+    def __add__(self, o):
+        if isinstance(o, SampleTable):
+            m = SampleTable(None)
+            m.segments = self.segments + o.segments
+            m.update_starts()
+            return m
+        elif isinstance(o, int):
+            return self
+        else:
+            raise ValueError(f"SampleTable object of class {o.__class__} is not supported for __add__ operator.")
+
+    def __radd__(self, o):
+        return self+o
+
+    def __getstate__(self):
+        return {'segments' : self.segments}
+
+    def __setstate__(self, d):
+        self.segments = d['segments']
+        self.update_starts()
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __iter__(self):
+        for i in range(self.__len__()):
+            yield self.__getitem__(i)
+
+    def get_columns(self, segment_id):
+        """
+        returns dict of flat memoryviews of the columns of segment, made once per process.
+        Indexing of memoryview returns python scalar without numpy overhead.
+        """
+        columns = self.columns[segment_id]
+        if columns is None:
+            segment = self.segments[segment_id]
+            sh_b = memoryview(segment['sh_b']).cast('B')
+
+            columns = {}
+            for name, (offset, dtype, shape) in segment['layout'].items():
+                dtype = np.dtype(dtype)
+                nbytes = int(np.prod(shape))*dtype.itemsize
+                columns[name] = sh_b[offset:offset+nbytes].toreadonly().cast(dtype.char)
+            self.columns[segment_id] = columns
+        return columns
+
+    def __getitem__(self, key):
+        samples_len = self.starts[-1]
+        if key < 0:
+            key = samples_len+key
+        if key < 0 or key >= samples_len:
+            raise ValueError("out of range")
+
+        segment_id = bisect.bisect_right(self.starts, key)-1
+        c = self.get_columns(segment_id)
+        i = key - self.starts[segment_id]
+
+        s = Sample.__new__(Sample)
+        s.sample_type = sample_types[ c['sample_type'][i] ]
+        s.face_type = face_types.get( c['face_type'][i], None)
+        shape_ndim = c['shape_ndim'][i]
+        s.shape = tuple( c['shape'][i*3:i*3+shape_ndim] ) if shape_ndim != -1 else None
+        s.eyebrows_expand_mod = c['eyebrows_expand_mod'][i]
+        s.pitch_yaw_roll = tuple( c['pitch_yaw_roll'][i*3:i*3+3] ) if c['has_pitch_yaw_roll'][i] else None
+
+        s.filename = SampleTable.get_str(c, 'filename', i)
+        s.source_filename = SampleTable.get_str(c, 'source_filename', i)
+        s.person_name = SampleTable.get_str(c, 'person_name', i)
+
+        landmarks = SampleTable.get_bytes(c, 'landmarks', i)
+        s.landmarks = np.frombuffer(landmarks, np.float32).reshape( (-1,2) ) if landmarks is not None else None
+
+        # unpickled by Sample on first access, most samples have no polys
+        seg_ie_polys = SampleTable.get_bytes(c, 'seg_ie_polys', i)
+        s._seg_ie_polys = None
+        s._seg_ie_polys_data = bytes(seg_ie_polys) if seg_ie_polys is not None else None
+
+        s.xseg_mask = None
+        xseg_mask_compressed = SampleTable.get_bytes(c, 'xseg_mask_compressed', i)
+        s.xseg_mask_compressed = np.frombuffer(xseg_mask_compressed, np.uint8) if xseg_mask_compressed is not None else None
+
+        packed_filename = SampleTable.get_str(c, 'packed_filename', i)
+        s._filename_offset_size = (packed_filename, c['packed_offset'][i], c['packed_size'][i] ) if packed_filename is not None else None
+        return s
+
+    @staticmethod
+    def get_bytes(c, name, i):
+        """
+        returns memoryview of value of variable size column, or None
+        """
+        offsets = c[name+'_offsets']
+        start = offsets[i*2]
+        if start == -1:
+            return None
+        return c[name][start:offsets[i*2+1]]
+
+    @staticmethod
+    def get_str(c, name, i):
+        value = SampleTable.get_bytes(c, name, i)
+        if value is not None:
+            value = str(value, 'utf-8')
+        return value
+
+    @staticmethod
+    def bake_data(samples):
+        if not isinstance(samples, list):
+            raise ValueError("SampleTable: samples should be list type.")
+
+        count = len(samples)
+
+        columns = { name : np.zeros( (count,)+shape, dtype ) for name, dtype, shape in SampleTable.fixed_columns }
+        var_values = { name : [None]*count for name in SampleTable.var_columns }
+
+        for i, s in enumerate(samples):
+            columns['sample_type'][i] = int(s.sample_type)
+            columns['face_type'][i] = int(s.face_type) if s.face_type is not None else -1
+
+            if s.shape is not None:
+                columns['shape'][i][:len(s.shape)] = s.shape
+                columns['shape_ndim'][i] = len(s.shape)
+            else:
+                columns['shape_ndim'][i] = -1
+
+            columns['eyebrows_expand_mod'][i] = s.eyebrows_expand_mod
+            if s.pitch_yaw_roll is not None:
+                columns['pitch_yaw_roll'][i] = s.pitch_yaw_roll
+                columns['has_pitch_yaw_roll'][i] = True
+
+            for name in ['filename', 'source_filename', 'person_name']:
+                value = getattr(s, name)
+                if value is not None:
+                    var_values[name][i] = str(value).encode('utf-8')
+
+            if s._filename_offset_size is not None:
+                packed_filename, offset, size = s._filename_offset_size
+                var_values['packed_filename'][i] = str(packed_filename).encode('utf-8')
+                columns['packed_offset'][i] = offset
+                columns['packed_size'][i] = size
+
+            if s.landmarks is not None:
+                var_values['landmarks'][i] = np.ascontiguousarray(s.landmarks, np.float32).tobytes()
+
+            if s.seg_ie_polys is not None and s.seg_ie_polys.has_polys():
+                var_values['seg_ie_polys'][i] = pickle.dumps(s.seg_ie_polys.dump(), 4)
+
+            if s.xseg_mask_compressed is not None:
+                var_values['xseg_mask_compressed'][i] = np.asarray(s.xseg_mask_compressed, np.uint8).tobytes()
+
+        for name in SampleTable.var_columns:
+            # start, end of row, -1 for None
+            offsets = np.full( (count,2), -1, np.int64)
+            offset = 0
+            for i, value in enumerate(var_values[name]):
+                if value is not None:
+                    offsets[i] = (offset, offset+len(value))
+                    offset += len(value)
+            columns[name+'_offsets'] = offsets
+            columns[name] = np.frombuffer( b"".join( value for value in var_values[name] if value is not None ), np.uint8)
+
+        # 64 bytes aligned columns in one shared buffer
+        layout = {}
+        size = 0
+        for name, ar in columns.items():
+            layout[name] = (size, ar.dtype.str, ar.shape)
+            size += (ar.nbytes + 63) // 64 * 64
+
+        sh_b = multiprocessing.RawArray('B', max(1, size) )
+        sh_b_view = memoryview(sh_b).cast('B')
+        for name, ar in columns.items():
+            offset = layout[name][0]
+            sh_b_view[offset:offset+ar.nbytes] = np.ascontiguousarray(ar).view(np.uint8).reshape(-1)
+
+        return {'count' : count, 'layout' : layout, 'sh_b' : sh_b}
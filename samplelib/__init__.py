@@ -1,7 +1,9 @@
 from .Sample import Sample
 from .Sample import SampleType
+from .SampleTable import SampleTable
 from .SampleLoader import SampleLoader
 from .SampleProcessor import SampleProcessor
+from .SampleImageCache import SampleImageCache
 from .SampleGeneratorBase import SampleGeneratorBase
 from .SampleGeneratorFace import SampleGeneratorFace
 from .SampleGeneratorFacePerson import SampleGeneratorFacePerson
@@ -0,0 +1,123 @@
+"""
+Check of the fused warp of SampleProcessor against the step by step reference path
+
+    python -m samplelib.fused_warp_check
+
+Faces are coordinate ramps, B is x and G is y of the source pixel and R is 255,
+so every output pixel tells from which source pixel it was sampled.
+process_batch runs with Options(fused_warp=True) and fused_warp=False on the same seed,
+and the distance of sampled source coordinates is measured away from the borders of the source image
+and of the face crop, which are replicated differently by the two paths.
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from core import imagelib
+from core.cv2ex import cv2_imwrite
+from facelib import FaceType, LandmarksProcessor
+from samplelib import SampleProcessor
+from samplelib.Sample import Sample, SampleType
+
+# max allowed distance of sampled source coordinates in source pixels
+max_mean_error = 0.5
+max_p99_error = 1.0
+
+def make_samples(dirpath, count=8, w=256):
+    """
+    returns list of FULL face samples of coordinate ramp images with randomly placed landmarks
+    """
+    rnd_state = np.random.RandomState(0)
+
+    x, y = np.meshgrid( np.arange(w), np.arange(w) )
+    img = np.stack( [x, y, np.full_like(x, 255)], -1 ).astype(np.uint8)
+
+    lmrks = LandmarksProcessor.landmarks_68_3D[:,:2]
+    lmrks = (lmrks - lmrks.mean(0)) / (lmrks.max(0)-lmrks.min(0)).max()
+
+    samples = []
+    for i in range(count):
+        # face covers the middle of the image, slightly rotated and shifted
+        mat = cv2.getRotationMatrix2D( (0,0), rnd_state.uniform(-10,10), w*rnd_state.uniform(0.4, 0.5) )
+        mat[:,2] += w/2 + rnd_state.uniform(-0.05, 0.05, size=(2,))*w
+        sample_lmrks = LandmarksProcessor.transform_points(lmrks, mat)
+
+        filepath = Path(dirpath) / f'{i}.png'
+        cv2_imwrite(filepath, img)
+        samples.append ( Sample(sample_type=SampleType.FACE, filename=str(filepath), face_type=FaceType.FULL, shape=img.shape, landmarks=sample_lmrks) )
+    return samples
+
+def get_output_sample_types(face_type, resolution):
+    return [ {'sample_type': SampleProcessor.SampleType.FACE_IMAGE, 'warp':warp, 'transform':True, 'channel_type' : SampleProcessor.ChannelType.BGR,
+              'face_type':face_type, 'resolution': resolution} for warp in [False, True] ]
+
+def process(samples, output_sample_types, fused_warp, seed):
+    np.random.seed(seed)
+    return SampleProcessor.process_batch (samples, SampleProcessor.Options(fused_warp=fused_warp), output_sample_types, False)
+
+def get_error(samples, output_sample_types, seed):
+    """
+    returns list of (mean, p99) distance in source pixels per output
+    """
+    outputs_ref = process(samples, output_sample_types, False, seed)
+    outputs_fused = process(samples, output_sample_types, True, seed)
+
+    w = samples[0].shape[1]
+    result = []
+    for ref, fused, opts in zip(outputs_ref, outputs_fused, output_sample_types):
+        ref_xy = ref[...,:2]*255.0
+        fused_xy = fused[...,:2]*255.0
+
+        # source pixels inside the image.
+        # R of pixels interpolated with constant border of the reference path is below 255
+        valid = np.all( (ref_xy > 2) & (ref_xy < w-3) & (fused_xy > 2) & (fused_xy < w-3), -1 ) & \
+                (ref[...,2] > 254.5/255.0) & (fused[...,2] > 254.5/255.0)
+
+        # and inside the face crop, which is replicated by the reference path
+        resolution = opts['resolution']
+        for sample, sample_valid, sample_xy in zip(samples, valid, fused_xy):
+            if opts['face_type'] != sample.face_type:
+                mat = LandmarksProcessor.get_transform_mat (sample.landmarks, resolution, opts['face_type'])
+            else:
+                mat = imagelib.get_resize_mat (w, resolution)
+            crop_xy = LandmarksProcessor.transform_points( sample_xy.reshape( (-1,2) ), mat).reshape(sample_xy.shape)
+            sample_valid &= np.all( (crop_xy > 2) & (crop_xy < resolution-3), -1 )
+
+        valid = np.stack( [ cv2.erode(x.astype(np.uint8), np.ones( (5,5), np.uint8) ) for x in valid ] ) != 0
+
+        dist = np.linalg.norm(ref_xy - fused_xy, axis=-1)[valid]
+        result.append ( (dist.mean(), np.percentile(dist, 99)) )
+    return result
+
+def bench(samples, output_sample_types, fused_warp, count=10):
+    process(samples, output_sample_types, fused_warp, 0)
+    t = time.perf_counter()
+    for i in range(count):
+        process(samples, output_sample_types, fused_warp, i)
+    return (time.perf_counter() - t) / count / len(samples)
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as dirpath:
+        samples = make_samples(dirpath)
+
+        is_ok = True
+        for face_type in [FaceType.FULL, FaceType.WHOLE_FACE]:
+            for resolution in [64, 128, 256]:
+                output_sample_types = get_output_sample_types(face_type, resolution)
+
+                for seed in range(4):
+                    for (mean, p99), opts in zip ( get_error(samples, output_sample_types, seed), output_sample_types):
+                        if mean > max_mean_error or p99 > max_p99_error:
+                            is_ok = False
+                            print(f"FAILED {FaceType.toString(face_type)} {resolution} warp={opts['warp']} seed={seed} : mean {mean:.3f} px, p99 {p99:.3f} px")
+
+                (mean, p99), (warp_mean, warp_p99) = get_error(samples, output_sample_types, 0)
+                print(f"{FaceType.toString(face_type):>10} {resolution:>3} : error mean {mean:.3f} px, p99 {p99:.3f} px, with warp mean {warp_mean:.3f} px, p99 {warp_p99:.3f} px, "
+                      f"{bench(samples, output_sample_types, False)*1000:.2f} -> {bench(samples, output_sample_types, True)*1000:.2f} ms per sample")
+
+        print("OK" if is_ok else "FAILED")
+        if not is_ok:
+            exit(1)